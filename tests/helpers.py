@@ -0,0 +1,33 @@
+import numpy as np
+
+
+def synthetic_dsm(size, veg_density=0.0, seed=0):
+    """
+    Block city on flat ground at 10 m, buildings of 3 - 60 m separated by 12 pixel
+    streets and tree crowns of 5 - 15 m covering about veg_density of the open
+    ground.
+
+    Returns the DSM and the canopy and trunk zone DSMs offset by the DSM as used by
+    the shadow functions (zero without vegetation), all float32.
+    """
+    rng = np.random.default_rng(seed)
+    block, street, crown = 32, 12, 4
+    ground = 10.0
+    nblocks = -(-size // block)
+    heights = rng.uniform(3.0, 60.0, (nblocks, nblocks))
+    # a fifth of the blocks are left open
+    heights[rng.random((nblocks, nblocks)) < 0.2] = 0.0
+    heights = np.kron(heights, np.ones((block, block)))[:size, :size]
+    idx = np.arange(size) % block
+    built = (idx[:, None] >= street) & (idx[None, :] >= street)
+    dsm = (ground + np.where(built, heights, 0.0)).astype(np.float32)
+
+    ncrowns = -(-size // crown)
+    canopy = rng.uniform(5.0, 15.0, (ncrowns, ncrowns))
+    canopy[rng.random((ncrowns, ncrowns)) >= veg_density] = 0.0
+    canopy = np.kron(canopy, np.ones((crown, crown)))[:size, :size]
+    canopy[dsm > ground] = 0.0
+    vegdem = np.where(canopy > 0, canopy + dsm, 0.0).astype(np.float32)
+    vegdem2 = np.where(canopy > 0, 0.25 * canopy + dsm, 0.0).astype(np.float32)
+
+    return dsm, vegdem, vegdem2
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from umep.util import benchmark
+
+
+def test_run_benchmarks_tiny_case():
+    records = benchmark.run_benchmarks(
+        sizes=[32],
+        functions=["shadowingfunctionglobalradiation"],
+        altitudes=[30.0],
+        azimuths=[135.0],
+        veg_densities=[0.0],
+    )
+    assert [record["backend"] for record in records] == ["numpy", "numba"]
+    for record in records:
+        assert record["positions"] == 1
+        assert record["steps"] > 0
+        assert record["seconds"] > 0
+    assert records[0]["speedup"] == pytest.approx(1.0)
+    assert records[1]["speedup"] > 0
+
+
+def test_unknown_function():
+    with pytest.raises(ValueError):
+        benchmark.run_benchmarks(functions=["shadowingfunction_99"])
+
+
+def test_main_writes_json(tmp_path):
+    output = tmp_path / "shadows.json"
+    benchmark.main(
+        [
+            "--sizes",
+            "32",
+            "--functions",
+            "shadowingfunction_20",
+            "--backends",
+            "numba",
+            "--altitudes",
+            "45",
+            "--azimuths",
+            "200",
+            "--veg-densities",
+            "0.3",
+            "--output",
+            str(output),
+        ]
+    )
+    report = json.loads(output.read_text())
+    assert set(report) == {"environment", "results"}
+    (record,) = report["results"]
+    assert record["function"] == "shadowingfunction_20"
+    assert record["veg_density"] == 0.3
+    # no numpy reference was run
+    assert record["speedup"] is None
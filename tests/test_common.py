@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from rasterio.transform import from_origin
+
+from umep import common
+
+
+def _bands():
+    rng = np.random.default_rng(0)
+    return {name: rng.random((40, 30)) for name in ("svf", "svfE", "svfveg")}
+
+
+def test_raster_bands_read_by_name(tmp_path):
+    bands = _bands()
+    transform = from_origin(1000.0, 2000.0, 1.0, 1.0)
+    path = tmp_path / "svfs.tif"
+    common.save_raster_bands(path, bands, transform, "EPSG:32633")
+    read, transf, crs = common.load_raster_bands(path, ["svfveg", "svf"])
+    assert list(read) == ["svfveg", "svf"]
+    for name, band in read.items():
+        np.testing.assert_array_equal(band, bands[name])
+    assert transf == transform
+    assert crs.to_epsg() == 32633
+    # the bbox window of a single band equals load_raster on the same window
+    bbox = [1005.0, 1970.0, 1020.0, 1990.0]
+    window, _, _ = common.load_raster_bands(path, ["svfE"], bbox)
+    np.testing.assert_array_equal(window["svfE"], bands["svfE"][10:30, 5:20])
+
+
+def test_missing_band(tmp_path):
+    path = tmp_path / "svfs.tif"
+    common.save_raster_bands(
+        path, _bands(), from_origin(0.0, 40.0, 1.0, 1.0), "EPSG:32633"
+    )
+    with pytest.raises(ValueError):
+        common.load_raster_bands(path, ["svfaveg"])
@@ -0,0 +1,19 @@
+import umep
+from umep.util import compilation
+
+
+def test_warmup_report():
+    report = umep.warmup()
+    assert set(report) == {"total", "compile", "run", "kernels"}
+    assert report["compile"] <= report["total"]
+    # once warm, later calls neither compile nor miss the on-disk cache
+    again = umep.warmup()
+    assert again["compile"] == 0.0
+    assert all(kernel["cache_misses"] == 0 for kernel in again["kernels"].values())
+
+
+def test_compile_report_of_a_block():
+    with compilation.compile_report() as report:
+        sum(range(10))
+    assert report["kernels"] == {}
+    assert report["run"] == report["total"]
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from umep.util import heightpyramid as hp
+from umep.util import shadowingfunctions as shadow
+from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_23 import (
+    shadowingfunction_wallheight_23,
+)
+
+
+def _no_stops(a, obstr=()):
+    # bounds under which no tile stops early, i.e. the full ray march
+    bmax, bmin = hp.tile_bounds(a, obstr)
+    return np.full_like(bmax, np.inf), np.full_like(bmin, -np.inf)
+
+
+def _raised_city():
+    # ground at 10 m with two buildings and a tree, most tiles stop early
+    rng = np.random.default_rng(3)
+    a = 10.0 + rng.random((320, 300)) * 2.0
+    a[140:170, 150:180] = 40.0
+    a[20:30, 250:290] = 25.0
+    vegdem = np.zeros_like(a)
+    vegdem[200:215, 60:80] = a[200:215, 60:80] + 8.0
+    vegdem2 = np.where(vegdem > 0, a + 2.0, 0.0)
+    walls = np.zeros_like(a)
+    walls[139, 150:180] = walls[170, 150:180] = 30.0
+    aspect = np.zeros_like(a)
+    aspect[170, 150:180] = np.pi
+    return a, vegdem, vegdem2, walls, aspect
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+@pytest.mark.parametrize("azimuth", [45.0, 200.0])
+def test_early_termination_matches_full_march(backend, azimuth):
+    a, vegdem, vegdem2, walls, aspect = _raised_city()
+    bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    amaxvalue = max(a.max(), vegdem.max())
+    bounds = hp.tile_bounds(a, (vegdem, vegdem2))
+    steps = shadow.shadow_steps(azimuth, 20.0, 1.0, *a.shape, amaxvalue, 0.0)
+    assert np.any(hp.tile_stops(bounds, *steps) < steps[0].shape[0])
+    nostops = _no_stops(a, (vegdem, vegdem2))
+
+    sh = shadow.shadowingfunctionglobalradiation(a, azimuth, 20.0, 1.0, 1, backend)
+    full = shadow.shadowingfunctionglobalradiation(
+        a, azimuth, 20.0, 1.0, 1, backend, _no_stops(a)
+    )
+    np.testing.assert_array_equal(sh, full)
+    args = (a, vegdem, vegdem2, azimuth, 20.0, 1.0, amaxvalue, bush)
+    result = shadow.shadowingfunction_20(*args, 1, backend)
+    full = shadow.shadowingfunction_20(*args, 1, backend, None, nostops)
+    for key in result:
+        np.testing.assert_array_equal(result[key], full[key])
+    result = shadowingfunction_wallheight_23(*args, walls, aspect, backend)
+    full = shadowingfunction_wallheight_23(*args, walls, aspect, backend, nostops)
+    for grid, reference in zip(result, full):
+        np.testing.assert_array_equal(grid, reference)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+@pytest.mark.parametrize("azimuth", [0.0, 45.0, 100.0, 200.0, 300.0])
+def test_early_termination_below_zero(backend, azimuth):
+    # the grid is padded with zeros, which shade surfaces below zero
+    rng = np.random.default_rng(0)
+    a = rng.random((150, 130)) * 6.0 - 5.0
+    a[40:60, 40:70] = 12.0
+    for altitude in (10.0, 30.0):
+        sh = shadow.shadowingfunctionglobalradiation(
+            a, azimuth, altitude, 1.0, 1, backend
+        )
+        full = shadow.shadowingfunctionglobalradiation(
+            a, azimuth, altitude, 1.0, 1, backend, _no_stops(a)
+        )
+        np.testing.assert_array_equal(sh, full)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+def test_early_termination_below_zero_vegetation(backend):
+    rng = np.random.default_rng(1)
+    a = rng.random((150, 130)) * 6.0 - 5.0
+    a[40:60, 40:70] = 12.0
+    vegdem = np.zeros_like(a)
+    vegdem[90:100, 20:40] = a[90:100, 20:40] + 8.0
+    vegdem2 = np.where(vegdem > 0, a + 2.0, 0.0)
+    bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    amaxvalue = max(a.max(), vegdem.max())
+    for azimuth in (45.0, 200.0):
+        result = shadow.shadowingfunction_20(
+            a, vegdem, vegdem2, azimuth, 20.0, 1.0, amaxvalue, bush, 1, backend
+        )
+        full = shadow.shadowingfunction_20(
+            a,
+            vegdem,
+            vegdem2,
+            azimuth,
+            20.0,
+            1.0,
+            amaxvalue,
+            bush,
+            1,
+            backend,
+            None,
+            _no_stops(a, (vegdem, vegdem2)),
+        )
+        for key in result:
+            np.testing.assert_array_equal(result[key], full[key])
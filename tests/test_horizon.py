@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.util import horizon
+from umep.util import shadowingfunctions as shadow
+
+
+@pytest.fixture(scope="module")
+def index():
+    dsm, _, _ = synthetic_dsm(96, seed=7)
+    return dsm, horizon.build_horizon_index(dsm, 1.0, 36, sub_rays=0)
+
+
+@pytest.fixture(scope="module")
+def veg_index():
+    dsm, vegdem, vegdem2 = synthetic_dsm(96, veg_density=0.3, seed=7)
+    bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    grids = (dsm, vegdem, vegdem2, bush)
+    return grids, horizon.build_horizon_index(
+        dsm, 1.0, 36, vegdem=vegdem, vegdem2=vegdem2, bush=bush
+    )
+
+
+def _lost_shadow(grids, index, azimuth, altitude):
+    # pixels in building or vegetation shadow of shadowingfunction_20 that the
+    # lookup gives as sunlit
+    dsm, vegdem, vegdem2, bush = grids
+    amaxvalue = max(dsm.max(), vegdem.max())
+    exact = shadow.shadowingfunction_20(
+        dsm, vegdem, vegdem2, azimuth, altitude, 1.0, amaxvalue, bush, 1
+    )
+    lookup = horizon.horizon_shadows(index, azimuth, altitude)
+    shade = (exact["sh"] == 0) | (exact["vegsh"] == 0)
+    return shade & (lookup["sh"] != 0) & (lookup["vegsh"] != 0)
+
+
+@pytest.mark.parametrize("sector", [0, 5, 10, 15, 20, 25, 30, 35])
+@pytest.mark.parametrize("altitude", [7.3, 21.1, 44.6])
+def test_lookup_at_sector_centres(index, sector, altitude):
+    # angles are rounded up, so the lookup only adds shade, and only where the
+    # horizon is within one quantisation step of the sun
+    dsm, index = index
+    azimuth = index["sectors"][sector]
+    exact = shadow.shadowingfunctionglobalradiation(dsm, azimuth, altitude, 1.0, 1)
+    lookup = horizon.horizon_shadows(index, azimuth, altitude)["sh"]
+    assert not np.any((exact == 0) & (lookup != 0))
+    angle = index["bldg"][sector] * horizon.HORIZON_QUANT
+    differ = exact != lookup
+    assert np.all(np.abs(angle[differ] - altitude) <= horizon.HORIZON_QUANT)
+
+
+@pytest.mark.parametrize("offset", [0.0, 15.0])
+def test_no_shadow_lost_within_ray_spacing(offset):
+    # 51 rays per 30 degree sector are less than 1 / 48 apart in tan, so every
+    # step of the exact rays on the 48 pixel grid lands on a cell of the index
+    # rays, also below zero where the edge padding shades the ground
+    dsm, vegdem, vegdem2 = synthetic_dsm(48, veg_density=0.3, seed=3)
+    dsm = dsm - offset
+    vegdem = np.where(vegdem > 0, vegdem - offset, 0.0)
+    vegdem2 = np.where(vegdem2 > 0, vegdem2 - offset, 0.0)
+    bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    grids = (dsm, vegdem, vegdem2, bush)
+    index = horizon.build_horizon_index(
+        dsm, 1.0, 12, vegdem=vegdem, vegdem2=vegdem2, bush=bush, sub_rays=50
+    )
+    rng = np.random.default_rng(1)
+    for azimuth, altitude in zip(rng.uniform(0, 360, 24), rng.uniform(2, 70, 24)):
+        assert not np.any(_lost_shadow(grids, index, azimuth, altitude))
+
+
+@pytest.mark.parametrize("fraction", [-0.5, -0.3, 0.1, 0.4])
+@pytest.mark.parametrize("sector", [2, 11, 20, 29])
+@pytest.mark.parametrize("altitude", [6.2, 18.5, 37.9])
+def test_lookup_off_centre(veg_index, fraction, sector, altitude):
+    # default sub rays, obstructions further than the ray spacing bound could be
+    # missed, none is in the block city
+    grids, index = veg_index
+    azimuth = index["sectors"][sector] + fraction * 10.0
+    assert not np.any(_lost_shadow(grids, index, azimuth, altitude))
+
+
+def test_trunk_zone():
+    # a crown from 4 to 12 m above the ground east of the pixel: a low sun shines
+    # through the trunk zone, a higher one is blocked by the crown
+    dsm = np.full((40, 40), 10.0)
+    vegdem = np.zeros_like(dsm)
+    vegdem2 = np.zeros_like(dsm)
+    vegdem[18:22, 24:28] = 22.0
+    vegdem2[18:22, 24:28] = 14.0
+    bush = np.zeros_like(dsm)
+    grids = (dsm, vegdem, vegdem2, bush)
+    index = horizon.build_horizon_index(dsm, 1.0, 36, vegdem=vegdem, vegdem2=vegdem2)
+    for altitude, shaded in ((10.0, False), (45.0, True)):
+        lookup = horizon.horizon_shadows(index, 90.0, altitude)
+        assert (lookup["vegsh"][20, 20] == 0) == shaded
+        assert not np.any(_lost_shadow(grids, index, 90.0, altitude))
+
+
+def test_save_and_load(veg_index, tmp_path):
+    _, index = veg_index
+    path = tmp_path / "horizon.npz"
+    horizon.save_horizon_index(path, index)
+    loaded = horizon.load_horizon_index(path)
+    assert loaded.keys() == index.keys()
+    for key in index:
+        np.testing.assert_array_equal(loaded[key], index[key])
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from umep.util import nearfield
+from umep.util import shadowingfunctions as shadow
+
+
+def _city(seed, shape=(160, 150), offset=0.0):
+    rng = np.random.default_rng(seed)
+    a = rng.random(shape) * 2.0 + offset
+    for _ in range(25):
+        x = rng.integers(0, shape[0])
+        y = rng.integers(0, shape[1])
+        a[x : x + rng.integers(3, 15), y : y + rng.integers(3, 15)] = rng.random() * 40
+    return a
+
+
+@pytest.mark.parametrize("scale", [0.5, 1.0, 2.0])
+@pytest.mark.parametrize("azimuth", [0.0, 68.0, 135.0, 250.0, 340.0])
+def test_far_field_never_sunlit_where_shaded(scale, azimuth):
+    # the far field only adds shade, also along the grid edges and below zero
+    for a in (_city(0), _city(1, offset=-1.0)):
+        for altitude in (10.0, 20.0, 45.0):
+            exact = shadow.shadowingfunctionglobalradiation(
+                a, azimuth, altitude, scale, 1
+            )
+            for near_radius in (5.0, 15.0, 30.0):
+                hybrid = nearfield.shadowingfunctionglobalradiation_hybrid(
+                    a, azimuth, altitude, scale, near_radius
+                )
+                assert not np.any((exact == 0) & (hybrid != 0))
+
+
+def test_far_field_vegetation_never_sunlit_where_shaded():
+    a = _city(2)
+    vegdem = np.zeros_like(a)
+    vegdem[100:110, 20:30] = a[100:110, 20:30] + 10.0
+    vegdem[10:16, 120:140] = a[10:16, 120:140] + 6.0
+    vegdem2 = np.where(vegdem > 0, a + 2.0, 0.0)
+    bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    amaxvalue = max(a.max(), vegdem.max())
+    for azimuth, altitude in ((45.0, 10.0), (200.0, 25.0), (300.0, 15.0)):
+        exact = shadow.shadowingfunction_20(
+            a, vegdem, vegdem2, azimuth, altitude, 1.0, amaxvalue, bush, 1
+        )
+        hybrid = nearfield.shadowingfunction_20_hybrid(
+            a, vegdem, vegdem2, azimuth, altitude, 1.0, amaxvalue, bush, 15.0
+        )
+        shaded = (exact["sh"] == 0) | (exact["vegsh"] == 0)
+        sunlit = (hybrid["sh"] != 0) & (hybrid["vegsh"] != 0)
+        assert not np.any(shaded & sunlit)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.util import shadowbatch
+from umep.util import shadowingfunctions as shadow
+
+AZIMUTHS = [40.0, 130.0, 210.0, 290.0, 350.0]
+ALTITUDES = [8.0, 25.0, 40.0, 60.0, 15.0]
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+def test_batch_matches_single_positions(backend):
+    dsm, _, _ = synthetic_dsm(80, seed=5)
+    batch = shadowbatch.shadowingfunction_batch(
+        dsm, AZIMUTHS, ALTITUDES, 1.0, backend=backend, workers=3
+    )
+    assert batch["sh"].shape == (len(AZIMUTHS),) + dsm.shape
+    for idx, (azimuth, altitude) in enumerate(zip(AZIMUTHS, ALTITUDES)):
+        sh = shadow.shadowingfunctionglobalradiation(
+            dsm, azimuth, altitude, 1.0, 1, backend
+        )
+        np.testing.assert_array_equal(batch["sh"][idx], sh)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+def test_iter_shadows_vegetation_in_order(backend):
+    dsm, vegdem, vegdem2 = synthetic_dsm(80, 0.3, seed=6)
+    amaxvalue = max(dsm.max(), vegdem.max())
+    bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    results = list(
+        shadowbatch.iter_shadows(
+            dsm, AZIMUTHS, ALTITUDES, 1.0, vegdem, vegdem2, backend=backend, workers=2
+        )
+    )
+    assert [idx for idx, _ in results] == list(range(len(AZIMUTHS)))
+    for (idx, result), azimuth, altitude in zip(results, AZIMUTHS, ALTITUDES):
+        single = shadow.shadowingfunction_20(
+            dsm, vegdem, vegdem2, azimuth, altitude, 1.0, amaxvalue, bush, 1, backend
+        )
+        assert result.keys() == single.keys()
+        for key in single:
+            np.testing.assert_array_equal(result[key], single[key])
+
+
+def test_mismatched_positions():
+    dsm, _, _ = synthetic_dsm(32)
+    with pytest.raises(ValueError):
+        list(shadowbatch.iter_shadows(dsm, [45.0, 90.0], [30.0], 1.0))
+
+
+def test_process_pool_matches_in_process():
+    dsm, vegdem, vegdem2 = synthetic_dsm(64, 0.3, seed=16)
+    azimuths = np.linspace(0.0, 350.0, 12)
+    altitudes = np.linspace(10.0, 70.0, 12)
+    local = dict(
+        shadowbatch.iter_shadows(
+            dsm, azimuths, altitudes, 1.0, vegdem, vegdem2, backend="numba"
+        )
+    )
+    pooled = list(
+        shadowbatch.iter_shadows(
+            dsm, azimuths, altitudes, 1.0, vegdem, vegdem2, backend="numba", processes=2
+        )
+    )
+    assert [idx for idx, _ in pooled] == list(range(len(azimuths)))
+    for idx, result in pooled:
+        for key in local[idx]:
+            np.testing.assert_array_equal(result[key], local[idx][key])
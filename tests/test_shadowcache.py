@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+from helpers import synthetic_dsm
+
+from umep.util import shadowbatch, shadowcache
+from umep.util import shadowingfunctions as shadow
+
+
+def test_cached_shadows_match_rounded_positions(tmp_path):
+    dsm, _, _ = synthetic_dsm(64, seed=11)
+    cache = shadowcache.open_cache(tmp_path)
+    azimuths = [45.004, 181.333]
+    altitudes = [20.006, 33.331]
+    for _ in range(2):
+        # the second run reads the entries of the first
+        results = dict(
+            shadowbatch.iter_shadows(dsm, azimuths, altitudes, 1.0, cache=cache)
+        )
+        assert len(os.listdir(tmp_path)) == len(azimuths)
+        for idx, (azimuth, altitude) in enumerate(zip(azimuths, altitudes)):
+            sh = shadow.shadowingfunctionglobalradiation(
+                dsm, round(azimuth, 2), round(altitude, 2), 1.0, 1
+            )
+            np.testing.assert_array_equal(results[idx]["sh"], sh)
+
+
+def test_hits_and_corrupt_entries(tmp_path):
+    cache = shadowcache.open_cache(tmp_path)
+    calls = []
+
+    def cast(azimuth, altitude):
+        calls.append((azimuth, altitude))
+        return {"sh": np.full((4, 4), azimuth)}
+
+    first = shadowcache.cached(cache, "site", 10.0, 20.0, cast)
+    second = shadowcache.cached(cache, "site", 10.001, 20.0, cast)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(first["sh"], second["sh"])
+    (path,) = tmp_path.iterdir()
+    path.write_bytes(b"truncated")
+    shadowcache.cached(cache, "site", 10.0, 20.0, cast)
+    assert len(calls) == 2
+
+
+def test_eviction_keeps_the_cap(tmp_path):
+    cache = shadowcache.open_cache(tmp_path, max_bytes=20000)
+    rng = np.random.default_rng(0)
+    for azimuth in range(20):
+        shadowcache.cached(
+            cache, "site", float(azimuth), 30.0, lambda *_: {"sh": rng.random(500)}
+        )
+        size = sum(entry.stat().st_size for entry in tmp_path.iterdir())
+        assert size <= 20000
+    assert (tmp_path / "site_0.01_1900_3000.npz").exists()
+
+
+def test_quanta_do_not_share_entries(tmp_path):
+    # a position in whole quanta means another angle with another quantum
+    fine = shadowcache.open_cache(tmp_path, quantum=0.01)
+    coarse = shadowcache.open_cache(tmp_path, quantum=0.5)
+
+    def cast(azimuth, altitude):
+        return {"position": np.array([azimuth, altitude])}
+
+    shadowcache.cached(fine, "site", 0.2, 0.3, cast)
+    result = shadowcache.cached(coarse, "site", 10.0, 15.0, cast)
+    np.testing.assert_array_equal(result["position"], [10.0, 15.0])
+    result = shadowcache.cached(fine, "site", 0.2, 0.3, cast)
+    np.testing.assert_allclose(result["position"], [0.2, 0.3])
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_site_key_depends_on_grids_and_params():
+    a = np.zeros((4, 4))
+    key = shadowcache.site_key((a, None), {"scale": 1.0})
+    assert key == shadowcache.site_key((a.copy(), None), {"scale": 1.0})
+    assert key != shadowcache.site_key((a, a), {"scale": 1.0})
+    assert key != shadowcache.site_key((a, None), {"scale": 0.5})
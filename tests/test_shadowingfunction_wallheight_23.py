@@ -0,0 +1,34 @@
+from functools import cache
+
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.functions import wallalgorithms as wa
+from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_23 import (
+    shadowingfunction_wallheight_23,
+)
+
+
+@cache
+def _walls():
+    # the block city is the same for each vegetation density of a seed
+    dsm, _, _ = synthetic_dsm(96, seed=4)
+    walls = wa.findwalls(dsm, 2.0)
+    aspect = wa.filter1Goodwin_as_aspect_v3(walls.copy(), 1.0, dsm)
+    return walls, aspect * np.pi / 180.0
+
+
+@pytest.mark.parametrize("veg_density", [0.0, 0.3])
+@pytest.mark.parametrize("azimuth", [30.0, 135.0, 225.0, 300.0])
+def test_fused_kernel_matches_numpy(veg_density, azimuth):
+    dsm, vegdem, vegdem2 = synthetic_dsm(96, veg_density, seed=4)
+    walls, aspect = _walls()
+    amaxvalue = max(dsm.max(), vegdem.max())
+    bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    args = (dsm, vegdem, vegdem2, azimuth, 25.0, 1.0, amaxvalue, bush, walls, aspect)
+    numpy = shadowingfunction_wallheight_23(*args)
+    numba = shadowingfunction_wallheight_23(*args, "numba")
+    for fused, reference in zip(numba, numpy):
+        assert fused.dtype == reference.dtype
+        np.testing.assert_array_equal(fused, reference)
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.util import shadowingfunctions as shadow
+
+
+@pytest.mark.parametrize("azimuth", [0.0, 45.0, 100.0, 180.0, 270.0, 330.0])
+@pytest.mark.parametrize("altitude", [5.0, 30.0, 70.0])
+def test_globalradiation_numba_matches_numpy(azimuth, altitude):
+    dsm, _, _ = synthetic_dsm(96, seed=3)
+    numpy = shadow.shadowingfunctionglobalradiation(dsm, azimuth, altitude, 1.0, 1)
+    numba = shadow.shadowingfunctionglobalradiation(
+        dsm, azimuth, altitude, 1.0, 1, "numba"
+    )
+    assert numba.dtype == numpy.dtype
+    np.testing.assert_array_equal(numba, numpy)
+
+
+def test_unknown_backend():
+    dsm, _, _ = synthetic_dsm(32)
+    with pytest.raises(ValueError):
+        shadow.shadowingfunctionglobalradiation(dsm, 45.0, 30.0, 1.0, 1, "cuda")
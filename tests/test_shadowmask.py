@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.functions import svf_functions as svf
+from umep.util import shadowingfunctions as shadow
+from umep.util import shadowmask
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+@pytest.mark.parametrize("mask_format", ["bool", "packed"])
+def test_masks_decode_to_float_shadows(backend, mask_format):
+    # 77 columns, so that packed rows end on a partial byte
+    dsm, vegdem, vegdem2 = synthetic_dsm(77, 0.3, seed=8)
+    cols = dsm.shape[1]
+    amaxvalue = max(dsm.max(), vegdem.max())
+    bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    for azimuth, altitude in ((60.0, 15.0), (250.0, 35.0)):
+        sh = shadow.shadowingfunctionglobalradiation(
+            dsm, azimuth, altitude, 1.0, 1, backend
+        )
+        mask = shadow.shadowingfunctionglobalradiation(
+            dsm, azimuth, altitude, 1.0, 1, backend, mask_format=mask_format
+        )
+        np.testing.assert_array_equal(shadowmask.to_float(mask, cols), sh)
+        args = (dsm, vegdem, vegdem2, azimuth, altitude, 1.0, amaxvalue, bush, 1)
+        full = shadow.shadowingfunction_20(*args, backend)
+        masks = shadow.shadowingfunction_20(*args, backend, mask_format=mask_format)
+        for key in ("sh", "vegsh"):
+            np.testing.assert_array_equal(
+                shadowmask.to_float(masks[key], cols), full[key]
+            )
+        psi = 0.03
+        np.testing.assert_array_equal(
+            shadowmask.combine_veg(masks["sh"], masks["vegsh"], psi, cols),
+            shadowmask.combine_veg(full["sh"], full["vegsh"], psi, cols),
+        )
+
+
+def test_packed_mask_size():
+    grid = np.ones((5, 17))
+    packed = shadowmask.encode(grid, "packed")
+    assert packed.dtype == np.uint8
+    assert packed.shape == (5, shadowmask.packed_cols(17))
+    np.testing.assert_array_equal(shadowmask.unpack(packed, 17), grid != 0)
+
+
+def test_unknown_mask_format():
+    with pytest.raises(ValueError):
+        shadowmask.check_mask_format("int8")
+
+
+def test_patch_bits_round_trip():
+    rng = np.random.default_rng(3)
+    # 13 patches, so that the last byte of each pixel is partial
+    matrix = (rng.random((6, 9, 13)) > 0.5).astype(np.float32)
+    bits = shadowmask.pack_patches(matrix)
+    assert bits["bits"].shape == (6, 9, 2)
+    np.testing.assert_array_equal(shadowmask.unpack_patches(bits), matrix)
+    filled = shadowmask.empty_patches(6, 9, 13)
+    for idx in range(13):
+        np.testing.assert_array_equal(shadowmask.patch(bits, idx), matrix[:, :, idx])
+        grid = shadowmask.encode(matrix[:, :, idx], "packed")
+        shadowmask.set_patch(filled, idx, grid, 9)
+    np.testing.assert_array_equal(filled["bits"], bits["bits"])
+
+
+def test_svf_patch_bits_match_matrices():
+    dsm, vegdem, vegdem2 = synthetic_dsm(40, 0.3, seed=19)
+    canopy = np.where(vegdem > 0, vegdem - dsm, 0.0)
+    trunk = np.where(vegdem2 > 0, vegdem2 - dsm, 0.0)
+    args = (dsm, canopy, trunk, 1.0, 1, "numba")
+    matrices = svf.svfForProcessing153(*args)
+    bits = svf.svfForProcessing153(*args, patch_bits=True)
+    for name in ("shmat", "vegshmat", "vbshvegshmat"):
+        np.testing.assert_array_equal(
+            shadowmask.unpack_patches(bits[name]), matrices[name]
+        )
+    np.testing.assert_array_equal(bits["svf"], matrices["svf"])
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.functions import svf_functions as svf
+from umep.util import shadowmask, shadowstore
+
+
+def _canopy(size, seed):
+    # canopy and trunk zone heights above the ground, as read from CDSM rasters
+    dsm, vegdem, vegdem2 = synthetic_dsm(size, 0.3, seed)
+    canopy = np.where(vegdem > 0, vegdem - dsm, 0.0)
+    return dsm, canopy, np.where(vegdem2 > 0, vegdem2 - dsm, 0.0)
+
+
+@pytest.mark.parametrize("mask_format", ["float", "packed"])
+def test_store_matches_in_memory_matrices(mask_format, tmp_path):
+    # 43 columns, so that packed rows end on a partial byte
+    dsm, vegdem, vegdem2 = _canopy(43, seed=18)
+    kwargs = {"mask_format": mask_format}
+    memory = svf.svfForProcessing153(dsm, vegdem, vegdem2, 1.0, 1, "numba", **kwargs)
+    stored = svf.svfForProcessing153(
+        dsm, vegdem, vegdem2, 1.0, 1, "numba", shmat_dir=tmp_path, **kwargs
+    )
+    store = shadowstore.open_store(tmp_path)
+    cols = dsm.shape[1]
+    for name in shadowstore.MATRICES:
+        assert isinstance(stored[name], np.memmap)
+        np.testing.assert_array_equal(stored[name], memory[name])
+        np.testing.assert_array_equal(
+            shadowstore.read_patch(store, name, 20),
+            shadowmask.unpack(memory[name][:, :, 20], cols),
+        )
+        window = (5, 30, 3, 41)
+        full = shadowmask.unpack(np.moveaxis(memory[name], -1, 0), cols)
+        np.testing.assert_array_equal(
+            shadowstore.read_window(store, name, window),
+            np.moveaxis(full[:, 5:30, 3:41], 0, -1),
+        )
+    for key in memory:
+        if not key.endswith("shmat"):
+            np.testing.assert_array_equal(stored[key], memory[key])
+
+
+def test_open_missing_store(tmp_path):
+    with pytest.raises(ValueError):
+        shadowstore.open_store(tmp_path)
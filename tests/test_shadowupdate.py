@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.util import shadowupdate
+
+AZIMUTHS = [20.0, 110.0, 190.0, 280.0]
+ALTITUDES = [15.0, 30.0, 45.0, 60.0]
+
+
+def _edit(dsm, vegdem, vegdem2):
+    # a new building, a lowered one and a felled tree, all below the highest
+    # obstruction so that the amaxvalue of the state is kept
+    dsm = dsm.copy()
+    dsm[50:58, 2:10] = 25.0
+    dsm[12:32, 12:32] -= 5.0
+    vegdem = vegdem.copy()
+    vegdem2 = vegdem2.copy()
+    tree = vegdem > 0
+    tree[:60] = False
+    tree[:, :60] = False
+    vegdem[tree] = 0.0
+    vegdem2[tree] = 0.0
+    return dsm, vegdem, vegdem2
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+@pytest.mark.parametrize("mask_format", ["float", "packed"])
+def test_update_matches_full_run(backend, mask_format):
+    dsm, vegdem, vegdem2 = synthetic_dsm(80, 0.3, seed=12)
+    kwargs = {"backend": backend, "mask_format": mask_format}
+    state = shadowupdate.shadow_state(
+        dsm, AZIMUTHS, ALTITUDES, 1.0, vegdem, vegdem2, **kwargs
+    )
+    edited = _edit(dsm, vegdem, vegdem2)
+    updated = shadowupdate.update_shadows(state, *edited)
+    full = shadowupdate.shadow_state(
+        edited[0], AZIMUTHS, ALTITUDES, 1.0, *edited[1:], **kwargs
+    )
+    assert updated["amaxvalue"] == full["amaxvalue"]
+    assert 0.0 < updated["recast_fraction"] < 1.0
+    for key, grid in full["shadows"].items():
+        np.testing.assert_array_equal(updated["shadows"][key], grid)
+
+
+def test_update_without_edits():
+    dsm, _, _ = synthetic_dsm(48, seed=13)
+    state = shadowupdate.shadow_state(dsm, AZIMUTHS, ALTITUDES, 1.0)
+    updated = shadowupdate.update_shadows(state, dsm)
+    assert updated["recast_fraction"] == 0.0
+    np.testing.assert_array_equal(updated["shadows"]["sh"], state["shadows"]["sh"])
+
+
+def test_update_above_amaxvalue_recasts_all():
+    dsm, _, _ = synthetic_dsm(48, seed=14)
+    state = shadowupdate.shadow_state(dsm, AZIMUTHS, ALTITUDES, 1.0)
+    dsm = dsm.copy()
+    dsm[5:8, 5:8] = dsm.max() + 10.0
+    updated = shadowupdate.update_shadows(state, dsm)
+    full = shadowupdate.shadow_state(dsm, AZIMUTHS, ALTITUDES, 1.0)
+    assert updated["recast_fraction"] == 1.0
+    np.testing.assert_array_equal(updated["shadows"]["sh"], full["shadows"]["sh"])
+
+
+def test_update_refuses_other_grids():
+    dsm, vegdem, vegdem2 = synthetic_dsm(48, 0.3, seed=15)
+    state = shadowupdate.shadow_state(dsm, AZIMUTHS, ALTITUDES, 1.0, vegdem, vegdem2)
+    with pytest.raises(ValueError):
+        shadowupdate.update_shadows(state, dsm)
+    with pytest.raises(ValueError):
+        shadowupdate.update_shadows(state, dsm[:40], vegdem[:40], vegdem2[:40])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from umep.util import shadowcache, sunlattice
+
+
+def test_snap_to_lattice_nodes():
+    azimuths, altitudes = sunlattice.snap(
+        [359.6, 12.6, 181.0], [0.4, 47.6, 89.9], (1.0, 2.0)
+    )
+    np.testing.assert_array_equal(azimuths, [0.0, 13.0, 181.0])
+    # altitudes stay at least one step above the horizon
+    np.testing.assert_array_equal(altitudes, [2.0, 48.0, 90.0])
+
+
+def test_lattice_nodes_are_cache_positions():
+    # snapped positions are whole multiples of the cache quantum
+    azimuths, altitudes = sunlattice.snap([33.3, 271.9], [12.2, 61.7], (0.5, 0.25))
+    for azimuth, altitude in zip(azimuths, altitudes):
+        qazimuth, qaltitude = shadowcache.quantise(azimuth, altitude)
+        assert qazimuth * shadowcache.CACHE_QUANTUM == pytest.approx(azimuth)
+        assert qaltitude * shadowcache.CACHE_QUANTUM == pytest.approx(altitude)
+
+
+def test_snap_report():
+    rng = np.random.default_rng(0)
+    azimuths = rng.uniform(0.0, 360.0, 500)
+    altitudes = rng.uniform(-10.0, 80.0, 500)
+    report = sunlattice.snap_report(azimuths, altitudes, (2.0, 2.0))
+    assert report["positions"] == int((altitudes > 0).sum())
+    assert report["unique_positions"] <= report["positions"]
+    # half an azimuth step, and up to a whole altitude step for the low sun
+    # positions lifted onto the first lattice row
+    assert report["max_error"] <= np.hypot(1.0, 2.0)
+    assert 0.0 < report["mean_error"] <= report["max_error"]
+    text = sunlattice.format_report(report)
+    assert f"{report['positions']} positions" in text
+    assert f"{report['unique_positions']} nodes" in text
+
+
+def test_check_lattice():
+    with pytest.raises(ValueError):
+        sunlattice.check_lattice((1.0, 0.0))
+    with pytest.raises(ValueError):
+        sunlattice.check_lattice((1.0,))
@@ -0,0 +1,192 @@
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.functions import svf_functions as svf
+from umep.util.SEBESOLWEIGCommonFiles.create_patches import create_patches
+
+
+def _blocks(seed=0, shape=(120, 110)):
+    rng = np.random.default_rng(seed)
+    a = np.zeros(shape, dtype=np.float32)
+    for _ in range(20):
+        x = rng.integers(0, shape[0] - 10)
+        y = rng.integers(0, shape[1] - 10)
+        height = rng.integers(5, 30)
+        a[x : x + rng.integers(5, 20), y : y + rng.integers(5, 20)] = height
+    return a
+
+
+def _canopy(size, seed):
+    # canopy and trunk zone heights above the ground, as read from CDSM rasters
+    dsm, vegdem, vegdem2 = synthetic_dsm(size, 0.3, seed)
+    canopy = np.where(vegdem > 0, vegdem - dsm, 0.0)
+    return dsm, canopy, np.where(vegdem2 > 0, vegdem2 - dsm, 0.0)
+
+
+def _assert_same_svfs(result, reference):
+    assert result.keys() == reference.keys()
+    for key, grid in reference.items():
+        if not key.endswith("shmat"):
+            np.testing.assert_array_equal(result[key], grid)
+
+
+def test_process_pool_matches_in_process():
+    dsm, vegdem, vegdem2 = _canopy(48, seed=17)
+    local = svf.svfForProcessing153(dsm, vegdem, vegdem2, 1.0, 1, "numba")
+    pooled = svf.svfForProcessing153(dsm, vegdem, vegdem2, 1.0, 1, "numba", processes=2)
+    _assert_same_svfs(pooled, local)
+    for key in ("shmat", "vegshmat", "vbshvegshmat"):
+        np.testing.assert_array_equal(pooled[key], local[key])
+
+
+def test_patch_weights_match_annulus_sums():
+    # the sums over the annuli of each patch, as accumulated patch by patch before
+    _, skyvaultazi, annulino, _, aziinterval, _, _ = create_patches(2)
+    patchband = np.repeat(np.arange(aziinterval.shape[0]), aziinterval)
+    iazimuth = np.where(skyvaultazi > 360.0, skyvaultazi - 360.0, skyvaultazi)
+    weights = svf.patch_weights(iazimuth, patchband, annulino, aziinterval)
+    for index, (band, azimuth) in enumerate(zip(patchband, iazimuth)):
+        annuli = np.arange(annulino[band] + 1, annulino[band + 1] + 1)
+        weight = sum(svf.annulus_weight(k, aziinterval[band]) for k in annuli)
+        aniso = sum(
+            svf.annulus_weight(k, np.ceil(aziinterval[band] / 2.0)) for k in annuli
+        )
+        sides = (
+            0 <= azimuth < 180,
+            90 <= azimuth < 270,
+            180 <= azimuth < 360,
+            azimuth >= 270 or azimuth < 90,
+        )
+        expected = [weight] + [aniso if side else 0.0 for side in sides]
+        np.testing.assert_allclose(weights[index], expected, rtol=1e-12)
+
+
+def test_open_sky():
+    zeros = np.zeros((24, 24), dtype=np.float32)
+    result = svf.svfForProcessing153(zeros, zeros, zeros, 1.0, 0)
+    np.testing.assert_allclose(result["svf"], 1.0, atol=1e-3)
+
+
+@pytest.mark.parametrize("usevegdem", [0, 1])
+def test_svfs_without_shadow_matrices(usevegdem):
+    dsm, vegdem, vegdem2 = _canopy(40, seed=20)
+    args = (dsm, vegdem, vegdem2, 1.0, usevegdem, "numba")
+    kept = svf.svfForProcessing153(*args)
+    dropped = svf.svfForProcessing153(*args, keep_shmat=False)
+    _assert_same_svfs(dropped, kept)
+    for key in ("shmat", "vegshmat", "vbshvegshmat"):
+        assert dropped[key] is None
+
+
+@pytest.mark.parametrize("engine", ["patches", "horizons"])
+@pytest.mark.parametrize("usevegdem", [0, 1])
+def test_svfs_are_float32(engine, usevegdem):
+    dsm, vegdem, vegdem2 = _canopy(32, seed=5)
+    args = (dsm, vegdem, vegdem2, 1.0, usevegdem)
+    if engine == "patches":
+        result = svf.svfForProcessing153(*args, keep_shmat=False)
+    else:
+        result = svf.svf_from_horizons(*args, n_sectors=12)
+    for key, grid in result.items():
+        if not key.endswith("shmat"):
+            assert grid.dtype == np.float32, key
+
+
+def test_unkept_matrices_can_not_be_stored(tmp_path):
+    zeros = np.zeros((16, 16), dtype=np.float32)
+    with pytest.raises(ValueError):
+        svf.svfForProcessing153(
+            zeros, zeros, zeros, 1.0, 0, shmat_dir=tmp_path, keep_shmat=False
+        )
+
+
+def test_horizon_svfs_within_documented_tolerance():
+    a = _blocks()
+    zeros = np.zeros_like(a)
+    patches = svf.svfForProcessing153(a, zeros, zeros, 1.0, 0, "numba")
+    horizons = svf.svf_from_horizons(a, zeros, zeros, 1.0, 0)
+    assert np.abs(horizons["svf"] - patches["svf"]).mean() <= 0.009
+    for side in ("E", "S", "W", "N"):
+        diff = np.abs(horizons["svf" + side] - patches["svf" + side])
+        assert diff.mean() <= 0.015
+    for key in ("svfveg", "svfaveg", "svfEveg", "svfNaveg"):
+        np.testing.assert_array_equal(horizons[key], patches[key])
+
+
+def test_horizon_vegetation_svfs_within_documented_tolerance():
+    dsm, vegdem, vegdem2 = _canopy(96, seed=4)
+    patches = svf.svfForProcessing153(dsm, vegdem, vegdem2, 1.0, 1, "numba")
+    horizons = svf.svf_from_horizons(dsm, vegdem, vegdem2, 1.0, 1)
+    for kind in ("", "veg", "aveg"):
+        diff = np.abs(horizons["svf" + kind] - patches["svf" + kind])
+        assert diff.mean() <= 0.01
+        for side in ("E", "S", "W", "N"):
+            diff = np.abs(horizons["svf" + side + kind] - patches["svf" + side + kind])
+            assert diff.mean() <= 0.02
+    # the trunk zone is open below the canopy, without it trees are bushes
+    trunkless = svf.svf_from_horizons(dsm, vegdem, np.zeros_like(vegdem2), 1.0, 1)
+    assert horizons["svfveg"].mean() > trunkless["svfveg"].mean()
+
+
+class _Interrupted(Exception):
+    pass
+
+
+@pytest.mark.parametrize("usevegdem", [0, 1])
+@pytest.mark.parametrize("store", [False, True])
+def test_checkpoint_resumes_to_the_full_run(usevegdem, store, tmp_path, monkeypatch):
+    dsm, vegdem, vegdem2 = _canopy(40, seed=22)
+    args = (dsm, vegdem, vegdem2, 1.0, usevegdem, "numba")
+    full = svf.svfForProcessing153(*args)
+    checkpoint = tmp_path / "svf_checkpoint.npz"
+    accumulate = svf._accumulate
+    calls = []
+
+    def interrupted(*accumulate_args):
+        # stops the run part way through the patches
+        calls.append(None)
+        if len(calls) > 60:
+            raise _Interrupted
+        accumulate(*accumulate_args)
+
+    kwargs = {
+        "checkpoint": str(checkpoint),
+        "checkpoint_interval": 0.0,
+    }
+    if store:
+        kwargs["shmat_dir"] = str(tmp_path / "shadowmats")
+    else:
+        kwargs["keep_shmat"] = False
+    monkeypatch.setattr(svf, "_accumulate", interrupted)
+    with pytest.raises(_Interrupted):
+        svf.svfForProcessing153(*args, **kwargs)
+    monkeypatch.setattr(svf, "_accumulate", accumulate)
+    assert checkpoint.is_file()
+    resumed = svf.svfForProcessing153(*args, **kwargs)
+    assert not checkpoint.is_file()
+    _assert_same_svfs(resumed, full)
+    if store:
+        for key in ("shmat", "vegshmat", "vbshvegshmat"):
+            np.testing.assert_array_equal(resumed[key], full[key])
+
+
+def test_checkpoint_of_another_run(tmp_path):
+    dsm, vegdem, vegdem2 = _canopy(24, seed=23)
+    checkpoint = tmp_path / "svf_checkpoint.npz"
+    svf._save_checkpoint(str(checkpoint), "another site", 10, {})
+    with pytest.raises(ValueError):
+        svf.svfForProcessing153(
+            dsm,
+            vegdem,
+            vegdem2,
+            1.0,
+            0,
+            keep_shmat=False,
+            checkpoint=str(checkpoint),
+        )
+    # in-memory shadow matrices would be saved in full
+    with pytest.raises(ValueError):
+        svf.svfForProcessing153(
+            dsm, vegdem, vegdem2, 1.0, 0, checkpoint=str(checkpoint)
+        )
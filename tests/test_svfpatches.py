@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.functions import svf_functions as svf
+from umep.util import svfpatches
+
+
+@pytest.mark.parametrize("patch_option", list(svf.PATCH_OPTIONS))
+def test_patch_options(patch_option):
+    zeros = np.zeros((16, 16), dtype=np.float32)
+    result = svf.svfForProcessing153(
+        zeros, zeros, zeros, 1.0, 0, patch_option=patch_option
+    )
+    assert result["shmat"].shape[-1] == svf.PATCH_OPTIONS[patch_option]
+    # open sky, within the rounding of the coarsest annuli
+    np.testing.assert_allclose(result["svf"], 1.0, atol=0.01)
+
+
+def test_unknown_patch_option():
+    with pytest.raises(ValueError):
+        svf.check_patch_option(6)
+
+
+def test_patch_report():
+    dsm, _, _ = synthetic_dsm(32, seed=21)
+    report = svfpatches.patch_report(dsm, 1.0, options=(5, 4), backend="numba")
+    assert report["reference_patches"] == 609
+    coarse, reference = report["options"]
+    assert coarse["patches"] == 79
+    for grid in svfpatches.GRIDS:
+        assert reference[grid]["max_error"] == 0.0
+        assert 0.0 < coarse[grid]["mean_error"] <= coarse[grid]["max_error"]
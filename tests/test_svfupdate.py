@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from umep.functions import svf_functions as svf
+from umep.util import svfupdate
+
+
+def _low_city(size=160, seed=24):
+    # flat ground with low buildings, so that edits are only seen from nearby
+    rng = np.random.default_rng(seed)
+    dsm = np.zeros((size, size), dtype=np.float32)
+    for _ in range(30):
+        x, y = rng.integers(0, size - 8, 2)
+        dsm[x : x + rng.integers(3, 8), y : y + rng.integers(3, 8)] = 1.0 + rng.random()
+    dsm[0, 0] = 4.0
+    return dsm
+
+
+@pytest.mark.parametrize("mask_format", ["float", "packed"])
+@pytest.mark.parametrize("edit", ["add", "remove"])
+def test_update_matches_full_run(mask_format, edit):
+    dsm = _low_city()
+    zeros = np.zeros_like(dsm)
+    kwargs = {"backend": "numba", "mask_format": mask_format}
+    before = svf.svfForProcessing153(
+        dsm, zeros, zeros, 1.0, 0, show_progress=False, **kwargs
+    )
+    edited = dsm.copy()
+    if edit == "add":
+        edited[70:76, 80:84] = 2.5
+        edit_height = 2.5
+    else:
+        # removed obstructions are bounded by the amaxvalue march
+        edited[edited > 0.0] = 0.0
+        edited[0, 0] = 4.0
+        edited[:, :100] = dsm[:, :100]
+        edit_height = None
+    edit_mask = edited != dsm
+    updated = svfupdate.update_svf(
+        before, edited, zeros, zeros, 1.0, 0, edit_mask, edit_height, "numba"
+    )
+    full = svf.svfForProcessing153(
+        edited, zeros, zeros, 1.0, 0, show_progress=False, **kwargs
+    )
+    if edit == "add":
+        assert updated["recast_fraction"] < 1.0
+    for name in svfupdate.SVF_NAMES[:5] + svfupdate.MATRIX_NAMES:
+        np.testing.assert_array_equal(updated[name], full[name])
+
+
+def test_update_without_edits():
+    dsm = _low_city(48)
+    zeros = np.zeros_like(dsm)
+    before = svf.svfForProcessing153(dsm, zeros, zeros, 1.0, 0, show_progress=False)
+    updated = svfupdate.update_svf(
+        before, dsm, zeros, zeros, 1.0, 0, np.zeros(dsm.shape, dtype=bool)
+    )
+    assert updated["window"] is None
+    assert updated["recast_fraction"] == 0.0
+
+
+def test_update_refuses_bit_packed_matrices():
+    dsm = _low_city(48)
+    zeros = np.zeros_like(dsm)
+    before = svf.svfForProcessing153(
+        dsm, zeros, zeros, 1.0, 0, patch_bits=True, show_progress=False
+    )
+    with pytest.raises(TypeError):
+        svfupdate.update_svf(before, dsm, zeros, zeros, 1.0, 0, dsm > 0)
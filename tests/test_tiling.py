@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from helpers import synthetic_dsm
+
+from umep.functions import svf_functions as svf
+from umep.util import shadowbatch, tiling
+
+AZIMUTHS = [30.0, 120.0, 200.0, 300.0]
+ALTITUDES = [20.0, 35.0, 50.0, 25.0]
+
+
+def _canopy(size, seed):
+    # canopy and trunk zone heights above the ground, as read from CDSM rasters
+    dsm, vegdem, vegdem2 = synthetic_dsm(size, 0.3, seed)
+    canopy = np.where(vegdem > 0, vegdem - dsm, 0.0)
+    return dsm, canopy, np.where(vegdem2 > 0, vegdem2 - dsm, 0.0)
+
+
+def test_halo_aligned():
+    halo = tiling.halo_size(30.0, 40.0, 1.0, 20.0)
+    assert halo % tiling.TILE_ALIGN == 0
+    assert halo >= 30.0 / np.tan(np.radians(20.0))
+    with pytest.raises(ValueError):
+        tiling.halo_size(30.0, 40.0, 1.0, 0.0)
+
+
+@pytest.mark.parametrize("mask_format", ["float", "packed"])
+def test_tiled_shadows_match_untiled(mask_format):
+    dsm, vegdem, vegdem2 = synthetic_dsm(100, 0.3, seed=9)
+    kwargs = {"backend": "numba", "mask_format": mask_format}
+    untiled = dict(
+        shadowbatch.iter_shadows(
+            dsm, AZIMUTHS, ALTITUDES, 1.0, vegdem, vegdem2, **kwargs
+        )
+    )
+    tiled = dict(
+        tiling.iter_shadows_tiled(
+            dsm,
+            AZIMUTHS,
+            ALTITUDES,
+            1.0,
+            vegdem,
+            vegdem2,
+            workers=2,
+            tile_size=40,
+            **kwargs,
+        )
+    )
+    assert tiled.keys() == untiled.keys()
+    for idx, grids in untiled.items():
+        for key, grid in grids.items():
+            np.testing.assert_array_equal(tiled[idx][key], grid)
+
+
+@pytest.mark.parametrize("usevegdem", [0, 1])
+def test_tiled_svf_matches_untiled(usevegdem):
+    dsm, vegdem, vegdem2 = _canopy(72, seed=10)
+    untiled = svf.svfForProcessing153(dsm, vegdem, vegdem2, 1.0, usevegdem, "numba")
+    tiled = tiling.svf_tiled(
+        dsm, vegdem, vegdem2, 1.0, usevegdem, "numba", workers=2, tile_size=40
+    )
+    assert tiled.keys() == untiled.keys()
+    for key in untiled:
+        np.testing.assert_array_equal(tiled[key], untiled[key])
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from umep.functions import wallalgorithms as wa
+
+
+def _dsm(n, dtype, seed):
+    # flat ground with noise and a few blocks of buildings
+    rng = np.random.default_rng(seed)
+    a = np.full((n, n), 1.0)
+    for _ in range(6):
+        r, c = rng.integers(0, n - 8, 2)
+        h, w = rng.integers(3, 12, 2)
+        a[r : r + h, c : c + w] = rng.random() * 20.0 + 3.0
+    a += rng.random((n, n)) * 0.1
+    return a.astype(dtype)
+
+
+def _findwalls_loop(a, walllimit):
+    # the original pixel loop of findwalls
+    col = a.shape[0]
+    row = a.shape[1]
+    walls = np.zeros((col, row))
+    domain = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]])
+    for i in np.arange(1, row - 1):
+        for j in np.arange(1, col - 1):
+            dom = a[j - 1 : j + 2, i - 1 : i + 2]
+            walls[j, i] = np.max(dom[np.where(domain == 1)])
+
+    walls = np.copy(walls - a)
+    walls[(walls < walllimit)] = 0
+
+    walls[0 : walls.shape[0], 0] = 0
+    walls[0 : walls.shape[0], walls.shape[1] - 1] = 0
+    walls[0, 0 : walls.shape[0]] = 0
+    walls[walls.shape[0] - 1, 0 : walls.shape[1]] = 0
+
+    return walls
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("shape", [(40, 40), (37, 52), (52, 37), (2, 30), (30, 1)])
+@pytest.mark.parametrize("wall_limit", [0.0, 1.0, -0.05])
+def test_findwalls_matches_loop(dtype, shape, wall_limit):
+    rng = np.random.default_rng(2)
+    a = np.full(shape, 1.0) + rng.random(shape) * 0.1
+    a[: shape[0] // 2, : shape[1] // 3] += 12.0
+    a[rng.random(shape) < 0.02] = np.nan
+    a = a.astype(dtype)
+    for workers in (None, 3):
+        np.testing.assert_array_equal(
+            wa.findwalls(a, wall_limit, workers), _findwalls_loop(a, wall_limit)
+        )
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("scale", [0.5, 1.0, 2.0, 3.0])
+@pytest.mark.parametrize("wall_limit", [0.0, 1.0])
+def test_numba_aspect_matches_numpy(dtype, scale, wall_limit):
+    # scale 0.5 gives the 3 pixel filter, 1 the common 9 pixel one
+    a = _dsm(40, dtype, 0)
+    # DSM nodata leaves NaN walls
+    a[[5, 20, 33], [30, 12, 21]] = np.nan
+    walls = wa.findwalls(a, wall_limit)
+    numba = wa.filter1Goodwin_as_aspect_v3(walls.copy(), scale, a, "numba")
+    numpy = wa.filter1Goodwin_as_aspect_v3(walls.copy(), scale, a, "numpy")
+    np.testing.assert_array_equal(numba, numpy)
+
+
+def test_numba_aspect_falls_back_for_negative_walls():
+    a = _dsm(40, np.float64, 1)
+    walls = wa.findwalls(a, -0.05)
+    assert np.any(walls < 0)
+    numba = wa.filter1Goodwin_as_aspect_v3(walls.copy(), 2.0, a, "numba")
+    numpy = wa.filter1Goodwin_as_aspect_v3(walls.copy(), 2.0, a, "numpy")
+    np.testing.assert_array_equal(numba, numpy)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+@pytest.mark.parametrize(
+    "scale, expected",
+    [
+        # north and south walls take the first of the tied rotations along them
+        (0.5, (14.0, 194.0, 270.0, 90.0)),
+        (1.0, (7.0, 187.0, 270.0, 90.0)),
+    ],
+)
+def test_aspect_of_a_block(backend, scale, expected):
+    # walls around a single building, sampled in the middle of each side
+    a = np.full((40, 40), 1.0)
+    a[12:28, 10:30] = 15.0
+    walls = wa.findwalls(a, 0.0)
+    dirwalls = wa.filter1Goodwin_as_aspect_v3(walls, scale, a, backend)
+    north, south, west, east = expected
+    assert dirwalls[11, 20] == north
+    assert dirwalls[28, 20] == south
+    assert dirwalls[20, 9] == west
+    assert dirwalls[20, 30] == east
@@ -0,0 +1,5 @@
+def warmup(*args, **kwargs):
+    # Compiles the numba kernels ahead of use, see umep.util.compilation.warmup
+    from umep.util.compilation import warmup
+
+    return warmup(*args, **kwargs)
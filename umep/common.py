@@ -45,6 +45,19 @@ def save_raster(out_path, data, transform, crs):
         dst.write(data, 1)
 
 
+def _check_bbox(dataset_bounds, bbox):
+    # Confirm the bbox is within dataset bounds
+    if not (
+        dataset_bounds.left <= bbox[0] <= dataset_bounds.right
+        and dataset_bounds.left <= bbox[2] <= dataset_bounds.right
+        and dataset_bounds.bottom <= bbox[1] <= dataset_bounds.top
+        and dataset_bounds.bottom <= bbox[3] <= dataset_bounds.top
+    ):
+        raise ValueError(
+            "Bounding box is not fully contained within the raster dataset bounds"
+        )
+
+
 def load_raster(
     path: str,
     bbox: list[int] = None,
@@ -56,16 +69,7 @@ def load_raster(
         dataset_bounds = dataset.bounds
         if bbox is not None:
             bbox_geom = geometry.box(*bbox)
-            # Confirm the bbox is within dataset bounds
-            if not (
-                dataset_bounds.left <= bbox[0] <= dataset_bounds.right
-                and dataset_bounds.left <= bbox[2] <= dataset_bounds.right
-                and dataset_bounds.bottom <= bbox[1] <= dataset_bounds.top
-                and dataset_bounds.bottom <= bbox[3] <= dataset_bounds.top
-            ):
-                raise ValueError(
-                    "Bounding box is not fully contained within the raster dataset bounds"
-                )
+            _check_bbox(dataset_bounds, bbox)
             rast, transf = mask(dataset, [bbox_geom], crop=True)
         else:
             rast = dataset.read()
@@ -81,3 +85,67 @@ def load_raster(
             raise ValueError("Raster contains negative values")
 
     return rast, transf, crs
+
+
+def save_raster_bands(out_path, bands, transform, crs):
+    """
+    Save a dict of equally shaped rasters as one tiled, deflate compressed GeoTIFF,
+    the keys being the band descriptions read by load_raster_bands.
+    """
+    data = list(bands.values())
+    with rasterio.open(
+        out_path,
+        "w",
+        driver="GTiff",
+        height=data[0].shape[0],
+        width=data[0].shape[1],
+        count=len(data),
+        dtype=data[0].dtype,
+        crs=crs,
+        transform=transform,
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="deflate",
+        predictor=3 if data[0].dtype.kind == "f" else 2,
+    ) as dst:
+        for idx, (name, band) in enumerate(bands.items(), start=1):
+            dst.write(band, idx)
+            dst.set_band_description(idx, name)
+
+
+def load_raster_bands(
+    path: str,
+    names: list[str],
+    bbox: list[int] | None = None,
+):
+    """
+    Bands of a multi-band raster selected by description (see save_raster_bands),
+    returned as a dict of float rasters with the transform and crs. Only the named
+    bands are read, over the window of the bbox, with the checks of load_raster.
+    """
+    with rasterio.open(path) as dataset:
+        crs = dataset.crs
+        descriptions = list(dataset.descriptions)
+        missing = [name for name in names if name not in descriptions]
+        if missing:
+            raise ValueError(f"Bands {missing} not found in {path}")
+        indexes = [descriptions.index(name) + 1 for name in names]
+        if bbox is not None:
+            _check_bbox(dataset.bounds, bbox)
+            rast, transf = mask(
+                dataset, [geometry.box(*bbox)], crop=True, indexes=indexes
+            )
+        else:
+            rast = dataset.read(indexes)
+            transf = dataset.transform
+        rast = rast.astype(float)
+        # Handle NoData values
+        nd = dataset.nodata
+        if nd is not None:
+            rast[rast == nd] = 0.0
+        # Check for negative values in the raster
+        if rast.min() < 0:
+            raise ValueError("Raster contains negative values")
+
+    return dict(zip(names, rast)), transf, crs
@@ -4,6 +4,7 @@ import numpy as np
 
 from umep.functions.SOLWEIGpython import sunlit_shaded_patches
 from umep.functions.SOLWEIGpython.Kvikt_veg import Kvikt_veg
+from umep.util import shadowmask
 
 
 def Kside_veg_v2022a(
@@ -183,7 +184,9 @@ def Kside_veg_v2022a(
                 shaded_surface = (albedo * radD * 0.5) / np.pi
 
                 # Shortwave radiation reflected on vegetation - based on diffuse shortwave radiation
-                temp_vegsh = (vegshmat[:, :, idx] == 0) | (vbshvegshmat[:, :, idx] == 0)
+                temp_vegsh = (shadowmask.patch(vegshmat, idx) == 0) | (
+                    shadowmask.patch(vbshvegshmat, idx) == 0
+                )
                 Kref_veg += (
                     shaded_surface
                     * temp_vegsh
@@ -192,7 +195,9 @@ def Kside_veg_v2022a(
                 )
 
                 # Shortwave radiation reflected on buildings (shaded and sunlit) - based on global and diffuse shortwave radiation
-                temp_vbsh = (1 - shmat[:, :, idx]) * vbshvegshmat[:, :, idx]
+                temp_vbsh = (1 - shadowmask.patch(shmat, idx)) * (
+                    shadowmask.patch(vbshvegshmat, idx)
+                )
                 temp_sh = temp_vbsh == 1  # & (vbshvegshmat[:,:,idx] == 1)
 
                 sunlit_patches, shaded_patches = sunlit_shaded_patches.shaded_or_sunlit(
@@ -276,7 +281,9 @@ def Kside_veg_v2022a(
                 shaded_surface = (albedo * radD * 0.5) / np.pi
 
                 # Shortwave radiation reflected on vegetation - based on diffuse shortwave radiation
-                temp_vegsh = (vegshmat[:, :, idx] == 0) | (vbshvegshmat[:, :, idx] == 0)
+                temp_vegsh = (shadowmask.patch(vegshmat, idx) == 0) | (
+                    shadowmask.patch(vbshvegshmat, idx) == 0
+                )
                 Kref_veg += (
                     shaded_surface
                     * temp_vegsh
@@ -318,7 +325,9 @@ def Kside_veg_v2022a(
                     )
 
                 # Shortwave radiation reflected on buildings (shaded and sunlit) - based on global and diffuse shortwave radiation
-                temp_vbsh = (1 - shmat[:, :, idx]) * vbshvegshmat[:, :, idx]
+                temp_vbsh = (1 - shadowmask.patch(shmat, idx)) * (
+                    shadowmask.patch(vbshvegshmat, idx)
+                )
                 temp_sh = temp_vbsh == 1  # & (vbshvegshmat[:,:,idx] == 1)
                 azimuth_difference = np.abs(azimuth - patch_azimuth[idx])
 
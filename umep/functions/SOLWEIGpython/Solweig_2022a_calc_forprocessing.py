@@ -18,15 +18,10 @@ from umep.functions.SOLWEIGpython.Kup_veg_2015a import Kup_veg_2015a
 from umep.functions.SOLWEIGpython.Lcyl_v2022a import Lcyl_v2022a
 from umep.functions.SOLWEIGpython.Lside_veg_v2022a import Lside_veg_v2022a
 from umep.functions.SOLWEIGpython.TsWaveDelay_2015a import TsWaveDelay_2015a
+from umep.util import shadowbatch, shadowmask, sunlattice
 from umep.util.SEBESOLWEIGCommonFiles.clearnessindex_2013b import clearnessindex_2013b
 from umep.util.SEBESOLWEIGCommonFiles.create_patches import create_patches
 from umep.util.SEBESOLWEIGCommonFiles.Perez_v3 import Perez_v3
-from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_13 import (
-    shadowingfunction_wallheight_13,
-)
-from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_23 import (
-    shadowingfunction_wallheight_23,
-)
 
 
 def Solweig_2022a_calc(
@@ -114,6 +109,11 @@ def Solweig_2022a_calc(
     anisotropic_sky,
     asvf,
     patch_option,
+    backend="numpy",
+    mask_format="float",
+    shadow_cache=None,
+    sun_lattice=None,
+    shadow_state=None,
 ):
     # def Solweig_2021a_calc(i, dsm, scale, rows, cols, svf, svfN, svfW, svfE, svfS, svfveg, svfNveg, svfEveg, svfSveg,
     #                       svfWveg, svfaveg, svfEaveg, svfSaveg, svfWaveg, svfNaveg, vegdem, vegdem2, albedo_b, absK, absL,
@@ -181,6 +181,12 @@ def Solweig_2022a_calc(
     # CI = Clearness index
     # TgOut1 = old Ts model
     # diffsh, ani = Used in anisotrpic models (Wallenberg et al. 2019, 2022)
+    # backend = "numpy" or "numba" for the compiled shadow kernels
+    # mask_format = "float", "bool" or "packed" shadow masks from the shadow kernels
+    # shadow_cache = optional shadowcache.open_cache dict, shadows reused across runs
+    # sun_lattice = optional (azimuth, altitude) steps, shadows cast at the nearest node
+    # shadow_state = optional shadowbatch.prepare_shadows state of the grids above,
+    # prepared once for all timesteps
 
     # # # Core program start # # #
     # Instrument offset in degrees
@@ -243,27 +249,59 @@ def Solweig_2022a_calc(
             # lv, pc_, pb_ = Perez_v3(zenDeg, azimuth, radD, radI, jday, patchchoice, patch_option)   # Relative luminance
 
         # Shadow  images
+        shazimuth = azimuth
+        shaltitude = altitude
+        if sun_lattice is not None:
+            shazimuth, shaltitude = sunlattice.snap(azimuth, altitude, sun_lattice)
         if usevegdem == 1:
-            vegsh, sh, _, wallsh, wallsun, wallshve, _, facesun = (
-                shadowingfunction_wallheight_23(
+            _, shadows = next(
+                shadowbatch.iter_shadows(
                     dsm,
+                    shazimuth,
+                    shaltitude,
+                    scale,
                     vegdem,
                     vegdem2,
-                    azimuth,
-                    altitude,
-                    scale,
                     amaxvalue,
                     bush,
                     walls,
                     dirwalls * np.pi / 180.0,
+                    backend,
+                    1,
+                    mask_format,
+                    cache=shadow_cache,
+                    state=shadow_state,
                 )
             )
-            shadow = sh - (1 - vegsh) * (1 - psi)
+            vegsh = shadows["vegsh"]
+            sh = shadows["sh"]
+            wallsh = shadows["wallsh"]
+            wallsun = shadows["wallsun"]
+            wallshve = shadows["wallshve"]
+            facesun = shadows["facesun"]
+            shadow = shadowmask.combine_veg(sh, vegsh, psi, cols)
         else:
-            sh, wallsh, wallsun, facesh, facesun = shadowingfunction_wallheight_13(
-                dsm, azimuth, altitude, scale, walls, dirwalls * np.pi / 180.0
+            _, shadows = next(
+                shadowbatch.iter_shadows(
+                    dsm,
+                    shazimuth,
+                    shaltitude,
+                    scale,
+                    walls=walls,
+                    aspect=dirwalls * np.pi / 180.0,
+                    backend=backend,
+                    workers=1,
+                    mask_format=mask_format,
+                    cache=shadow_cache,
+                    state=shadow_state,
+                )
             )
-            shadow = sh
+            sh = shadows["sh"]
+            wallsh = shadows["wallsh"]
+            wallsun = shadows["wallsun"]
+            facesh = shadows["facesh"]
+            facesun = shadows["facesun"]
+            shadow = shadowmask.to_float(sh, cols)
 
         # # # Surface temperature parameterisation during daytime # # # #
         # new using max sun alt.instead of  dfm
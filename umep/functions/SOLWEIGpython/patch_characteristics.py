@@ -1,6 +1,7 @@
 import numpy as np
 
 from umep.functions.SOLWEIGpython import sunlit_shaded_patches
+from umep.util import shadowmask
 
 """ This function defines if a patch seen from a pixel is sky, building or vegetation. 
     It also calculates if a building patch is sunlit or shaded. From this it estimates 
@@ -56,7 +57,9 @@ def define_patch_characteristics(
     # Define patch characteristics (sky, vegetation or building, and sunlit or shaded if building)
     for idx in range(patch_altitude.shape[0]):
         # Calculations for patches on sky, shmat = 1 = sky is visible
-        temp_sky = (shmat[:, :, idx] == 1) & (vegshmat[:, :, idx] == 1)
+        temp_sky = (shadowmask.patch(shmat, idx) == 1) & (
+            shadowmask.patch(vegshmat, idx) == 1
+        )
 
         # Longwave radiation from sky to vertical surface
         Ldown_sky += temp_sky * Lsky_down[idx, 2]
@@ -65,7 +68,9 @@ def define_patch_characteristics(
         Lside_sky += temp_sky * Lsky_side[idx, 2]
 
         # Calculations for patches that are vegetation, vegshmat = 0 = shade from vegetation
-        temp_vegsh = (vegshmat[:, :, idx] == 0) | (vbshvegshmat[:, :, idx] == 0)
+        temp_vegsh = (shadowmask.patch(vegshmat, idx) == 0) | (
+            shadowmask.patch(vbshvegshmat, idx) == 0
+        )
         # Longwave radiation from vegetation surface (considered vertical)
         vegetation_surface = (ewall * SBC * ((Ta + 273.15) ** 4)) / np.pi
 
@@ -140,7 +145,9 @@ def define_patch_characteristics(
             )
 
         # Calculations for patches that are buildings, shmat = 0 = shade from buildings
-        temp_vbsh = (1 - shmat[:, :, idx]) * vbshvegshmat[:, :, idx]
+        temp_vbsh = (1 - shadowmask.patch(shmat, idx)) * (
+            shadowmask.patch(vbshvegshmat, idx)
+        )
         temp_sh = temp_vbsh == 1
         azimuth_difference = np.abs(solar_azimuth - patch_azimuth[idx])
 
@@ -321,9 +328,9 @@ def define_patch_characteristics(
     reflected_on_surfaces = ((Ldown_sky + Lup) * (1 - ewall) * 0.5) / np.pi
     for idx in range(patch_altitude.shape[0]):
         temp_sh = (
-            (shmat[:, :, idx] == 0)
-            | (vegshmat[:, :, idx] == 0)
-            | (vbshvegshmat[:, :, idx] == 0)
+            (shadowmask.patch(shmat, idx) == 0)
+            | (shadowmask.patch(vegshmat, idx) == 0)
+            | (shadowmask.patch(vbshvegshmat, idx) == 0)
         )
 
         # Reflected longwave radiation reaching vertical surfaces
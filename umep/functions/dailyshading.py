@@ -1,18 +1,19 @@
 import datetime as dt
 from builtins import range
+from functools import partial
+from pathlib import Path
 
 import numpy as np
 from tqdm import tqdm
 
 from umep import common
+from umep.util import horizon, shadowbatch, shadowcache, shadowmask, sunlattice, tiling
 from umep.util import shadowingfunctions as shadow
 from umep.util.SEBESOLWEIGCommonFiles import sun_position as sp
-from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_13 import (
-    shadowingfunction_wallheight_13,
-)
-from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_23 import (
-    shadowingfunction_wallheight_23,
-)
+
+# azimuth sectors of the horizon index and rays spanning each sector
+HORIZON_SECTORS = 72
+HORIZON_SUB_RAYS = 4
 
 
 def dailyshading(
@@ -37,7 +38,29 @@ def dailyshading(
     wallshadow,
     wheight,
     waspect,
+    backend="numpy",
+    workers=None,
+    horizon_index_path=None,
+    mask_format="float",
+    tile_size=None,
+    near_radius=None,
+    cache=None,
+    sun_lattice=None,
 ):
+    shadow.check_backend(backend)
+    shadowmask.check_mask_format(mask_format)
+    if sun_lattice is not None:
+        sunlattice.check_lattice(sun_lattice)
+    if horizon_index_path is not None and wallshadow == 1:
+        raise ValueError(
+            "The horizon index lookup does not support the facade shadow scheme."
+        )
+    if horizon_index_path is not None and tile_size is not None:
+        raise ValueError("The horizon index lookup does not support tiling.")
+    if horizon_index_path is not None and near_radius is not None:
+        raise ValueError(
+            "The horizon index lookup does not support the near field mode."
+        )
     # lon = lonlat[0]
     # lat = lonlat[1]
     year = tv[0]
@@ -62,6 +85,40 @@ def dailyshading(
         # Bush separation
         bush = np.logical_not((vegdem2 * vegdem)) * vegdem
 
+    # Horizon index, built once per site and reused for later runs of the same
+    # grids, rebuilt when the grids or scale changed
+    horizon_index = None
+    if horizon_index_path is not None:
+        site = shadowcache.site_key(
+            (
+                dsm,
+                vegdem if usevegdem == 1 else None,
+                vegdem2 if usevegdem == 1 else None,
+                bush if usevegdem == 1 else None,
+            ),
+            {
+                "scale": float(scale),
+                "n_sectors": HORIZON_SECTORS,
+                "sub_rays": HORIZON_SUB_RAYS,
+            },
+        )
+        if Path(horizon_index_path).exists():
+            horizon_index = horizon.load_horizon_index(horizon_index_path)
+            if str(horizon_index.get("site")) != site:
+                horizon_index = None
+        if horizon_index is None:
+            horizon_index = horizon.build_horizon_index(
+                dsm,
+                scale,
+                HORIZON_SECTORS,
+                vegdem=vegdem if usevegdem == 1 else None,
+                vegdem2=vegdem2 if usevegdem == 1 else None,
+                bush=bush if usevegdem == 1 else None,
+                sub_rays=HORIZON_SUB_RAYS,
+            )
+            horizon_index["site"] = np.array(site)
+            horizon.save_horizon_index(horizon_index_path, horizon_index)
+
     shtot = np.zeros((dsm_height, dsm_width))
 
     if onetime == 1:
@@ -83,7 +140,9 @@ def dailyshading(
         walls = np.zeros((dsm_height, dsm_width))
         dirwalls = np.zeros((dsm_height, dsm_width))
 
-    for i in tqdm(range(0, itera)):
+    # sun positions for all time steps
+    timestrs = []
+    for i in range(0, itera):
         if onetime == 0:
             minu = int(timeInterval * i)
             if minu >= 60:
@@ -135,83 +194,87 @@ def dailyshading(
             year, month, day, time["hour"], time["min"], time["sec"]
         )
         timestr = time_vector.strftime("%Y%m%d_%H%M")
-        if alt[i] > 0:
-            if wallshadow == 1:  # Include wall shadows (Issue #121)
-                if usevegdem == 1:
-                    vegsh, sh, _, wallsh, _, wallshve, _, _ = (
-                        shadowingfunction_wallheight_23(
-                            dsm,
-                            vegdem,
-                            vegdem2,
-                            azi[i],
-                            alt[i],
-                            scale,
-                            amaxvalue,
-                            bush,
-                            walls,
-                            dirwalls * np.pi / 180.0,
-                        )
-                    )
-                    # create output folders
-                    sh = sh - (1 - vegsh) * (1 - psi)
-                    if onetime == 0:
-                        filenamewallshve = (
-                            folder
-                            + "/facade_shdw_veg/facade_shdw_veg_"
-                            + timestr
-                            + "_LST.tif"
-                        )
-                        common.save_raster(
-                            filenamewallshve, wallshve, dsm_transf, dsm_crs
-                        )
-                else:
-                    sh, wallsh, _, _, _ = shadowingfunction_wallheight_13(
-                        dsm, azi[i], alt[i], scale, walls, dirwalls * np.pi / 180.0
-                    )
-                    # shtot = shtot + sh
-
+        timestrs.append(timestr)
+
+    # Casting shadows for all daytime steps in one batch
+    daysteps = np.where(alt > 0)[0]
+    shazi = azi[daysteps]
+    shalt = alt[daysteps]
+    if sun_lattice is not None:
+        # shadows are cast for the nearest lattice node
+        shazi, shalt = sunlattice.snap(shazi, shalt, sun_lattice)
+    if horizon_index is not None:
+        shadows = horizon.iter_horizon_shadows(horizon_index, shazi, shalt, mask_format)
+    else:
+        # tiles are cast in worker processes, otherwise the whole grid at once
+        if tile_size is not None:
+            iter_shadows = partial(tiling.iter_shadows_tiled, tile_size=tile_size)
+        else:
+            iter_shadows = shadowbatch.iter_shadows
+        shadows = iter_shadows(
+            dsm,
+            shazi,
+            shalt,
+            scale,
+            vegdem=vegdem if usevegdem == 1 else None,
+            vegdem2=vegdem2 if usevegdem == 1 else None,
+            amaxvalue=amaxvalue if usevegdem == 1 else None,
+            bush=bush if usevegdem == 1 else None,
+            walls=walls if wallshadow == 1 else None,
+            aspect=dirwalls * np.pi / 180.0 if wallshadow == 1 else None,
+            backend=backend,
+            workers=workers,
+            mask_format=mask_format,
+            near_radius=near_radius,
+            cache=cache,
+        )
+    for idx, shadowresult in tqdm(shadows, total=daysteps.shape[0]):
+        timestr = timestrs[daysteps[idx]]
+        sh = shadowmask.unpack(shadowresult["sh"], dsm_width)
+        if wallshadow == 1:  # Include wall shadows (Issue #121)
+            wallsh = shadowresult["wallsh"]
+            if usevegdem == 1:
+                vegsh = shadowresult["vegsh"]
+                wallshve = shadowresult["wallshve"]
+                # create output folders
+                sh = shadowmask.combine_veg(sh, vegsh, psi, dsm_width)
                 if onetime == 0:
-                    filename = (
-                        folder + "/shadow_ground/shadow_ground_" + timestr + "_LST.tif"
-                    )
-                    common.save_raster(filename, sh, dsm_transf, dsm_crs)
-                    filenamewallsh = (
+                    filenamewallshve = (
                         folder
-                        + "/facade_shdw_bldgs/facade_shdw_bldgs_"
+                        + "/facade_shdw_veg/facade_shdw_veg_"
                         + timestr
                         + "_LST.tif"
                     )
-                    common.save_raster(filenamewallsh, wallsh, dsm_transf, dsm_crs)
+                    common.save_raster(filenamewallshve, wallshve, dsm_transf, dsm_crs)
 
-            else:
-                if usevegdem == 0:
-                    sh = shadow.shadowingfunctionglobalradiation(
-                        dsm, azi[i], alt[i], scale, 0
-                    )
-                    # shtot = shtot + sh
-                else:
-                    shadowresult = shadow.shadowingfunction_20(
-                        dsm,
-                        vegdem,
-                        vegdem2,
-                        azi[i],
-                        alt[i],
-                        scale,
-                        amaxvalue,
-                        bush,
-                        0,
-                    )
-                    vegsh = shadowresult["vegsh"]
-                    sh = shadowresult["sh"]
-                    sh = sh - (1 - vegsh) * (1 - psi)
-                    # vegshtot = vegshtot + sh
+            if onetime == 0:
+                filename = (
+                    folder + "/shadow_ground/shadow_ground_" + timestr + "_LST.tif"
+                )
+                common.save_raster(
+                    filename, shadowmask.to_float(sh, dsm_width), dsm_transf, dsm_crs
+                )
+                filenamewallsh = (
+                    folder
+                    + "/facade_shdw_bldgs/facade_shdw_bldgs_"
+                    + timestr
+                    + "_LST.tif"
+                )
+                common.save_raster(filenamewallsh, wallsh, dsm_transf, dsm_crs)
 
-                if onetime == 0:
-                    filename = folder + "/Shadow_" + timestr + "_LST.tif"
-                    common.save_raster(filename, sh, dsm_transf, dsm_crs)
+        else:
+            if usevegdem == 1:
+                vegsh = shadowresult["vegsh"]
+                sh = shadowmask.combine_veg(sh, vegsh, psi, dsm_width)
+
+            if onetime == 0:
+                filename = folder + "/Shadow_" + timestr + "_LST.tif"
+                common.save_raster(
+                    filename, shadowmask.to_float(sh, dsm_width), dsm_transf, dsm_crs
+                )
 
-            shtot = shtot + sh
-            index += 1
+        shtot += sh  # bool masks are accumulated without a float copy
+        index += 1
 
     shfinal = shtot / index
 
@@ -228,6 +291,8 @@ def dailyshading(
                 common.save_raster(filenamewallshve, wallshve, dsm_transf, dsm_crs)
 
     shadowresult = {"shfinal": shfinal, "time_vector": time_vector}
+    if sun_lattice is not None:
+        shadowresult["sun_lattice"] = sunlattice.snap_report(azi, alt, sun_lattice)
 
     return shadowresult
 
@@ -3,31 +3,49 @@ from builtins import range
 # -*- coding: utf-8 -*-
 __author__ = "xlinfr"
 
+import itertools
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy.ndimage.interpolation as sc
+from numba import njit, prange
 from tqdm import tqdm
 
+from umep.util import shadowingfunctions as shadow
 
-def findwalls(a, walllimit):
+
+def _neighbour_max(a, walls, r0, r1):
+    # numpy releases the GIL, bands of rows are filled in parallel threads
+    out = walls[r0:r1, 1:-1]
+    np.maximum(a[r0 - 1 : r1 - 1, 1:-1], a[r0 + 1 : r1 + 1, 1:-1], out=out)
+    np.maximum(out, a[r0:r1, :-2], out=out)
+    np.maximum(out, a[r0:r1, 2:], out=out)
+
+
+def findwalls(a, walllimit, workers=None):
     # This function identifies walls based on a DSM and a wall-height limit
     # Walls are represented by outer pixels within building footprints
     #
     # Fredrik Lindberg, Goteborg Urban Climate Group
     # fredrikl@gvc.gu.se
     # 20150625
+    #
+    # workers = threads over bands of rows, all cores if None
 
     col = a.shape[0]
     row = a.shape[1]
     walls = np.zeros((col, row))
-    domain = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]])
-    index = 0
-    for i in tqdm(np.arange(1, row - 1)):
-        for j in np.arange(1, col - 1):
-            dom = a[j - 1 : j + 2, i - 1 : i + 2]
-            walls[j, i] = np.max(dom[np.where(domain == 1)])  # new 20171006
-            index = index + 1
+    # highest of the four neighbours (cross-shaped max filter, the pixel itself
+    # excluded), filled by bands of rows as the neighbours are read from a
+    if col > 2 and row > 2:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        bands = np.linspace(1, col - 1, min(workers, col - 2) + 1).astype(int)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            bounds = itertools.pairwise(bands)
+            list(pool.map(lambda b: _neighbour_max(a, walls, *b), bounds))
 
     walls = np.copy(walls - a)  # new 20171006
     walls[(walls < walllimit)] = 0
@@ -40,25 +58,15 @@ def findwalls(a, walllimit):
     return walls
 
 
-def filter1Goodwin_as_aspect_v3(walls, scale, a):
+def goodwin_kernels(scale):
     """
-    tThis function applies the filter processing presented in Goodwin et al (2010) but instead for removing
-    linear fetures it calculates wall aspect based on a wall pixels grid, a dsm (a) and a scale factor
+    Rotated filters of filter1Goodwin_as_aspect_v3, computed once for the 180 one
+    degree rotations.
 
-    Fredrik Lindberg, 2012-02-14
-    fredrikl@gvc.gu.se
-
-    Translated: 2015-09-15
-
-    :param walls:
-    :param scale:
-    :param a:
-    :return: dirwalls
+    Returns the filter size and the (180, size, size) line filters, the building
+    side filters (1 and 2 on either side of the line) and the wall aspect of each
+    rotation.
     """
-
-    row = a.shape[0]
-    col = a.shape[1]
-
     filtersize = np.floor((scale + 0.0000000001) * 9)
     if filtersize <= 2:
         filtersize = 3
@@ -78,12 +86,10 @@ def filter1Goodwin_as_aspect_v3(walls, scale, a):
     buildfilt[filthalveceil - 1, 0:filthalvefloor] = 1
     buildfilt[filthalveceil - 1, filthalveceil : int(filtersize)] = 2
 
-    y = np.zeros((row, col))  # final direction
-    z = np.zeros((row, col))  # temporary direction
-    x = np.zeros((row, col))  # building side
-    walls[walls > 0] = 1
-
-    for h in tqdm(range(0, 180)):  # =0:1:180 #%increased resolution to 1 deg 20140911
+    filtmatrices = np.zeros((180, int(filtersize), int(filtersize)))
+    buildmatrices = np.zeros((180, int(filtersize), int(filtersize)))
+    indexes = np.zeros(180)
+    for h in range(180):  # =0:1:180 #%increased resolution to 1 deg 20140911
         filtmatrix1temp = sc.rotate(
             filtmatrix, h, order=1, reshape=False, mode="nearest"
         )  # bilinear
@@ -109,35 +115,149 @@ def filter1Goodwin_as_aspect_v3(walls, scale, a):
             # n = filtmatrix.shape[0] - 1  # length(filtmatrix);
             filtmatrix1[0, n] = 1
             filtmatrix1[n, 0] = 1
+        filtmatrices[h] = filtmatrix1
+        buildmatrices[h] = filtmatrixbuild
+        indexes[h] = index
+
+    return int(filtersize), filtmatrices, buildmatrices, indexes
+
+
+@njit(parallel=True, cache=True)
+def filter1Goodwin_numba(walls, filtmatrices, lo, rowhi, colhi, best):
+    # Compiled equivalent of the filter response loop of filter1Goodwin_as_aspect_v3
+    # for walls of 0, 1 or NaN, where the response is the count of wall pixels on
+    # the line. Rows are processed in parallel and every wall pixel keeps in best
+    # the first rotation of highest response, as the strict update of the loop
+    nrot = filtmatrices.shape[0]
+    size = filtmatrices.shape[1]
+    half = size // 2
+    # line pixels of each rotation
+    nline = np.zeros(nrot, dtype=np.int64)
+    lineu = np.zeros((nrot, size * size), dtype=np.int64)
+    linev = np.zeros((nrot, size * size), dtype=np.int64)
+    for h in range(nrot):
+        for u in range(size):
+            for v in range(size):
+                if filtmatrices[h, u, v] == 1:
+                    lineu[h, nline[h]] = u
+                    linev[h, nline[h]] = v
+                    nline[h] += 1
+    for i in prange(lo, rowhi):
+        for j in range(lo, colhi):
+            if walls[i, j] != 1:
+                continue
+            # a NaN in the window makes every response NaN, never above z
+            window = walls[i - half : i + half + 1, j - half : j + half + 1]
+            if np.isnan(window).any():
+                continue
+            z = 0
+            for h in range(nrot):
+                response = 0
+                for k in range(nline[h]):
+                    if walls[i - half + lineu[h, k], j - half + linev[h, k]] == 1:
+                        response += 1
+                if z < response:
+                    z = response
+                    best[i, j] = h
+
+
+def _building_sides(a, best, buildmatrices, indexes, half, y, x):
+    # Building side of the wall pixels from their best rotation, with the DSM
+    # sums of either side taken by numpy as in the loop of the numpy backend
+    wi, wj = np.nonzero(best >= 0)
+    rotations = best[wi, wj]
+    order = np.argsort(rotations, kind="stable")
+    wi, wj, rotations = wi[order], wj[order], rotations[order]
+    hs, starts = np.unique(rotations, return_index=True)
+    groups = zip(hs, np.split(wi, starts[1:]), np.split(wj, starts[1:]))
+    for h, rows, cols in groups:
+        # window offsets of either side, in row-major order as dsmcut[mask]
+        u1, v1 = np.nonzero(buildmatrices[h] == 1)
+        u2, v2 = np.nonzero(buildmatrices[h] == 2)
+        side1 = a[rows[:, None] - half + u1, cols[:, None] - half + v1].sum(axis=1)
+        side2 = a[rows[:, None] - half + u2, cols[:, None] - half + v2].sum(axis=1)
+        x[rows, cols] = np.where(side1 > side2, 1, 2)
+        y[rows, cols] = indexes[h]
+
+
+def filter1Goodwin_as_aspect_v3(walls, scale, a, backend="numpy"):
+    """
+    tThis function applies the filter processing presented in Goodwin et al (2010) but instead for removing
+    linear fetures it calculates wall aspect based on a wall pixels grid, a dsm (a) and a scale factor
+
+    Fredrik Lindberg, 2012-02-14
+    fredrikl@gvc.gu.se
+
+    Translated: 2015-09-15
+
+    :param walls:
+    :param scale:
+    :param a:
+    :param backend: "numpy" or "numba" (compiled, parallel over rows), numba falls
+        back to numpy for walls below zero (negative wall limits)
+    :return: dirwalls
+    """
+    shadow.check_backend(backend)
 
-        for i in range(
-            int(filthalveceil) - 1, row - int(filthalveceil) - 1
-        ):  # i=filthalveceil:sizey-filthalveceil
-            for j in range(
-                int(filthalveceil) - 1, col - int(filthalveceil) - 1
-            ):  # (j=filthalveceil:sizex-filthalveceil
-                if walls[i, j] == 1:
-                    wallscut = (
-                        walls[
+    row = a.shape[0]
+    col = a.shape[1]
+
+    filtersize, filtmatrices, buildmatrices, indexes = goodwin_kernels(scale)
+    filthalveceil = int(np.ceil(filtersize / 2.0))
+    filthalvefloor = int(np.floor(filtersize / 2.0))
+
+    y = np.zeros((row, col))  # final direction
+    z = np.zeros((row, col))  # temporary direction
+    x = np.zeros((row, col))  # building side
+    walls[walls > 0] = 1
+
+    # walls below zero are left by negative wall limits, NaN by DSM nodata. The
+    # kernel counts wall pixels, other values are weighted by the numpy loop
+    if backend == "numba" and np.all((walls == 0) | (walls == 1) | np.isnan(walls)):
+        best = np.full((row, col), -1, dtype=np.int64)
+        filter1Goodwin_numba(
+            walls,
+            filtmatrices,
+            filthalveceil - 1,
+            row - filthalveceil - 1,
+            col - filthalveceil - 1,
+            best,
+        )
+        _building_sides(a, best, buildmatrices, indexes, filthalvefloor, y, x)
+    else:
+        for h in tqdm(range(180)):
+            filtmatrix1 = filtmatrices[h]
+            filtmatrixbuild = buildmatrices[h]
+            index = indexes[h]
+
+            for i in range(
+                int(filthalveceil) - 1, row - int(filthalveceil) - 1
+            ):  # i=filthalveceil:sizey-filthalveceil
+                for j in range(
+                    int(filthalveceil) - 1, col - int(filthalveceil) - 1
+                ):  # (j=filthalveceil:sizex-filthalveceil
+                    if walls[i, j] == 1:
+                        wallscut = (
+                            walls[
+                                i - filthalvefloor : i + filthalvefloor + 1,
+                                j - filthalvefloor : j + filthalvefloor + 1,
+                            ]
+                            * filtmatrix1
+                        )
+                        dsmcut = a[
                             i - filthalvefloor : i + filthalvefloor + 1,
                             j - filthalvefloor : j + filthalvefloor + 1,
                         ]
-                        * filtmatrix1
-                    )
-                    dsmcut = a[
-                        i - filthalvefloor : i + filthalvefloor + 1,
-                        j - filthalvefloor : j + filthalvefloor + 1,
-                    ]
-                    if z[i, j] < wallscut.sum():  # sum(sum(wallscut))
-                        z[i, j] = wallscut.sum()  # sum(sum(wallscut));
-                        if np.sum(dsmcut[filtmatrixbuild == 1]) > np.sum(
-                            dsmcut[filtmatrixbuild == 2]
-                        ):
-                            x[i, j] = 1
-                        else:
-                            x[i, j] = 2
-
-                        y[i, j] = index
+                        if z[i, j] < wallscut.sum():  # sum(sum(wallscut))
+                            z[i, j] = wallscut.sum()  # sum(sum(wallscut));
+                            if np.sum(dsmcut[filtmatrixbuild == 1]) > np.sum(
+                                dsmcut[filtmatrixbuild == 2]
+                            ):
+                                x[i, j] = 1
+                            else:
+                                x[i, j] = 2
+
+                            y[i, j] = index
 
     y[(x == 1)] = y[(x == 1)] - 180
     y[(y < 0)] = y[(y < 0)] + 360
@@ -52,6 +52,7 @@ from rasterio.transform import xy
 
 from umep import common
 from umep.functions import dailyshading as dsh
+from umep.util import shadowcache, sunlattice
 
 
 def generate_shadows(
@@ -66,6 +67,15 @@ def generate_shadows(
     veg_dsm_path: str | None = None,
     trans_veg: float = 3,
     trunk_zone_ht_perc: float = 0.25,
+    shadow_backend: str = "numpy",
+    horizon_index_path: str | None = None,  # .npz - built on first use, reused
+    # while the DSM, CDSM and scale are unchanged
+    shadow_mask: str = "float",  # "float", "bool" or "packed" shadow masks
+    tile_size: int | None = None,  # pixels - tiles are processed in parallel
+    near_field_radius: float | None = None,  # m - cast exactly, coarser beyond
+    shadow_cache_dir: str | None = None,  # shadows reused across runs of a site
+    shadow_cache_size_mb: float = 1024,
+    sun_lattice: tuple[float, float] | None = None,  # degrees - azimuth, altitude
 ):
     dsm, dsm_transf, dsm_crs = common.load_raster(dsm_path, bbox)
     dsm_height, dsm_width = dsm.shape  # y rows by x cols
@@ -155,6 +165,10 @@ def generate_shadows(
     Path.mkdir(out_path / "facade_shdw_veg", parents=True, exist_ok=True)
     Path.mkdir(out_path / "shadow_ground", parents=True, exist_ok=True)
 
+    cache = None
+    if shadow_cache_dir is not None:
+        cache = shadowcache.open_cache(shadow_cache_dir, shadow_cache_size_mb * 2**20)
+
     shadowresult = dsh.dailyshading(
         dsm,
         veg_dsm,
@@ -177,7 +191,19 @@ def generate_shadows(
         wallsh,
         wh_rast,
         wa_rast,
+        shadow_backend,
+        horizon_index_path=horizon_index_path,
+        mask_format=shadow_mask,
+        tile_size=tile_size,
+        near_radius=near_field_radius,
+        cache=cache,
+        sun_lattice=sun_lattice,
     )
+    if sun_lattice is not None:
+        print(sunlattice.format_report(shadowresult["sun_lattice"]))
+        sunlattice.save_report(
+            out_path_str + "/sun_lattice.json", shadowresult["sun_lattice"]
+        )
 
     shfinal = shadowresult["shfinal"]
     common.save_raster(
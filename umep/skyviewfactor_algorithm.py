@@ -46,6 +46,7 @@ __revision__ = "$Format:%H$"
 
 # %%
 import os
+import tempfile
 import zipfile
 from pathlib import Path
 
@@ -53,6 +54,51 @@ import numpy as np
 
 from umep import common
 from umep.functions import svf_functions as svf
+from umep.util import shadowmask, shadowstore, svfupdate, tiling
+
+# bands of the SVF product, named as the rasters of the zip
+SVF_BANDS = ("svf", "svfE", "svfS", "svfW", "svfN")
+SVF_VEG_BANDS = (
+    "svfveg",
+    "svfEveg",
+    "svfSveg",
+    "svfWveg",
+    "svfNveg",
+    "svfaveg",
+    "svfEaveg",
+    "svfSaveg",
+    "svfWaveg",
+    "svfNaveg",
+)
+
+
+def _save_svfs(out_path_str, bands, svf_product, transf, crs, trans):
+    # SVF product and total SVF, with the vegetation bands when present
+    if svf_product == "tif":
+        # one tiled and compressed raster, read by band name without extraction
+        common.save_raster_bands(out_path_str + "/" + "svfs.tif", bands, transf, crs)
+    else:
+        # Create or update the ZIP file
+        zip_filepath = out_path_str + "/" + "svfs.zip"
+        if os.path.isfile(zip_filepath):
+            os.remove(zip_filepath)
+
+        with zipfile.ZipFile(zip_filepath, "a") as zippo:
+            for name, band in bands.items():
+                band_path = out_path_str + "/" + name + ".tif"
+                common.save_raster(band_path, band, transf, crs)
+                zippo.write(band_path, name + ".tif")
+                # Remove the individual TIFF files after zipping
+                os.remove(band_path)
+
+    if "svfveg" not in bands:
+        svftotal = bands["svf"]
+    else:
+        # Calculate final total SVF
+        svftotal = bands["svf"] - (1 - bands["svfveg"]) * (1 - trans)
+
+    # Save the final svftotal raster
+    common.save_raster(out_path_str + "/" + "svf_total.tif", svftotal, transf, crs)
 
 
 # %%
@@ -62,6 +108,20 @@ def generate_svf(
     out_dir: str,
     cdsm_path: str | None = None,
     trans_veg: float = 3,
+    shadow_backend: str = "numpy",
+    shadow_mask: str = "float",  # "float", "bool" or "packed" shadow matrices
+    tile_size: int | None = None,  # pixels - tiles are processed in parallel
+    processes: int | None = None,  # worker processes over the sky patches
+    shadow_mats: str = "npz",  # "npz", "bits" (npz packed along the patches),
+    # "store" (memory-mapped, see shadowstore) or "none" (not kept, for isotropic
+    # sky runs, memory then stays in O(rows * cols))
+    svf_product: str = "zip",  # "zip" of GeoTIFFs or "tif", one multi-band svfs.tif
+    patch_option: int = 2,  # sky patches: 5 = 79 (fast), 1 = 145, 2 = 153, 3 = 305,
+    # 4 = 609, see umep.util.svfpatches for the error and runtime of each
+    svf_engine: str = "shadows",  # "shadows" of sky patches or "horizons" profiles,
+    # see svf_functions.svf_from_horizons for the agreement of the two
+    checkpoint_minutes: float | None = None,  # saves progress to out_dir, a rerun
+    # after an interruption resumes from it (shadow_mats "store" or "none")
 ):
     out_path = Path(out_dir)
     out_path.mkdir(parents=True, exist_ok=True)
@@ -91,131 +151,206 @@ def generate_svf(
         if not dsm_transf == cdsm_transf:
             raise ValueError("Mismatching spatial transform for DSM and CDSM.")
 
+    if svf_engine not in ("shadows", "horizons"):
+        raise ValueError("svf_engine should be 'shadows' or 'horizons'.")
+    if svf_engine == "horizons" and (
+        shadow_mats != "none" or tile_size is not None or processes is not None
+    ):
+        raise ValueError(
+            "The horizons engine gives no shadow matrices and runs untiled, "
+            "set shadow_mats='none' and leave tile_size and processes."
+        )
+    if svf_engine == "horizons" and patch_option != 2:
+        raise ValueError("The horizons engine has no sky patches, leave patch_option.")
+    if checkpoint_minutes is not None and (
+        svf_engine != "shadows" or tile_size is not None
+    ):
+        raise ValueError("Checkpoints are only kept for untiled shadow SVF runs.")
+    if checkpoint_minutes is not None and shadow_mats not in ("store", "none"):
+        raise ValueError("Checkpointed runs need shadow_mats='store' or 'none'.")
+    if svf_product not in ("zip", "tif"):
+        raise ValueError("svf_product should be 'zip' or 'tif'.")
+    if shadow_mats not in ("npz", "bits", "store", "none"):
+        raise ValueError("shadow_mats should be 'npz', 'bits', 'store' or 'none'.")
+    # the store is written patch by patch while casting
+    shmat_dir = out_path_str + "/shadowmats" if shadow_mats == "store" else None
+    if tile_size is not None and processes is not None:
+        raise ValueError("Tiles are already processed in parallel, leave processes.")
+
     # CDSM 2
     cdsm_2_rast = np.zeros([rows, cols])
     # compute
-    ret = svf.svfForProcessing153(dsm_rast, cdsm_rast, cdsm_2_rast, dsm_scale, use_cdsm)
-
-    svfbu = ret["svf"]
-    svfbuE = ret["svfE"]
-    svfbuS = ret["svfS"]
-    svfbuW = ret["svfW"]
-    svfbuN = ret["svfN"]
-
-    # Save the rasters using rasterio
-    common.save_raster(out_path_str + "/" + "svf.tif", svfbu, dsm_transf, dsm_crs)
-    common.save_raster(out_path_str + "/" + "svfE.tif", svfbuE, dsm_transf, dsm_crs)
-    common.save_raster(out_path_str + "/" + "svfS.tif", svfbuS, dsm_transf, dsm_crs)
-    common.save_raster(out_path_str + "/" + "svfW.tif", svfbuW, dsm_transf, dsm_crs)
-    common.save_raster(out_path_str + "/" + "svfN.tif", svfbuN, dsm_transf, dsm_crs)
-
-    # Create or update the ZIP file
-    zip_filepath = out_path_str + "/" + "svfs.zip"
-    if os.path.isfile(zip_filepath):
-        os.remove(zip_filepath)
-
-    with zipfile.ZipFile(zip_filepath, "a") as zippo:
-        zippo.write(out_path_str + "/" + "svf.tif", "svf.tif")
-        zippo.write(out_path_str + "/" + "svfE.tif", "svfE.tif")
-        zippo.write(out_path_str + "/" + "svfS.tif", "svfS.tif")
-        zippo.write(out_path_str + "/" + "svfW.tif", "svfW.tif")
-        zippo.write(out_path_str + "/" + "svfN.tif", "svfN.tif")
-
-    # Remove the individual TIFF files after zipping
-    os.remove(out_path_str + "/" + "svf.tif")
-    os.remove(out_path_str + "/" + "svfE.tif")
-    os.remove(out_path_str + "/" + "svfS.tif")
-    os.remove(out_path_str + "/" + "svfW.tif")
-    os.remove(out_path_str + "/" + "svfN.tif")
-
-    if use_cdsm == 0:
-        svftotal = svfbu
-    else:
-        # Report the vegetation-related results
-        svfveg = ret["svfveg"]
-        svfEveg = ret["svfEveg"]
-        svfSveg = ret["svfSveg"]
-        svfWveg = ret["svfWveg"]
-        svfNveg = ret["svfNveg"]
-        svfaveg = ret["svfaveg"]
-        svfEaveg = ret["svfEaveg"]
-        svfSaveg = ret["svfSaveg"]
-        svfWaveg = ret["svfWaveg"]
-        svfNaveg = ret["svfNaveg"]
-
-        # Save vegetation rasters
-        common.save_raster(
-            out_path_str + "/" + "svfveg.tif", svfveg, dsm_transf, dsm_crs
-        )
-        common.save_raster(
-            out_path_str + "/" + "svfEveg.tif", svfEveg, dsm_transf, dsm_crs
-        )
-        common.save_raster(
-            out_path_str + "/" + "svfSveg.tif", svfSveg, dsm_transf, dsm_crs
-        )
-        common.save_raster(
-            out_path_str + "/" + "svfWveg.tif", svfWveg, dsm_transf, dsm_crs
-        )
-        common.save_raster(
-            out_path_str + "/" + "svfNveg.tif", svfNveg, dsm_transf, dsm_crs
-        )
-        common.save_raster(
-            out_path_str + "/" + "svfaveg.tif", svfaveg, dsm_transf, dsm_crs
-        )
-        common.save_raster(
-            out_path_str + "/" + "svfEaveg.tif", svfEaveg, dsm_transf, dsm_crs
+    if svf_engine == "horizons":
+        ret = svf.svf_from_horizons(
+            dsm_rast, cdsm_rast, cdsm_2_rast, dsm_scale, use_cdsm
         )
-        common.save_raster(
-            out_path_str + "/" + "svfSaveg.tif", svfSaveg, dsm_transf, dsm_crs
+    elif tile_size is not None:
+        ret = tiling.svf_tiled(
+            dsm_rast,
+            cdsm_rast,
+            cdsm_2_rast,
+            dsm_scale,
+            use_cdsm,
+            shadow_backend,
+            mask_format=shadow_mask,
+            tile_size=tile_size,
+            shmat_dir=shmat_dir,
+            keep_shmat=shadow_mats != "none",
+            patch_option=patch_option,
         )
-        common.save_raster(
-            out_path_str + "/" + "svfWaveg.tif", svfWaveg, dsm_transf, dsm_crs
-        )
-        common.save_raster(
-            out_path_str + "/" + "svfNaveg.tif", svfNaveg, dsm_transf, dsm_crs
+    else:
+        ret = svf.svfForProcessing153(
+            dsm_rast,
+            cdsm_rast,
+            cdsm_2_rast,
+            dsm_scale,
+            use_cdsm,
+            shadow_backend,
+            mask_format=shadow_mask,
+            processes=processes,
+            shmat_dir=shmat_dir,
+            patch_bits=shadow_mats == "bits",
+            keep_shmat=shadow_mats != "none",
+            patch_option=patch_option,
+            checkpoint=(
+                None
+                if checkpoint_minutes is None
+                else out_path_str + "/" + "svf_checkpoint.npz"
+            ),
+            checkpoint_interval=60.0 * (checkpoint_minutes or 0.0),
         )
 
-        # Add vegetation rasters to the ZIP file
-        with zipfile.ZipFile(zip_filepath, "a") as zippo:
-            zippo.write(out_path_str + "/" + "svfveg.tif", "svfveg.tif")
-            zippo.write(out_path_str + "/" + "svfEveg.tif", "svfEveg.tif")
-            zippo.write(out_path_str + "/" + "svfSveg.tif", "svfSveg.tif")
-            zippo.write(out_path_str + "/" + "svfWveg.tif", "svfWveg.tif")
-            zippo.write(out_path_str + "/" + "svfNveg.tif", "svfNveg.tif")
-            zippo.write(out_path_str + "/" + "svfaveg.tif", "svfaveg.tif")
-            zippo.write(out_path_str + "/" + "svfEaveg.tif", "svfEaveg.tif")
-            zippo.write(out_path_str + "/" + "svfSaveg.tif", "svfSaveg.tif")
-            zippo.write(out_path_str + "/" + "svfWaveg.tif", "svfWaveg.tif")
-            zippo.write(out_path_str + "/" + "svfNaveg.tif", "svfNaveg.tif")
-
-        # Remove the individual TIFF files after zipping
-        os.remove(out_path_str + "/" + "svfveg.tif")
-        os.remove(out_path_str + "/" + "svfEveg.tif")
-        os.remove(out_path_str + "/" + "svfSveg.tif")
-        os.remove(out_path_str + "/" + "svfWveg.tif")
-        os.remove(out_path_str + "/" + "svfNveg.tif")
-        os.remove(out_path_str + "/" + "svfaveg.tif")
-        os.remove(out_path_str + "/" + "svfEaveg.tif")
-        os.remove(out_path_str + "/" + "svfSaveg.tif")
-        os.remove(out_path_str + "/" + "svfWaveg.tif")
-        os.remove(out_path_str + "/" + "svfNaveg.tif")
+    bands = {name: ret[name] for name in SVF_BANDS}
+    if use_cdsm == 1:
+        # Report the vegetation-related results
+        bands.update({name: ret[name] for name in SVF_VEG_BANDS})
 
-        # Calculate final total SVF
-        svftotal = svfbu - (1 - svfveg) * (1 - trans)
+    _save_svfs(out_path_str, bands, svf_product, dsm_transf, dsm_crs, trans)
 
-    # Save the final svftotal raster
-    common.save_raster(
-        out_path_str + "/" + "svf_total.tif", svftotal, dsm_transf, dsm_crs
-    )
+    # Save shadow matrices as compressed npz, the store is already written and
+    # "none" keeps no matrices
+    if shadow_mats == "bits":
+        shadowmats = {}
+        for key, name in (
+            ("shmat", "shadowmat"),
+            ("vegshmat", "vegshadowmat"),
+            ("vbshvegshmat", "vbshmat"),
+        ):
+            matrix = ret[key]
+            if not isinstance(matrix, dict):
+                # tiles are stitched as cubes
+                if shadow_mask == "packed":
+                    matrix = np.unpackbits(matrix, axis=1, count=cols)
+                matrix = shadowmask.pack_patches(matrix)
+            shadowmats[name] = matrix["bits"]
+            shadowmats["patches"] = matrix["patches"]
+        np.savez_compressed(out_path_str + "/" + "shadowmats.npz", **shadowmats)
+    elif shadow_mats == "npz":
+        shadowmats = {
+            "shadowmat": ret["shmat"],
+            "vegshadowmat": ret["vegshmat"],
+            "vbshmat": ret["vbshvegshmat"],
+        }
+        if shadow_mask == "packed":
+            # the number of columns is needed to unpack the matrices
+            shadowmats["cols"] = cols
+        np.savez_compressed(out_path_str + "/" + "shadowmats.npz", **shadowmats)
 
-    # Save shadow matrices as compressed npz
-    shmat = ret["shmat"]
-    vegshmat = ret["vegshmat"]
-    vbshvegshmat = ret["vbshvegshmat"]
 
-    np.savez_compressed(
-        out_path_str + "/" + "shadowmats.npz",
-        shadowmat=shmat,
-        vegshadowmat=vegshmat,
-        vbshmat=vbshvegshmat,
+def update_svf(
+    dsm_path: str,
+    bbox: list[int, int, int, int],
+    out_dir: str,
+    edit_path: str,  # raster of the edit footprint, edited pixels being non-zero
+    cdsm_path: str | None = None,
+    trans_veg: float = 3,
+    shadow_backend: str = "numpy",
+    patch_option: int = 2,  # as in the generate_svf run
+    edit_height: float | None = None,  # highest surface in the footprint before or
+    # after the edit, the whole grid is recomputed if None, see
+    # svfupdate.update_svf
+):
+    """
+    Updates the SVFs generate_svf wrote to out_dir for edited DSM / CDSM rasters,
+    recomputing only the pixels the edit can be seen from. The product (svfs.tif or
+    svfs.zip), svf_total.tif and the shadow matrices (npz or store) are rewritten,
+    bit-packed matrices are not updated.
+    """
+    out_path_str = str(Path(out_dir))
+    dsm_rast, dsm_transf, dsm_crs = common.load_raster(dsm_path, bbox)
+    dsm_scale = 1 / dsm_transf.a
+    if not trans_veg >= 0 and trans_veg <= 100:
+        raise ValueError(
+            "Vegetation transmissivity should be a number between 0 and 100"
+        )
+    trans = trans_veg / 100.0
+    rows, cols = dsm_rast.shape
+    if cdsm_path is None:
+        use_cdsm = 0
+        cdsm_rast = np.zeros([rows, cols])
+    else:
+        use_cdsm = 1
+        cdsm_rast, cdsm_transf, cdsm_crs = common.load_raster(cdsm_path, bbox)
+        if not cdsm_crs == dsm_crs:
+            raise ValueError("Mismatching CRS for DSM and CDSM.")
+        if not dsm_transf == cdsm_transf:
+            raise ValueError("Mismatching spatial transform for DSM and CDSM.")
+    edit_rast, edit_transf, _ = common.load_raster(edit_path, bbox)
+    if not dsm_transf == edit_transf:
+        raise ValueError("Mismatching spatial transform for DSM and edit footprint.")
+
+    # SVFs of the previous run, over the whole product as written
+    names = list(SVF_BANDS) + (list(SVF_VEG_BANDS) if use_cdsm == 1 else [])
+    if os.path.isfile(out_path_str + "/" + "svfs.tif"):
+        svf_product = "tif"
+        svfs, _, _ = common.load_raster_bands(out_path_str + "/" + "svfs.tif", names)
+    elif os.path.isfile(out_path_str + "/" + "svfs.zip"):
+        svf_product = "zip"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with zipfile.ZipFile(out_path_str + "/" + "svfs.zip", "r") as zippo:
+                zippo.extractall(temp_dir)
+            svfs = {
+                name: common.load_raster(temp_dir + "/" + name + ".tif")[0]
+                for name in names
+            }
+    else:
+        raise ValueError(f"No SVF product of generate_svf found in {out_dir}.")
+
+    # shadow matrices, updated in place in a store
+    npz_path = out_path_str + "/" + "shadowmats.npz"
+    shmat_dir = out_path_str + "/" + "shadowmats"
+    npz = None
+    if os.path.isfile(npz_path):
+        with np.load(npz_path) as data:
+            npz = {key: data[key] for key in data.files}
+        if "patches" in npz:
+            raise ValueError("Bit-packed shadow matrices can not be updated.")
+        svfs["shmat"] = npz["shadowmat"]
+        svfs["vegshmat"] = npz["vegshadowmat"]
+        svfs["vbshvegshmat"] = npz["vbshmat"]
+    elif os.path.isdir(shmat_dir):
+        store = shadowstore.open_store(shmat_dir, "r+")
+        for key in shadowstore.MATRICES:
+            svfs[key] = shadowstore.matrix(store, key)
+
+    ret = svfupdate.update_svf(
+        svfs,
+        dsm_rast,
+        cdsm_rast,
+        np.zeros([rows, cols]),
+        dsm_scale,
+        use_cdsm,
+        edit_rast != 0,
+        edit_height,
+        shadow_backend,
+        patch_option=patch_option,
     )
+    if ret["window"] is None:
+        return
+
+    bands = {name: ret[name] for name in names}
+    _save_svfs(out_path_str, bands, svf_product, dsm_transf, dsm_crs, trans)
+    if npz is not None:
+        np.savez_compressed(npz_path, **npz)
+    elif os.path.isdir(shmat_dir):
+        shadowstore.flush(store)
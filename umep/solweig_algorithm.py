@@ -65,6 +65,8 @@ from umep.functions.SOLWEIGpython import PET_calculations as p
 from umep.functions.SOLWEIGpython import Solweig_2022a_calc_forprocessing as so
 from umep.functions.SOLWEIGpython import UTCI_calculations as utci
 from umep.functions.SOLWEIGpython import WriteMetadataSOLWEIG
+from umep.skyviewfactor_algorithm import SVF_BANDS, SVF_VEG_BANDS
+from umep.util import shadowbatch, shadowcache, sunlattice
 from umep.util.SEBESOLWEIGCommonFiles.clearnessindex_2013b import clearnessindex_2013b
 from umep.util.SEBESOLWEIGCommonFiles.Solweig_v2015_metdata_noload import (
     Solweig_2015a_metdata_noload,
@@ -75,7 +77,7 @@ def generate_solweig(
     dsm_path: str,
     wall_ht_path: str,
     wall_aspect_path: str,
-    svf_path: str,
+    svf_path: str,  # svfs.zip or the multi-band svfs.tif of generate_svf
     epw_path: str,
     bbox: list[int, int, int, int],
     out_dir: str,
@@ -96,6 +98,11 @@ def generate_solweig(
     body_shortwave_absorp: float = 0.7,
     body_longwave_absorp: float = 0.95,
     estimate_radiation_from_global=False,
+    shadow_backend: str = "numpy",
+    shadow_mask: str = "float",  # "float", "bool" or "packed" shadow masks
+    shadow_cache_dir: str | None = None,  # shadows reused across runs of a site
+    shadow_cache_size_mb: float = 1024,
+    sun_lattice: tuple[float, float] | None = None,  # degrees - azimuth, altitude
 ):
     as_cylinder = 0
     standing = True
@@ -187,27 +194,36 @@ def generate_solweig(
         random.choice(string.ascii_uppercase) for _ in range(8)
     )
     temp_dir = out_path_str + "/" + temp_dir_name
-    zip = zipfile.ZipFile(svf_path, "r")
-    zip.extractall(temp_dir)
-    zip.close()
+    names = list(SVF_BANDS) + (list(SVF_VEG_BANDS) if usevegdem == 1 else [])
+    if svf_path.endswith(".zip"):
+        zip = zipfile.ZipFile(svf_path, "r")
+        zip.extractall(temp_dir)
+        zip.close()
+        svfs = {
+            name: common.load_raster(temp_dir + "/" + name + ".tif", bbox)[0]
+            for name in names
+        }
+    else:
+        # multi-band product of generate_svf, only the needed bands are read
+        svfs, _, _ = common.load_raster_bands(svf_path, names, bbox)
 
-    svf, _, _ = common.load_raster(temp_dir + "/svf.tif", bbox)
-    svfN, _, _ = common.load_raster(temp_dir + "/svfN.tif", bbox)
-    svfS, _, _ = common.load_raster(temp_dir + "/svfS.tif", bbox)
-    svfE, _, _ = common.load_raster(temp_dir + "/svfE.tif", bbox)
-    svfW, _, _ = common.load_raster(temp_dir + "/svfW.tif", bbox)
+    svf = svfs["svf"]
+    svfN = svfs["svfN"]
+    svfS = svfs["svfS"]
+    svfE = svfs["svfE"]
+    svfW = svfs["svfW"]
 
     if usevegdem == 1:
-        svfveg, _, _ = common.load_raster(temp_dir + "/svfveg.tif", bbox)
-        svfNveg, _, _ = common.load_raster(temp_dir + "/svfNveg.tif", bbox)
-        svfSveg, _, _ = common.load_raster(temp_dir + "/svfSveg.tif", bbox)
-        svfEveg, _, _ = common.load_raster(temp_dir + "/svfEveg.tif", bbox)
-        svfWveg, _, _ = common.load_raster(temp_dir + "/svfWveg.tif", bbox)
-        svfaveg, _, _ = common.load_raster(temp_dir + "/svfaveg.tif", bbox)
-        svfNaveg, _, _ = common.load_raster(temp_dir + "/svfNaveg.tif", bbox)
-        svfSaveg, _, _ = common.load_raster(temp_dir + "/svfSaveg.tif", bbox)
-        svfEaveg, _, _ = common.load_raster(temp_dir + "/svfEaveg.tif", bbox)
-        svfWaveg, _, _ = common.load_raster(temp_dir + "/svfWaveg.tif", bbox)
+        svfveg = svfs["svfveg"]
+        svfNveg = svfs["svfNveg"]
+        svfSveg = svfs["svfSveg"]
+        svfEveg = svfs["svfEveg"]
+        svfWveg = svfs["svfWveg"]
+        svfaveg = svfs["svfaveg"]
+        svfNaveg = svfs["svfNaveg"]
+        svfSaveg = svfs["svfSaveg"]
+        svfEaveg = svfs["svfEaveg"]
+        svfWaveg = svfs["svfWaveg"]
     else:
         svfveg = np.ones((dsm_height, dsm_width))
         svfNveg = np.ones((dsm_height, dsm_width))
@@ -437,6 +453,41 @@ def generate_solweig(
     # Main function
     print("Executing main model")
 
+    if sun_lattice is not None:
+        # shadows are cast for the nearest lattice node, radiation for the sun
+        lattice_report = sunlattice.snap_report(azimuth[0], altitude[0], sun_lattice)
+        print(sunlattice.format_report(lattice_report))
+        sunlattice.save_report(out_path_str + "/sun_lattice.json", lattice_report)
+
+    shadow_cache = None
+    if shadow_cache_dir is not None:
+        shadow_cache = shadowcache.open_cache(
+            shadow_cache_dir, shadow_cache_size_mb * 2**20
+        )
+    # tile bounds and cache site key of the grids, shared by all timesteps
+    if usevegdem == 1:
+        shadow_state = shadowbatch.prepare_shadows(
+            dsm,
+            dsm_scale,
+            veg_dsm,
+            veg_dsm_2,
+            amaxvalue,
+            bush,
+            wh_rast,
+            wa_rast * np.pi / 180.0,
+            shadow_mask,
+            cache=shadow_cache,
+        )
+    else:
+        shadow_state = shadowbatch.prepare_shadows(
+            dsm,
+            dsm_scale,
+            walls=wh_rast,
+            aspect=wa_rast * np.pi / 180.0,
+            mask_format=shadow_mask,
+            cache=shadow_cache,
+        )
+
     tmrtplot = np.zeros((dsm_height, dsm_width))
     TgOut1 = np.zeros((dsm_height, dsm_width))
 
@@ -598,6 +649,11 @@ def generate_solweig(
             anisotropic_sky,
             asvf,
             patch_option,
+            shadow_backend,
+            shadow_mask,
+            shadow_cache,
+            sun_lattice,
+            shadow_state,
         )
 
         if i < first_unique_day.shape[0]:
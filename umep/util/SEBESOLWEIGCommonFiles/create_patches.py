@@ -8,6 +8,7 @@ def create_patches(patch_option):
     # patch_option = 2 = 153 patches (Wallenberg et al., 2022)
     # patch_option = 3 = 306 patches -> test
     # patch_option = 4 = 612 patches -> test
+    # patch_option = 5 = 79 patches -> fast, screening runs
 
     skyvaultalt = np.atleast_2d([])
     skyvaultazi = np.atleast_2d([])
@@ -69,6 +70,14 @@ def create_patches(patch_option):
             ]
         )  # Nils
         azistart = np.array([0, 0, 4, 4, 2, 2, 5, 5, 8, 8, 0, 0, 10, 10, 0])  # Nils
+    # Patch option 5, 79 patches, bands of option 2 with about half the azimuths
+    elif patch_option == 5:
+        annulino = np.array([0, 12, 24, 36, 48, 60, 72, 84, 90])
+        skyvaultaltint = np.array(
+            [6, 18, 30, 42, 54, 66, 78, 90]
+        )  # Robinson & Stone (2004)
+        azistart = np.array([0, 4, 2, 5, 8, 0, 10, 0])  # Fredrik/Nils
+        patches_in_band = np.array([16, 15, 14, 12, 10, 7, 4, 1])
 
     skyvaultaziint = np.array([360 / patches for patches in patches_in_band])
 
@@ -5,10 +5,24 @@ from math import radians
 
 import numpy as np
 
+from umep.util import heightpyramid as hp
+from umep.util import shadowmask
+from umep.util.shadowingfunctions import shadow_steps
+
 # from scipy.ndimage.filters import median_filter
 
 
-def shadowingfunction_wallheight_13(a, azimuth, altitude, scale, walls, aspect):
+def shadowingfunction_wallheight_13(
+    a,
+    azimuth,
+    altitude,
+    scale,
+    walls,
+    aspect,
+    bounds=None,
+    mask_format="float",
+    amaxvalue=None,
+):
     """
     This m.file calculates shadows on a DSM and shadow height on building
     walls.
@@ -36,6 +50,9 @@ def shadowingfunction_wallheight_13(a, azimuth, altitude, scale, walls, aspect):
     :param scale:
     :param walls:
     :param aspect:
+    :param bounds: optional precomputed heightpyramid.tile_bounds(a)
+    :param mask_format: "float", "bool" or "packed" for sh, see shadowmask
+    :param amaxvalue: maximum obstruction height, np.max(a) if None
     :return:
     """
 
@@ -50,74 +67,47 @@ def shadowingfunction_wallheight_13(a, azimuth, altitude, scale, walls, aspect):
         aspect = dirwalls*np.pi/180
         """
 
-    # conversion
-    # degrees = np.pi/180
-    azimuth = radians(azimuth)
-    altitude = radians(altitude)
-
     # measure the size of the image
     sizex = np.shape(a)[0]
     sizey = np.shape(a)[1]
 
+    # ray march steps, each tile stops once its local obstruction bound is passed
+    if amaxvalue is None:
+        amaxvalue = np.max(a)
+    dxs, dys, dzs = shadow_steps(azimuth, altitude, scale, sizex, sizey, amaxvalue)
+    if bounds is None:
+        bounds = hp.tile_bounds(a)
+    stops = hp.tile_stops(bounds, dxs, dys, dzs)
+
+    # conversion
+    # degrees = np.pi/180
+    azimuth = radians(azimuth)
+
     # initialise parameters
-    f = np.copy(a)
-    dx = 0
-    dy = 0
-    dz = 0
+    f = a.astype(np.float64)
     temp = np.zeros((sizex, sizey))
     wallbol = (walls > 0).astype(float)
 
-    # other loop parameters
-    amaxvalue = np.max(a)
-    pibyfour = np.pi / 4
-    threetimespibyfour = 3 * pibyfour
-    fivetimespibyfour = 5 * pibyfour
-    seventimespibyfour = 7 * pibyfour
-    sinazimuth = np.sin(azimuth)
-    cosazimuth = np.cos(azimuth)
-    tanazimuth = np.tan(azimuth)
-    signsinazimuth = np.sign(sinazimuth)
-    signcosazimuth = np.sign(cosazimuth)
-    dssin = np.abs(1 / sinazimuth)
-    dscos = np.abs(1 / cosazimuth)
-    tanaltitudebyscale = np.tan(altitude) / scale
-
-    index = 1
-
     # main loop
-    while (amaxvalue >= dz) and (np.abs(dx) < sizex) and (np.abs(dy) < sizey):
-        if (pibyfour <= azimuth and azimuth < threetimespibyfour) or (
-            fivetimespibyfour <= azimuth and azimuth < seventimespibyfour
-        ):
-            dy = signsinazimuth * index
-            dx = -1 * signcosazimuth * np.abs(np.round(index / tanazimuth))
-            ds = dssin
-        else:
-            dy = signsinazimuth * np.abs(np.round(index * tanazimuth))
-            dx = -1 * signcosazimuth * index
-            ds = dscos
-
-        # note: dx and dy represent absolute values while ds is an incremental value
-        dz = ds * index * tanaltitudebyscale
-        temp[0:sizex, 0:sizey] = 0
-
-        absdx = np.abs(dx)
-        absdy = np.abs(dy)
-
-        xc1 = int((dx + absdx) / 2)
-        xc2 = int(sizex + (dx - absdx) / 2)
-        yc1 = int((dy + absdy) / 2)
-        yc2 = int(sizey + (dy - absdy) / 2)
-
-        xp1 = int(-((dx - absdx) / 2))
-        xp2 = int(sizex - (dx + absdx) / 2)
-        yp1 = int(-((dy - absdy) / 2))
-        yp2 = int(sizey - (dy + absdy) / 2)
-
-        temp[xp1:xp2, yp1:yp2] = a[xc1:xc2, yc1:yc2] - dz
-        f = np.fmax(f, temp)  # Moving building shadow
-
-        index = index + 1
+    for k in range(dzs.shape[0]):
+        window = hp.active_window(stops, k, hp.PYRAMID_TILE, sizex, sizey)
+        if window is None:
+            break
+        r0, r1, c0, c1 = window
+        dx = dxs[k]
+        dy = dys[k]
+        dz = dzs[k]
+        temp[r0:r1, c0:c1] = 0
+        # shifted DSM clipped to the active window
+        x0 = max(-dx, 0, r0)
+        x1 = min(sizex - dx, sizex, r1)
+        y0 = max(-dy, 0, c0)
+        y1 = min(sizey - dy, sizey, c1)
+        if x0 < x1 and y0 < y1:
+            temp[x0:x1, y0:y1] = a[x0 + dx : x1 + dx, y0 + dy : y1 + dy] - dz
+        f[r0:r1, c0:c1] = np.fmax(
+            f[r0:r1, c0:c1], temp[r0:r1, c0:c1]
+        )  # Moving building shadow
 
     # Removing walls in shadow due to selfshadowing
     azilow = azimuth - np.pi / 2
@@ -148,6 +138,6 @@ def shadowingfunction_wallheight_13(a, azimuth, altitude, scale, walls, aspect):
     wallsh = np.copy(walls - wallsun)
 
     sh = np.logical_not(np.logical_not(sh)).astype(float)
-    sh = sh * -1 + 1
+    sh = shadowmask.encode(sh * -1 + 1, mask_format)
 
     return sh, wallsh, wallsun, facesh, facesun
@@ -1,11 +1,28 @@
 from __future__ import division
 
 import numpy as np
+from numba import njit, prange
+
+from umep.util import heightpyramid as hp
+from umep.util import shadowmask
+from umep.util.shadowingfunctions import check_backend, shadow_steps
 
 
 # import matplotlib.pylab as plt
 def shadowingfunction_wallheight_23(
-    a, vegdem, vegdem2, azimuth, altitude, scale, amaxvalue, bush, walls, aspect
+    a,
+    vegdem,
+    vegdem2,
+    azimuth,
+    altitude,
+    scale,
+    amaxvalue,
+    bush,
+    walls,
+    aspect,
+    backend="numpy",
+    bounds=None,
+    mask_format="float",
 ):
     """
     This function calculates shadows on a DSM and shadow height on building
@@ -41,22 +58,46 @@ def shadowingfunction_wallheight_23(
     :param bush:
     :param walls:
     :param aspect:
+    :param backend: "numpy" or "numba" for the fused parallel kernel
+    :param bounds: optional precomputed heightpyramid.tile_bounds
+    :param mask_format: "float", "bool" or "packed" for sh and vegsh, see shadowmask
     :return:
     """
-
-    # conversion
-    degrees = np.pi / 180.0
-    azimuth *= degrees
-    altitude *= degrees
+    check_backend(backend)
+    shadowmask.check_mask_format(mask_format)
+    if backend == "numba":
+        return _shadowingfunction_wallheight_23_fused(
+            a,
+            vegdem,
+            vegdem2,
+            azimuth,
+            altitude,
+            scale,
+            amaxvalue,
+            bush,
+            walls,
+            aspect,
+            bounds,
+            mask_format,
+        )
 
     # measure the size of the image
     sizex = np.shape(a)[0]
     sizey = np.shape(a)[1]
 
+    # ray march steps, each tile stops once its local obstruction bound is passed
+    dxs, dys, dzs = shadow_steps(
+        azimuth, altitude, scale, sizex, sizey, amaxvalue, index=0.0
+    )
+    if bounds is None:
+        bounds = hp.tile_bounds(a, (vegdem, vegdem2))
+    stops = hp.tile_stops(bounds, dxs, dys, dzs)
+
+    # conversion
+    degrees = np.pi / 180.0
+    azimuth *= degrees
+
     # initialise parameters
-    dx = 0
-    dy = 0
-    dz = 0
     temp = np.zeros((sizex, sizey))
     tempvegdem = np.zeros((sizex, sizey))
     tempvegdem2 = np.zeros((sizex, sizey))
@@ -68,78 +109,57 @@ def shadowingfunction_wallheight_23(
     vegsh = np.add(
         np.zeros((sizex, sizey)), bushplant, dtype=float
     )  # vegetation shadow
-    f = np.copy(a)
-    shvoveg = np.copy(vegdem)  # for vegetation shadowvolume
+    f = a.astype(np.float64)
+    shvoveg = vegdem.astype(np.float64)  # for vegetation shadowvolume
     # g = np.copy(sh)
     wallbol = (walls > 0).astype(float)
 
-    # other loop parameters
-    pibyfour = np.pi / 4
-    threetimespibyfour = 3 * pibyfour
-    fivetimespibyfour = 5 * pibyfour
-    seventimespibyfour = 7 * pibyfour
-    sinazimuth = np.sin(azimuth)
-    cosazimuth = np.cos(azimuth)
-    tanazimuth = np.tan(azimuth)
-    signsinazimuth = np.sign(sinazimuth)
-    signcosazimuth = np.sign(cosazimuth)
-    dssin = np.abs(1 / sinazimuth)
-    dscos = np.abs(1 / cosazimuth)
-    tanaltitudebyscale = np.tan(altitude) / scale
-
-    index = 0
-
     # new case with pergola (thin vertical layer of vegetation), August 2021
     dzprev = 0
 
     # main loop
-    while (amaxvalue >= dz) and (np.abs(dx) < sizex) and (np.abs(dy) < sizey):
-        if ((pibyfour <= azimuth) and (azimuth < threetimespibyfour)) or (
-            (fivetimespibyfour <= azimuth) and (azimuth < seventimespibyfour)
-        ):
-            dy = signsinazimuth * index
-            dx = -1 * signcosazimuth * np.abs(np.round(index / tanazimuth))
-            ds = dssin
-        else:
-            dy = signsinazimuth * np.abs(np.round(index * tanazimuth))
-            dx = -1 * signcosazimuth * index
-            ds = dscos
-
-        # note: dx and dy represent absolute values while ds is an incremental value
-        dz = (ds * index) * tanaltitudebyscale
-        tempvegdem[0:sizex, 0:sizey] = 0
-        tempvegdem2[0:sizex, 0:sizey] = 0
-        temp[0:sizex, 0:sizey] = 0
-        templastfabovea[0:sizex, 0:sizey] = 0.0
-        templastgabovea[0:sizex, 0:sizey] = 0.0
-        absdx = np.abs(dx)
-        absdy = np.abs(dy)
-        xc1 = int((dx + absdx) / 2)
-        xc2 = int(sizex + (dx - absdx) / 2)
-        yc1 = int((dy + absdy) / 2)
-        yc2 = int(sizey + (dy - absdy) / 2)
-        xp1 = -int((dx - absdx) / 2)
-        xp2 = int(sizex - (dx + absdx) / 2)
-        yp1 = -int((dy - absdy) / 2)
-        yp2 = int(sizey - (dy + absdy) / 2)
-
-        tempvegdem[xp1:xp2, yp1:yp2] = vegdem[xc1:xc2, yc1:yc2] - dz
-        tempvegdem2[xp1:xp2, yp1:yp2] = vegdem2[xc1:xc2, yc1:yc2] - dz
-        temp[xp1:xp2, yp1:yp2] = a[xc1:xc2, yc1:yc2] - dz
-
-        f = np.fmax(f, temp)  # Moving building shadow
-        shvoveg = np.fmax(shvoveg, tempvegdem)  # moving vegetation shadow volume
-        sh[f > a] = 1
-        sh[f <= a] = 0
-        fabovea = (tempvegdem > a).astype(int)  # vegdem above DEM
-        gabovea = (tempvegdem2 > a).astype(int)  # vegdem2 above DEM
-
-        # new pergola condition
-        templastfabovea[xp1:xp2, yp1:yp2] = vegdem[xc1:xc2, yc1:yc2] - dzprev
-        templastgabovea[xp1:xp2, yp1:yp2] = vegdem2[xc1:xc2, yc1:yc2] - dzprev
-        lastfabovea = templastfabovea > a
-        lastgabovea = templastgabovea > a
+    for k in range(dzs.shape[0]):
+        window = hp.active_window(stops, k, hp.PYRAMID_TILE, sizex, sizey)
+        if window is None:
+            break
+        r0, r1, c0, c1 = window
+        dx = dxs[k]
+        dy = dys[k]
+        dz = dzs[k]
+        win = (slice(r0, r1), slice(c0, c1))
+        tempvegdem[win] = 0
+        tempvegdem2[win] = 0
+        temp[win] = 0
+        templastfabovea[win] = 0.0
+        templastgabovea[win] = 0.0
+        # shifted grids clipped to the active window
+        x0 = max(-dx, 0, r0)
+        x1 = min(sizex - dx, sizex, r1)
+        y0 = max(-dy, 0, c0)
+        y1 = min(sizey - dy, sizey, c1)
+        if x0 < x1 and y0 < y1:
+            shifted = (slice(x0 + dx, x1 + dx), slice(y0 + dy, y1 + dy))
+            clipped = (slice(x0, x1), slice(y0, y1))
+            tempvegdem[clipped] = vegdem[shifted] - dz
+            tempvegdem2[clipped] = vegdem2[shifted] - dz
+            temp[clipped] = a[shifted] - dz
+            # new pergola condition
+            templastfabovea[clipped] = vegdem[shifted] - dzprev
+            templastgabovea[clipped] = vegdem2[shifted] - dzprev
         dzprev = dz
+
+        awin = a[win]
+        f[win] = np.fmax(f[win], temp[win])  # Moving building shadow
+        # moving vegetation shadow volume
+        shvoveg[win] = np.fmax(shvoveg[win], tempvegdem[win])
+        fwin = f[win]
+        shwin = sh[win]
+        shwin[fwin > awin] = 1
+        shwin[fwin <= awin] = 0
+        fabovea = (tempvegdem[win] > awin).astype(int)  # vegdem above DEM
+        gabovea = (tempvegdem2[win] > awin).astype(int)  # vegdem2 above DEM
+        lastfabovea = templastfabovea[win] > awin
+        lastgabovea = templastgabovea[win] > awin
         vegsh2 = np.add(
             np.add(np.add(fabovea, gabovea, dtype=float), lastfabovea, dtype=float),
             lastgabovea,
@@ -152,9 +172,10 @@ def shadowingfunction_wallheight_23(
         # vegsh2 = fabovea - gabovea #old without pergolas
         # vegsh = np.max([vegsh, vegsh2], axis=0) #old without pergolas
 
-        vegsh = np.fmax(vegsh, vegsh2)
-        vegsh[vegsh * sh > 0] = 0
-        vbshvegsh = np.copy(vegsh) + vbshvegsh  # removing shadows 'behind' buildings
+        vegshwin = vegsh[win]
+        vegshwin[...] = np.fmax(vegshwin, vegsh2)
+        vegshwin[vegshwin * shwin > 0] = 0
+        vbshvegsh[win] += vegshwin  # removing shadows 'behind' buildings
 
         # # vegsh at high sun altitudes # Not needed when pergolas are included
         # if index == 0:
@@ -171,8 +192,6 @@ def shadowingfunction_wallheight_23(
         #     g = np.max([g, tempbush], axis=0)
         #     g = bushplant * g
 
-        index += 1
-
     # Removing walls in shadow due to selfshadowing
     azilow = azimuth - np.pi / 2
     azihigh = azimuth + np.pi / 2
@@ -225,4 +244,213 @@ def shadowingfunction_wallheight_23(
     wallshve[id] = 0
     wallsun[id] = 0
 
+    sh = shadowmask.encode(sh, mask_format)
+    vegsh = shadowmask.encode(vegsh, mask_format)
+
+    return vegsh, sh, vbshvegsh, wallsh, wallsun, wallshve, facesh, facesun
+
+
+def face_case(azimuth):
+    """
+    Self shadowing branch used for the wall facets. Azimuth in radians.
+    Returns the case (1: 90 to 270, 2: 0 to 90, 3: 270 to 360) and the
+    adjusted low and high azimuth bounds.
+    """
+    azilow = azimuth - np.pi / 2
+    azihigh = azimuth + np.pi / 2
+    if azilow >= 0 and azihigh < 2 * np.pi:
+        return 1, azilow, azihigh
+    elif azilow < 0 and azihigh <= 2 * np.pi:
+        return 2, azilow + 2 * np.pi, azihigh
+    return 3, azilow, azihigh - 2 * np.pi
+
+
+def _shadowingfunction_wallheight_23_fused(
+    a,
+    vegdem,
+    vegdem2,
+    azimuth,
+    altitude,
+    scale,
+    amaxvalue,
+    bush,
+    walls,
+    aspect,
+    bounds,
+    mask_format,
+):
+    sizex, sizey = a.shape
+    dxs, dys, dzs = shadow_steps(
+        azimuth, altitude, scale, sizex, sizey, amaxvalue, index=0.0
+    )
+    if bounds is None:
+        bounds = hp.tile_bounds(a, (vegdem, vegdem2))
+    stops = hp.tile_stops(bounds, dxs, dys, dzs)
+    facecase, azilow, azihigh = face_case(azimuth * np.pi / 180.0)
+    out = np.empty((8, sizex, sizey), dtype=np.float64)
+    shadowingfunction_wallheight_23_numba(
+        a,
+        vegdem,
+        vegdem2,
+        bush,
+        walls,
+        aspect,
+        dxs,
+        dys,
+        dzs,
+        stops,
+        hp.PYRAMID_TILE,
+        facecase,
+        azilow,
+        azihigh,
+        out,
+    )
+    vegsh, sh, vbshvegsh, wallsh, wallsun, wallshve, facesh, facesun = out
+    if facecase != 1:
+        # the numpy path gives integer self shadows outside of 90 to 270
+        facesh = facesh.astype(int)
+    sh = shadowmask.encode(sh, mask_format)
+    vegsh = shadowmask.encode(vegsh, mask_format)
+
     return vegsh, sh, vbshvegsh, wallsh, wallsun, wallshve, facesh, facesun
+
+
+@njit(parallel=True, cache=True)
+def shadowingfunction_wallheight_23_numba(
+    a,
+    vegdem,
+    vegdem2,
+    bush,
+    walls,
+    aspect,
+    dxs,
+    dys,
+    dzs,
+    stops,
+    tile,
+    facecase,
+    azilow,
+    azihigh,
+    out,
+):
+    """
+    Fused single pass equivalent of shadowingfunction_wallheight_23.
+
+    Rows are processed in parallel. For each row the ray march and the wall and
+    facade post-processing happen in one sweep, writing straight into the
+    preallocated out buffer (vegsh, sh, vbshvegsh, wallsh, wallsun, wallshve,
+    facesh, facesun). The wallsun and wallshve rows double as the running
+    building and vegetation shadow volumes until they are finalised. Each tile of
+    a row only marches up to its stop step from heightpyramid.tile_stops.
+    """
+    sizex = a.shape[0]
+    sizey = a.shape[1]
+    nty = stops.shape[1]
+    vegsh = out[0]
+    sh = out[1]
+    vbshvegsh = out[2]
+    wallsh = out[3]
+    wallsun = out[4]
+    wallshve = out[5]
+    facesh = out[6]
+    facesun = out[7]
+    for i in prange(sizex):
+        f = wallsun[i]  # moving building shadow
+        shvoveg = wallshve[i]  # moving vegetation shadow volume
+        for j in range(sizey):
+            f[j] = a[i, j]
+            shvoveg[j] = vegdem[i, j]
+            sh[i, j] = 0.0
+            vegsh[i, j] = 1.0 if bush[i, j] > 1 else 0.0
+            vbshvegsh[i, j] = 0.0
+        tx = i // tile
+        rowstop = 0
+        for ty in range(nty):
+            rowstop = max(rowstop, stops[tx, ty])
+        for k in range(rowstop):
+            dx = dxs[k]
+            dy = dys[k]
+            dz = dzs[k]
+            # new case with pergola (thin vertical layer of vegetation), August 2021
+            dzprev = dzs[k - 1] if k > 0 else 0.0
+            rowin = 0 <= i + dx < sizex
+            for j in range(sizey):
+                if stops[tx, j // tile] <= k:
+                    continue
+                if rowin and 0 <= j + dy < sizey:
+                    temp = a[i + dx, j + dy] - dz
+                    tempvegdem = vegdem[i + dx, j + dy] - dz
+                    tempvegdem2 = vegdem2[i + dx, j + dy] - dz
+                    templastfabovea = vegdem[i + dx, j + dy] - dzprev
+                    templastgabovea = vegdem2[i + dx, j + dy] - dzprev
+                else:
+                    temp = 0.0
+                    tempvegdem = 0.0
+                    tempvegdem2 = 0.0
+                    templastfabovea = 0.0
+                    templastgabovea = 0.0
+                # np.fmax semantics
+                if temp > f[j] or f[j] != f[j]:
+                    f[j] = temp
+                if tempvegdem > shvoveg[j] or shvoveg[j] != shvoveg[j]:
+                    shvoveg[j] = tempvegdem
+                aij = a[i, j]
+                if f[j] > aij:
+                    sh[i, j] = 1.0
+                elif f[j] <= aij:
+                    sh[i, j] = 0.0
+                vegsh2 = 0
+                if tempvegdem > aij:
+                    vegsh2 += 1
+                if tempvegdem2 > aij:
+                    vegsh2 += 1
+                if templastfabovea > aij:
+                    vegsh2 += 1
+                if templastgabovea > aij:
+                    vegsh2 += 1
+                if vegsh2 > 0 and vegsh2 < 4 and vegsh[i, j] < 1.0:
+                    vegsh[i, j] = 1.0
+                if vegsh[i, j] * sh[i, j] > 0:
+                    vegsh[i, j] = 0.0
+                vbshvegsh[i, j] += vegsh[i, j]
+
+        for j in range(sizey):
+            aij = a[i, j]
+            wall = walls[i, j]
+            wallbol = 1.0 if wall > 0 else 0.0
+            # Removing walls in shadow due to selfshadowing
+            asp = aspect[i, j]
+            if facecase == 1:
+                fsh = (1.0 if asp < azilow or asp >= azihigh else 0.0) - wallbol + 1
+            else:
+                fsh = 0.0 if asp > azilow or asp <= azihigh else 1.0
+            facesh[i, j] = fsh
+            facesun[i, j] = 1.0 if fsh + wallbol == 1 and wall > 0 else 0.0
+
+            sh[i, j] = 1 - sh[i, j]
+            vbsh = 1.0 if vbshvegsh[i, j] > 0 else vbshvegsh[i, j]
+            vbsh = vbsh - vegsh[i, j]
+            vsh = 1.0 if vegsh[i, j] > 0 else vegsh[i, j]
+            shv = (shvoveg[j] - aij) * vsh  # Vegetation shadow volume
+            vegsh[i, j] = 1 - vsh
+            vbshvegsh[i, j] = 1 - vbsh
+
+            # wall shadows
+            shvo = f[j] - aij  # building shadow volume
+            wsun = wall - shvo
+            if wsun < 0:
+                wsun = 0.0
+            if fsh == 1:
+                wsun = 0.0  # Removing walls in "self"-shadow
+            wsh = wall - wsun
+            wshve = shv * wallbol - wsh
+            if wshve < 0:
+                wshve = 0.0
+            wshve = min(wshve, wall)
+            wsun = wsun - wshve
+            if wsun < 0:
+                wshve = 0.0
+                wsun = 0.0
+            wallsh[i, j] = wsh
+            wallsun[i, j] = wsun
+            wallshve[i, j] = wshve
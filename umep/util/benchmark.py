@@ -0,0 +1,356 @@
+"""
+Benchmark of the shadow functions on synthetic DSMs.
+
+    python -m umep.util.benchmark --sizes 256 512 1024 --output shadows.json
+
+Each case (function, backend, grid size, vegetation density) runs in a fresh
+spawned process so that peak memory is measured per case. Results are written as
+JSON with one record per case. Peak memory is not measured on Windows.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # no resource module on Windows, peak memory is then not reported
+    resource = None
+
+# function name -> backends, "numpy" being the reference of each function
+FUNCTIONS = {
+    "shadowingfunctionglobalradiation": ("numpy", "numba"),
+    "shadowingfunction_20": ("numpy", "numba"),
+    # serial kernel, compared against the numpy reference of shadowingfunction_20
+    "shadowingfunction_20_numba": ("numba",),
+    "shadowingfunction_wallheight_13": ("numpy",),
+    "shadowingfunction_wallheight_23": ("numpy", "numba"),
+}
+REFERENCES = {"shadowingfunction_20_numba": "shadowingfunction_20"}
+VEGETATION = ("shadowingfunction_20", "shadowingfunction_20_numba")
+
+SIZES = (256, 512, 1024, 2048, 4096, 8192)
+ALTITUDES = (10.0, 30.0, 60.0)
+AZIMUTHS = (45.0, 135.0, 200.0, 300.0)
+VEG_DENSITIES = (0.0, 0.3)
+
+
+def synthetic_dsm(size, veg_density=0.0, seed=0):
+    """
+    Block city on flat ground at 10 m, buildings of 3 - 60 m separated by 12 pixel
+    streets and tree crowns of 5 - 15 m covering about veg_density of the open
+    ground.
+
+    Returns the DSM and the canopy and trunk zone DSMs offset by the DSM as used by
+    the shadow functions (zero without vegetation), all float32.
+    """
+    rng = np.random.default_rng(seed)
+    block, street, crown = 32, 12, 4
+    ground = 10.0
+    nblocks = -(-size // block)
+    heights = rng.uniform(3.0, 60.0, (nblocks, nblocks))
+    # a fifth of the blocks are left open
+    heights[rng.random((nblocks, nblocks)) < 0.2] = 0.0
+    heights = np.kron(heights, np.ones((block, block)))[:size, :size]
+    idx = np.arange(size) % block
+    built = (idx[:, None] >= street) & (idx[None, :] >= street)
+    dsm = (ground + np.where(built, heights, 0.0)).astype(np.float32)
+
+    ncrowns = -(-size // crown)
+    canopy = rng.uniform(5.0, 15.0, (ncrowns, ncrowns))
+    canopy[rng.random((ncrowns, ncrowns)) >= veg_density] = 0.0
+    canopy = np.kron(canopy, np.ones((crown, crown)))[:size, :size]
+    canopy[dsm > ground] = 0.0
+    vegdem = np.where(canopy > 0, canopy + dsm, 0.0).astype(np.float32)
+    vegdem2 = np.where(canopy > 0, 0.25 * canopy + dsm, 0.0).astype(np.float32)
+
+    return dsm, vegdem, vegdem2
+
+
+def _wall_grids(dsm):
+    # wall heights from the four neighbour maximum and aspects from the DSM
+    # gradient, cheap stand-ins for findwalls and filter1Goodwin_as_aspect_v3
+    pad = np.pad(dsm, 1, mode="edge")
+    neighbours = np.maximum.reduce(
+        [pad[:-2, 1:-1], pad[2:, 1:-1], pad[1:-1, :-2], pad[1:-1, 2:]]
+    )
+    walls = neighbours - dsm
+    walls[walls < 2.0] = 0.0
+    gx, gy = np.gradient(dsm)
+    aspect = np.mod(np.arctan2(gx, gy), 2 * np.pi)
+
+    return walls.astype(np.float32), aspect.astype(np.float32)
+
+
+def _caller(function, backend, dsm, vegdem, vegdem2, scale):
+    # single sun position call of a shadow function with its DSM level inputs
+    from umep.util import shadowingfunctions as shadow
+    from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_13 import (
+        shadowingfunction_wallheight_13,
+    )
+    from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_23 import (
+        shadowingfunction_wallheight_23,
+    )
+
+    amaxvalue = max(dsm.max(), vegdem.max())
+    bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    if function == "shadowingfunctionglobalradiation":
+        return lambda azi, alt: shadow.shadowingfunctionglobalradiation(
+            dsm, azi, alt, scale, 1, backend
+        )
+    if function == "shadowingfunction_20":
+        return lambda azi, alt: shadow.shadowingfunction_20(
+            dsm, vegdem, vegdem2, azi, alt, scale, amaxvalue, bush, 1, backend
+        )
+    if function == "shadowingfunction_20_numba":
+        # the serial kernel only types for float64 grids
+        dsm, vegdem, vegdem2, bush = (
+            grid.astype(np.float64) for grid in (dsm, vegdem, vegdem2, bush)
+        )
+        return lambda azi, alt: shadow.shadowingfunction_20_numba(
+            dsm, vegdem, vegdem2, azi, alt, scale, float(amaxvalue), bush, 1
+        )
+    walls, aspect = _wall_grids(dsm)
+    if function == "shadowingfunction_wallheight_13":
+        return lambda azi, alt: shadowingfunction_wallheight_13(
+            dsm, azi, alt, scale, walls, aspect
+        )
+    return lambda azi, alt: shadowingfunction_wallheight_23(
+        dsm,
+        vegdem,
+        vegdem2,
+        azi,
+        alt,
+        scale,
+        amaxvalue,
+        bush,
+        walls,
+        aspect,
+        backend,
+    )
+
+
+def _maxrss():
+    # peak resident set size of this process in bytes, None without resource
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _run_case(case, queue):
+    # runs in a spawned process, puts the measurements of one case on the queue
+    from umep.util import compilation
+    from umep.util import shadowingfunctions as shadow
+
+    size = case["size"]
+    scale = case["scale"]
+    # loads the kernels from the on-disk cache, compiling them on a first run, for
+    # every backend as the numpy functions dispatch the tile stops to numba too
+    start = time.perf_counter()
+    compilation.warmup()
+    compile_time = time.perf_counter() - start
+    # peak memory of the interpreter and the kernels, taken off the case peak
+    baseline = _maxrss()
+    dsm, vegdem, vegdem2 = synthetic_dsm(size, case["veg_density"], case["seed"])
+    call = _caller(case["function"], case["backend"], dsm, vegdem, vegdem2, scale)
+    # an untimed call, so that no timed position pays for the first dispatch
+    start = time.perf_counter()
+    call(case["azimuths"][0], case["altitudes"][0])
+    compile_time += time.perf_counter() - start
+    index = 0.0 if case["function"] in VEGETATION else 1.0
+    amaxvalue = max(dsm.max(), vegdem.max())
+    timings = []
+    steps = 0
+    for altitude in case["altitudes"]:
+        for azimuth in case["azimuths"]:
+            dxs = shadow.shadow_steps(
+                azimuth, altitude, scale, size, size, amaxvalue, index
+            )[0]
+            steps += len(dxs)
+            start = time.perf_counter()
+            call(azimuth, altitude)
+            timings.append(time.perf_counter() - start)
+    seconds = float(np.sum(timings))
+    pixel_steps = size * size * steps
+    peak = _maxrss()
+    queue.put(
+        {
+            "positions": len(timings),
+            "steps": steps,
+            "seconds": seconds,
+            "seconds_per_position": float(np.median(timings)),
+            "pixel_steps": pixel_steps,
+            "throughput": pixel_steps / seconds if seconds > 0 else None,
+            "input_memory_mb": (dsm.nbytes + vegdem.nbytes + vegdem2.nbytes) / 2**20,
+            "peak_memory_mb": None if peak is None else (peak - baseline) / 2**20,
+            "compile_seconds": compile_time,
+        }
+    )
+
+
+def _measure(case):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(case, queue))
+    proc.start()
+    # the result is a small dict, it fits the queue pipe before the join
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError(f"Benchmark case failed: {case}")
+    return queue.get()
+
+
+def run_benchmarks(
+    sizes=SIZES[:3],
+    functions=tuple(FUNCTIONS),
+    backends=("numpy", "numba"),
+    altitudes=ALTITUDES,
+    azimuths=AZIMUTHS,
+    veg_densities=VEG_DENSITIES,
+    scale=1.0,
+    seed=0,
+    max_reference_size=2048,
+    progress=None,
+):
+    """
+    Runs the benchmark cases and returns a list of records, one per function,
+    backend, size and vegetation density.
+
+    Throughput is given in pixels * ray steps per second, the steps being those of
+    the full ray march for each sun position (shadow_steps) so that early ray
+    termination shows as a higher throughput. Peak memory is the rise of the peak
+    resident set size of the case process over the interpreter and the loaded
+    kernels, i.e. the inputs and working memory of the case, None on Windows.
+    Speedups are relative to the numpy backend of the same function
+    (shadowingfunction_20 for the serial shadowingfunction_20_numba kernel), which
+    is skipped above max_reference_size as it is slow on large grids.
+
+    progress = optional callable receiving each record when done
+    """
+    for function in functions:
+        if function not in FUNCTIONS:
+            raise ValueError(
+                f"Unknown shadow function '{function}', "
+                f"expected one of {tuple(FUNCTIONS)}"
+            )
+    records = []
+    for size in sizes:
+        for veg_density in veg_densities:
+            reference = {}
+            # references first, so that speedups are known when a record is done
+            cases = sorted(
+                (
+                    (function, backend)
+                    for function in functions
+                    for backend in FUNCTIONS[function]
+                    if backend in backends
+                ),
+                key=lambda case: case[1] != "numpy",
+            )
+            for function, backend in cases:
+                if backend == "numpy" and size > max_reference_size:
+                    continue
+                case = {
+                    "function": function,
+                    "backend": backend,
+                    "size": size,
+                    "veg_density": veg_density,
+                    "altitudes": list(altitudes),
+                    "azimuths": list(azimuths),
+                    "scale": scale,
+                    "seed": seed,
+                }
+                record = dict(case, **_measure(case))
+                if backend == "numpy":
+                    reference[function] = record["seconds"]
+                ref = reference.get(REFERENCES.get(function, function))
+                record["speedup"] = ref / record["seconds"] if ref else None
+                records.append(record)
+                if progress is not None:
+                    progress(record)
+
+    return records
+
+
+def environment():
+    # versions and machine the benchmark ran on
+    import numba
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the shadow functions.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES[:3]))
+    parser.add_argument(
+        "--functions", nargs="+", default=list(FUNCTIONS), choices=list(FUNCTIONS)
+    )
+    parser.add_argument(
+        "--backends", nargs="+", default=["numpy", "numba"], choices=["numpy", "numba"]
+    )
+    parser.add_argument("--altitudes", type=float, nargs="+", default=list(ALTITUDES))
+    parser.add_argument("--azimuths", type=float, nargs="+", default=list(AZIMUTHS))
+    parser.add_argument(
+        "--veg-densities", type=float, nargs="+", default=list(VEG_DENSITIES)
+    )
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-reference-size", type=int, default=2048)
+    parser.add_argument("--output", help="JSON file, printed when not given")
+    args = parser.parse_args(argv)
+
+    def progress(record):
+        speedup = record["speedup"]
+        print(
+            f"{record['function']:<34} {record['backend']:<6} {record['size']:>5} "
+            f"veg {record['veg_density']:.2f} "
+            f"{record['seconds_per_position']:8.3f} s/position "
+            f"{record['throughput'] or 0:.3e} px*steps/s "
+            + (
+                f"{record['peak_memory_mb']:8.1f} MB"
+                if record["peak_memory_mb"] is not None
+                else ""
+            )
+            + (f" x{speedup:.2f}" if speedup else ""),
+            file=sys.stderr,
+        )
+
+    records = run_benchmarks(
+        args.sizes,
+        args.functions,
+        args.backends,
+        args.altitudes,
+        args.azimuths,
+        args.veg_densities,
+        args.scale,
+        args.seed,
+        args.max_reference_size,
+        progress,
+    )
+    report = {"environment": environment(), "results": records}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
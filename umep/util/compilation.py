@@ -0,0 +1,158 @@
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from numba.core import event
+
+from umep.functions import wallalgorithms as wa
+from umep.util import heightpyramid as hp
+from umep.util import horizon
+from umep.util import shadowingfunctions as shadow
+from umep.util.SEBESOLWEIGCommonFiles import shadowingfunction_wallheight_23 as wh23
+
+# compiled kernels, all cached on disk (cache=True) next to their modules
+KERNELS = (
+    shadow.shadowingfunctionglobalradiation_numba,
+    shadow.shadowingfunction_20_parallel,
+    shadow.shadowingfunction_20_numba,
+    wh23.shadowingfunction_wallheight_23_numba,
+    hp._tile_stops,
+    horizon._horizon_ray,
+    horizon._canopy_ray,
+    horizon._sky_ray,
+    wa.filter1Goodwin_numba,
+)
+
+
+class _CompileTimer(event.Listener):
+    # Accumulates the time of outermost compilations per kernel, nested
+    # compilations are part of their caller
+    def __init__(self):
+        self.depth = 0
+        self.start = 0.0
+        self.name = None
+        self.kernels = {}
+
+    def on_start(self, ev):
+        if self.depth == 0:
+            self.start = time.perf_counter()
+            self.name = ev.data["dispatcher"].py_func.__name__
+        self.depth += 1
+
+    def on_end(self, ev):
+        self.depth -= 1
+        if self.depth == 0:
+            elapsed = time.perf_counter() - self.start
+            self.kernels[self.name] = self.kernels.get(self.name, 0.0) + elapsed
+
+
+def _cache_counts():
+    counts = {}
+    for kernel in KERNELS:
+        stats = kernel.stats
+        counts[kernel.py_func.__name__] = (
+            sum(stats.cache_hits.values()),
+            sum(stats.cache_misses.values()),
+        )
+    return counts
+
+
+@contextmanager
+def compile_report():
+    """
+    Splits the wall clock time of a block into numba compilation and run time.
+
+    Yields a dict that is filled on exit with the "total", "compile" and "run"
+    seconds and, per kernel dispatched for a new signature in the block, the
+    compile seconds and the number of signatures loaded from ("cache_hits") or
+    missing in ("cache_misses") the on-disk cache. Loading from the cache is
+    counted as run time.
+
+        with compile_report() as report:
+            generate_svf(...)
+        print(report["compile"], report["run"])
+    """
+    report = {}
+    timer = _CompileTimer()
+    before = _cache_counts()
+    start = time.perf_counter()
+    try:
+        with event.install_listener("numba:compile", timer):
+            yield report
+    finally:
+        total = time.perf_counter() - start
+        after = _cache_counts()
+        kernels = {}
+        for name in after:
+            hits = after[name][0] - before[name][0]
+            misses = after[name][1] - before[name][1]
+            if hits or misses or name in timer.kernels:
+                kernels[name] = {
+                    "compile": timer.kernels.get(name, 0.0),
+                    "cache_hits": hits,
+                    "cache_misses": misses,
+                }
+        compile_time = sum(timer.kernels.values(), 0.0)
+        report.update(
+            {
+                "total": total,
+                "compile": compile_time,
+                "run": total - compile_time,
+                "kernels": kernels,
+            }
+        )
+
+
+def warmup(dtypes=(np.float32, np.float64)):
+    """
+    Compiles the numba kernels for the signatures used by the algorithms, or loads
+    them from the on-disk cache when already compiled, so that later runs and
+    worker processes start hot.
+
+    dtypes = DSM dtypes to compile for (rasters are usually read as float32)
+
+    Returns the compile_report of the warm-up.
+    """
+    with compile_report() as report:
+        for dtype in dtypes:
+            # a small grid with one obstruction, so that every kernel marches
+            a = np.zeros((4, 4), dtype=dtype)
+            a[1, 1] = 5.0
+            vegdem = np.zeros_like(a)
+            vegdem2 = np.zeros_like(a)
+            bush = np.zeros_like(a)
+            walls = np.zeros_like(a)
+            aspect = np.zeros_like(a)
+            amaxvalue = a.max()
+            for mask_format in ("float", "bool"):
+                shadow.shadowingfunctionglobalradiation(
+                    a, 45.0, 30.0, 1.0, 1, "numba", mask_format=mask_format
+                )
+            shadow.shadowingfunction_20(
+                a, vegdem, vegdem2, 45.0, 30.0, 1.0, amaxvalue, bush, 1, "numba"
+            )
+            if a.dtype == np.float64:
+                # the serial kernel only types for float64 grids
+                shadow.shadowingfunction_20_numba(
+                    a, vegdem, vegdem2, 45.0, 30.0, 1.0, amaxvalue, bush, 1
+                )
+            wh23.shadowingfunction_wallheight_23(
+                a,
+                vegdem,
+                vegdem2,
+                45.0,
+                30.0,
+                1.0,
+                amaxvalue,
+                bush,
+                walls,
+                aspect,
+                "numba",
+            )
+            horizon.build_horizon_index(
+                a, 1.0, n_sectors=1, vegdem=vegdem, vegdem2=vegdem2
+            )
+            list(horizon.iter_sky_fractions(a, 1.0, 1, vegdem, vegdem2, bush))
+            wa.filter1Goodwin_as_aspect_v3(wa.findwalls(a, 0), 1.0, a, "numba")
+
+    return report
@@ -0,0 +1,110 @@
+import numpy as np
+from numba import njit
+
+# tile size (pixels) used for early ray termination, a power of two
+PYRAMID_TILE = 64
+
+
+def max_pyramid(a, levels=None):
+    """
+    Quadtree of block maxima. Level l holds the maxima of 2**l x 2**l blocks,
+    level 0 being the grid itself. Odd edges are padded by repeating the last
+    row / column so that maxima are not affected.
+    """
+    pyramid = [a]
+    cur = a
+    while (levels is None and max(cur.shape) > 1) or (
+        levels is not None and len(pyramid) <= levels
+    ):
+        cur = np.pad(cur, ((0, cur.shape[0] % 2), (0, cur.shape[1] % 2)), mode="edge")
+        cur = cur.reshape(cur.shape[0] // 2, 2, cur.shape[1] // 2, 2).max(axis=(1, 3))
+        pyramid.append(cur)
+
+    return pyramid
+
+
+def _blocks(a, tile, fn):
+    # block reduction of a over tile x tile blocks, edges padded by repetition
+    padx = -a.shape[0] % tile
+    pady = -a.shape[1] % tile
+    a = np.pad(a, ((0, padx), (0, pady)), mode="edge")
+    return fn(
+        a.reshape(a.shape[0] // tile, tile, a.shape[1] // tile, tile), axis=(1, 3)
+    )
+
+
+def tile_bounds(a, obstr=(), tile=PYRAMID_TILE):
+    """
+    Per tile obstruction bound (block maxima over the DSM and any further
+    obstructing grids such as vegdem) and lowest surface (block minima of the DSM).
+    """
+    level = int(np.log2(tile))
+    bmax = max_pyramid(a, level)[level]
+    for grid in obstr:
+        bmax = np.maximum(bmax, max_pyramid(grid, level)[level])
+    bmin = _blocks(a, tile, np.min)
+
+    return bmax.astype(np.float64), bmin.astype(np.float64)
+
+
+@njit(cache=True)
+def _tile_stops(bmax, bmin, dxs, dys, dzs, tile, stops):
+    ntx, nty = bmin.shape
+    n = dzs.shape[0]
+    for tx in range(ntx):
+        for ty in range(nty):
+            # suffix max over the remaining in-grid ray footprint, which drops by dz
+            h = -np.inf
+            # the shadow functions pad outside of the grid with an absolute zero,
+            # the last tiles are taken as leaving the grid as they may be partial
+            outside = False
+            stop = n
+            for k in range(n - 1, -1, -1):
+                rx0 = (tx * tile + dxs[k]) // tile
+                rx1 = (tx * tile + dxs[k] + tile - 1) // tile
+                ry0 = (ty * tile + dys[k]) // tile
+                ry1 = (ty * tile + dys[k] + tile - 1) // tile
+                if rx0 < 0 or rx1 >= ntx - 1 or ry0 < 0 or ry1 >= nty - 1:
+                    outside = True
+                for bx in range(max(rx0, 0), min(rx1, ntx - 1) + 1):
+                    for by in range(max(ry0, 0), min(ry1, nty - 1) + 1):
+                        h = max(h, bmax[bx, by])
+                # previous step drop covers the pergola condition of the veg schemes
+                dzprev = dzs[k - 1] if k > 0 else 0.0
+                reach = h - dzprev
+                if outside and reach < 0.0:
+                    reach = 0.0
+                if reach <= bmin[tx, ty]:
+                    stop = k
+                else:
+                    break
+            # always run the first step, it initialises the vegetation shadows
+            stops[tx, ty] = max(stop, 1)
+
+
+def tile_stops(bounds, dxs, dys, dzs, tile=PYRAMID_TILE):
+    """
+    Number of ray marching steps after which no obstruction can reach any pixel of
+    each tile, i.e. the remaining steps cannot change the result for that tile.
+    """
+    bmax, bmin = bounds
+    stops = np.empty(bmin.shape, dtype=np.int64)
+    _tile_stops(bmax, bmin, dxs, dys, dzs, tile, stops)
+
+    return stops
+
+
+def active_window(stops, k, tile, sizex, sizey):
+    """
+    Bounding window (row0, row1, col0, col1) of the tiles still marching at step
+    k, or None when all tiles are done.
+    """
+    tx, ty = np.nonzero(stops > k)
+    if tx.shape[0] == 0:
+        return None
+    return (
+        tx.min() * tile,
+        min((tx.max() + 1) * tile, sizex),
+        ty.min() * tile,
+        min((ty.max() + 1) * tile, sizey),
+    )
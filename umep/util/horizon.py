@@ -0,0 +1,429 @@
+import numpy as np
+from numba import njit, prange
+
+from umep.util import shadowmask
+from umep.util.shadowingfunctions import shadow_steps
+
+# horizon angles are quantised to uint8 steps over 0 - 90 degrees
+HORIZON_QUANT = 90.0 / 255.0
+
+
+@njit(parallel=True, cache=True)
+def _horizon_ray(a, scale, amaxvalue, dxs, dys, dss, tanmin, out):
+    # Maximum obstruction elevation (as tangent) for each pixel along one ray, 0
+    # where it is below tanmin. The march stops per pixel once no remaining
+    # obstruction could raise the angle
+    # Outside the grid the shadow functions pad with zeros, which shades cells
+    # below zero if the ray reaches the edge before dz exceeds amaxvalue
+    sizex = a.shape[0]
+    sizey = a.shape[1]
+    for i in prange(sizex):
+        for j in range(sizey):
+            aij = a[i, j]
+            best = tanmin
+            for k in range(1, dss.shape[0]):
+                if (amaxvalue - aij) * scale <= best * dss[k]:
+                    break
+                x = i + dxs[k]
+                y = j + dys[k]
+                if x < 0 or x >= sizex or y < 0 or y >= sizey:
+                    if aij < 0.0 and amaxvalue >= 0.0:
+                        if dss[k - 1] == 0.0:
+                            best = np.inf
+                        else:
+                            best = max(best, amaxvalue * scale / dss[k - 1])
+                    break
+                tanangle = (a[x, y] - aij) * scale / dss[k]
+                best = max(best, tanangle)
+            out[i, j] = best if best > tanmin else 0.0
+
+
+@njit(parallel=True, cache=True)
+def _canopy_ray(a, vegdem, vegdem2, scale, amaxvalue, dxs, dys, dss, tanmin, hi, lo):
+    # Vegetation shadow of shadowingfunction_20 along one ray. At step k the sun is
+    # blocked by the canopy for tan(altitude) in [lo_k, hi_k), from the trunk zone
+    # top (vegdem2) at this step up to the canopy top (vegdem) at the previous one
+    # (the pergola condition). hi is the largest hi_k and lo the smallest lo_k
+    # of the steps that block any altitude above tanmin, hi is 0 without such steps
+    # The march stops once no remaining step could raise hi or lower lo below tanmin
+    sizex = a.shape[0]
+    sizey = a.shape[1]
+    for i in prange(sizex):
+        for j in range(sizey):
+            aij = a[i, j]
+            best = tanmin
+            low = np.inf
+            for k in range(dss.shape[0]):
+                prev = dss[k - 1] if k > 0 else 0.0
+                bound = (amaxvalue - aij) * scale
+                if bound <= tanmin * prev or (bound <= best * prev and low < tanmin):
+                    break
+                x = i + dxs[k]
+                y = j + dys[k]
+                if x < 0 or x >= sizex or y < 0 or y >= sizey:
+                    # the zero padding never gives vegetation shadow
+                    break
+                top = vegdem[x, y] - aij
+                bottom = vegdem2[x, y] - aij
+                if prev > 0.0:
+                    tanhi = top * scale / prev
+                else:
+                    tanhi = np.inf if top > 0.0 else -np.inf
+                if dss[k] > 0.0:
+                    tanlo = bottom * scale / dss[k]
+                else:
+                    tanlo = np.inf if bottom > 0.0 else -np.inf
+                if tanhi > tanlo and tanhi > tanmin:
+                    best = max(best, tanhi)
+                    low = min(low, tanlo)
+            hi[i, j] = best if best > tanmin else 0.0
+            lo[i, j] = low
+
+
+@njit(cache=True)
+def _level(tangent):
+    # first HORIZON_QUANT altitude level at or above an angle given as tangent
+    if tangent <= 0.0:
+        return 0
+    level = np.ceil(np.arctan(tangent) * 180.0 / np.pi / (90.0 / 255.0))
+    return int(min(level, 256.0))
+
+
+@njit(parallel=True, cache=True)
+def _sky_ray(
+    a,
+    vegdem,
+    vegdem2,
+    bushplant,
+    scale,
+    amaxvalue,
+    vegmax,
+    dxs,
+    dys,
+    dss,
+    tanmin,
+    opensky,
+    sky,
+    vegsky,
+    avegsky,
+):
+    # Sky fractions of one ray with the vegetation shadows of shadowingfunction_20
+    # The altitude levels blocked by the canopy at each step ([lo_k, hi_k) of
+    # _canopy_ray) are marked, and separately those not yet behind the building
+    # horizon up to the step (vegetation blocking building shadow, vbshvegsh)
+    # opensky[l] is the fraction of the sky above level l (cos(altitude) ** 2),
+    # sky the fraction above the building horizon, vegsky and avegsky one minus
+    # the fractions blocked by vegetation above and in front of the buildings
+    sizex = a.shape[0]
+    sizey = a.shape[1]
+    for i in prange(sizex):
+        marks = np.zeros(258, dtype=np.int64)
+        front = np.zeros(258, dtype=np.int64)
+        for j in range(sizey):
+            aij = a[i, j]
+            first = 257
+            last = 0
+            if bushplant[i, j]:
+                marks[0] += 1
+                marks[256] -= 1
+                front[0] += 1
+                front[256] -= 1
+                first = 0
+                last = 256
+            best = tanmin
+            for k in range(dss.shape[0]):
+                prev = dss[k - 1] if k > 0 else 0.0
+                # the remaining canopy could only block altitudes below the
+                # building horizon, which are not before the buildings either
+                if (amaxvalue - aij) * scale <= best * dss[k] and (
+                    vegmax - aij
+                ) * scale <= best * prev:
+                    break
+                x = i + dxs[k]
+                y = j + dys[k]
+                if x < 0 or x >= sizex or y < 0 or y >= sizey:
+                    # same zero padding as _horizon_ray
+                    if aij < 0.0 and amaxvalue >= 0.0:
+                        if prev == 0.0:
+                            best = np.inf
+                        else:
+                            best = max(best, amaxvalue * scale / prev)
+                    break
+                if k > 0:
+                    best = max(best, (a[x, y] - aij) * scale / dss[k])
+                top = vegdem[x, y] - aij
+                bottom = vegdem2[x, y] - aij
+                if prev > 0.0:
+                    tanhi = top * scale / prev
+                else:
+                    tanhi = np.inf if top > 0.0 else -np.inf
+                if dss[k] > 0.0:
+                    tanlo = bottom * scale / dss[k]
+                else:
+                    tanlo = np.inf if bottom > 0.0 else -np.inf
+                if tanhi > tanlo and tanhi > tanmin:
+                    hi = _level(tanhi)
+                    lo = _level(tanlo)
+                    if lo < hi:
+                        marks[lo] += 1
+                        marks[hi] -= 1
+                        first = min(first, lo)
+                        last = max(last, hi)
+                    lo = max(lo, _level(best))
+                    if lo < hi:
+                        front[lo] += 1
+                        front[hi] -= 1
+            bldg = _level(best) if best > tanmin else 0
+            sky[i, j] = opensky[bldg]
+            blocked = 0.0
+            ablocked = 0.0
+            covered = 0
+            acovered = 0
+            for level in range(first, last):
+                covered += marks[level]
+                acovered += front[level]
+                width = opensky[level] - opensky[level + 1]
+                if level >= bldg and covered > 0:
+                    blocked += width
+                if level < bldg and acovered > 0:
+                    ablocked += width
+            vegsky[i, j] = 1.0 - blocked
+            avegsky[i, j] = 1.0 - ablocked
+            for level in range(first, min(last + 1, 258)):
+                marks[level] = 0
+                front[level] = 0
+
+
+def _sector_steps(azimuth, sizex, sizey):
+    # Same ray discretisation as shadowingfunction_20, marched to the grid edge
+    dxs, dys, _, dss = shadow_steps(
+        azimuth % 360.0, 0.0, 1.0, sizex, sizey, np.inf, index=0.0, distances=True
+    )
+    return dxs, dys, dss
+
+
+def _sector_rays(centre, width, sub_rays):
+    # Azimuths of the rays spanning a sector: its edges, sub_rays - 1 rays between
+    # them and the octant boundaries where the ray discretisation changes axis
+    # With the step length ds of an azimuth (1 / max(|sin|, |cos|)), which is
+    # monotonic between neighbouring rays, the horizon tangents of a ray are scaled
+    # by ds / min ds and ds / max ds over its neighbourhood in the sector to bound
+    # those of any azimuth in between from above and below
+    if sub_rays == 0:
+        return np.array([centre]), np.ones(1), np.ones(1)
+    start = centre - width / 2.0
+    edges = start + np.arange(sub_rays + 1) * (width / sub_rays)
+    octants = 45.0 * np.arange(np.ceil(start / 45.0), np.floor(edges[-1] / 45.0) + 1)
+    angles = np.unique(np.round(np.concatenate((edges, octants)), 9))
+    radians = np.radians(angles)
+    ds = 1.0 / np.maximum(np.abs(np.sin(radians)), np.abs(np.cos(radians)))
+    before = np.concatenate((ds[:1], ds[:-1]))
+    after = np.concatenate((ds[1:], ds[-1:]))
+    dsmin = np.minimum(np.minimum(before, after), ds)
+    dsmax = np.maximum(np.maximum(before, after), ds)
+    return angles, ds / dsmin, ds / dsmax
+
+
+def _quantise(tangent, rounding):
+    # tangents as uint8 angle steps, rounded up or down
+    angle = np.degrees(np.arctan(tangent)) / HORIZON_QUANT
+    return np.clip(rounding(angle), 0, 255).astype(np.uint8)
+
+
+def build_horizon_index(
+    dsm, scale, n_sectors=72, vegdem=None, vegdem2=None, bush=None, sub_rays=4
+):
+    """
+    Precomputes a per-pixel horizon index from a DSM and optionally a CDSM.
+
+    For each of n_sectors azimuth sectors (centred on 0, 360 / n_sectors, ...
+    degrees) the maximum obstruction elevation angle over the sector is stored as
+    uint8 in steps of 90 / 255 degrees, rounded up. It is taken over sub_rays + 1
+    rays spanning the sector, which follow the discretisation of the shadow
+    functions including the zero padding outside the grid. For an azimuth between
+    two neighbouring rays each step of the shadow functions' ray lands on a cell
+    of one of them while k * (tan(b) - tan(a)) < 1, with k the step and a, b the
+    azimuths of the rays measured from the nearest axis. Lookups therefore never
+    give sun where the exact kernel gives shadow from obstructions within
+    1 / (tan(b) - tan(a)) pixels: 23 pixels near the diagonals (45 near the axes)
+    with the default 72 sectors and 4 sub rays. Further away an obstruction
+    narrower than k * (tan(b) - tan(a)) pixels can fall between the rays. On the
+    256 pixel block city of umep.util.benchmark no shadow was lost at 40 random
+    sun positions with the defaults, against 0.7 % of the pixels with sub_rays=0,
+    which casts a single ray at the sector centre.
+
+    dsm = digital surface model
+    scale = scale of DSM (1 meter pixels=1, 2 meter pixels=0.5)
+    vegdem = vegetation canopy DSM, already offset by the DSM
+    vegdem2 = vegetation trunk zone DSM, already offset by the DSM, zero (no trunk
+    zone) if None
+    bush = bush grid, bush pixels are treated as always in vegetation shadow
+
+    Vegetation shadows follow shadowingfunction_20 with the pergola condition: the
+    sun is blocked where a ray passes the canopy but not below it through the
+    trunk zone. The sector's blocked altitudes are bounded by "veg", the largest
+    (rounded up), and "trunk", the smallest (rounded down) altitude blocked by any
+    tree, so a low sun below the canopy of nearby trees is sunlit unless other
+    trees along the sector block it.
+
+    Returns a dict with "bldg" (and "veg" and "trunk") arrays of shape
+    (n_sectors, rows, cols) and the "sectors" azimuths in degrees.
+    """
+    sizex, sizey = dsm.shape
+    dsm = dsm.astype(np.float64)
+    width = 360.0 / n_sectors
+    sectors = np.arange(n_sectors) * width
+    tanmin = np.tan(HORIZON_QUANT * np.pi / 180.0)
+    bldg = np.zeros((n_sectors, sizex, sizey), dtype=np.uint8)
+    veg = None
+    amaxvalue = dsm.max()
+    if vegdem is not None:
+        vegdem = vegdem.astype(np.float64)
+        if vegdem2 is None:
+            vegdem2 = np.zeros_like(vegdem)
+        vegdem2 = vegdem2.astype(np.float64)
+        veg = np.zeros((n_sectors, sizex, sizey), dtype=np.uint8)
+        trunk = np.zeros((n_sectors, sizex, sizey), dtype=np.uint8)
+        amaxvalue = max(amaxvalue, vegdem.max())
+
+    def cast(azimuth):
+        dxs, dys, dss = _sector_steps(azimuth, sizex, sizey)
+        rays = [np.empty((sizex, sizey))]
+        _horizon_ray(dsm, scale, amaxvalue, dxs, dys, dss, tanmin, rays[0])
+        if veg is not None:
+            rays += [np.empty((sizex, sizey)), np.empty((sizex, sizey))]
+            _canopy_ray(
+                dsm, vegdem, vegdem2, scale, amaxvalue, dxs, dys, dss, tanmin, *rays[1:]
+            )
+        return rays
+
+    last = None
+    for s, centre in enumerate(sectors):
+        angles, up, down = _sector_rays(centre, width, sub_rays)
+        bldgmax = np.zeros((sizex, sizey))
+        vegmax = np.zeros((sizex, sizey))
+        trunkmin = np.full((sizex, sizey), np.inf)
+        for r, azimuth in enumerate(angles):
+            # the first edge of a sector is the last edge of the previous one
+            rays = (
+                last if r == 0 and last is not None and sub_rays > 0 else cast(azimuth)
+            )
+            np.maximum(bldgmax, rays[0] * up[r], out=bldgmax)
+            if veg is not None:
+                np.maximum(vegmax, rays[1] * up[r], out=vegmax)
+                low = np.where(rays[2] < 0.0, rays[2] * up[r], rays[2] * down[r])
+                np.minimum(trunkmin, low, out=trunkmin)
+        last = rays
+        bldg[s] = _quantise(bldgmax, np.ceil)
+        if veg is not None:
+            veg[s] = _quantise(vegmax, np.ceil)
+            trunk[s] = _quantise(trunkmin, np.floor)
+            if bush is not None:
+                veg[s][bush > 1.0] = 255
+                trunk[s][bush > 1.0] = 0
+
+    index = {"bldg": bldg, "sectors": sectors}
+    if veg is not None:
+        index["veg"] = veg
+        index["trunk"] = trunk
+
+    return index
+
+
+def iter_sky_fractions(dsm, scale, n_sectors=72, vegdem=None, vegdem2=None, bush=None):
+    """
+    Sky fractions of each azimuth sector for horizon SVFs, cast along a ray at
+    the sector centre.
+
+    Yields the sector azimuth and a dict of the fractions of the sector's sky (as
+    cos(h) ** 2 over altitude steps of HORIZON_QUANT) above the building horizon
+    ("sky") and, with vegetation, one minus those blocked by the canopy above the
+    building horizon ("vegsky") and in front of the buildings below it
+    ("avegsky"), as vegsh and vbshvegsh of shadowingfunction_20 including the
+    trunk zone. The building horizon is the one of build_horizon_index with
+    sub_rays=0.
+
+    vegdem, vegdem2 and bush as for build_horizon_index.
+    """
+    sizex, sizey = dsm.shape
+    dsm = dsm.astype(np.float64)
+    tanmin = np.tan(HORIZON_QUANT * np.pi / 180.0)
+    opensky = np.zeros(257)
+    opensky[:256] = np.cos(np.radians(np.arange(256) * HORIZON_QUANT)) ** 2
+    amaxvalue = dsm.max()
+    if vegdem is not None:
+        vegdem = vegdem.astype(np.float64)
+        if vegdem2 is None:
+            vegdem2 = np.zeros_like(vegdem)
+        vegdem2 = vegdem2.astype(np.float64)
+        bushplant = np.zeros(dsm.shape, dtype=np.bool_) if bush is None else bush > 1.0
+        vegmax = vegdem.max()
+        amaxvalue = max(amaxvalue, vegmax)
+    for azimuth in np.arange(n_sectors) * (360.0 / n_sectors):
+        dxs, dys, dss = _sector_steps(azimuth, sizex, sizey)
+        if vegdem is None:
+            ray = np.empty((sizex, sizey))
+            _horizon_ray(dsm, scale, amaxvalue, dxs, dys, dss, tanmin, ray)
+            yield azimuth, {"sky": opensky[_quantise(ray, np.ceil)]}
+            continue
+        fractions = {
+            name: np.empty((sizex, sizey)) for name in ("sky", "vegsky", "avegsky")
+        }
+        _sky_ray(
+            dsm,
+            vegdem,
+            vegdem2,
+            bushplant,
+            scale,
+            amaxvalue,
+            vegmax,
+            dxs,
+            dys,
+            dss,
+            tanmin,
+            opensky,
+            *fractions.values(),
+        )
+        yield azimuth, fractions
+
+
+def save_horizon_index(path, index):
+    np.savez_compressed(path, **index)
+
+
+def load_horizon_index(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def sector_of(index, azimuth):
+    # nearest sector for an azimuth in degrees
+    n_sectors = index["sectors"].shape[0]
+    return int(np.round(azimuth / (360.0 / n_sectors))) % n_sectors
+
+
+def horizon_shadows(index, azimuth, altitude, mask_format="float"):
+    """
+    Shadows for a sun position by comparison against the horizon index.
+
+    Follows the shadow functions' convention: "sh" is 1 where sunlit and 0 in
+    building shadow, "vegsh" (with a vegetation index) is 0 in vegetation shadow
+    that is not already building shadow, between the "trunk" and "veg" angles.
+    Grids are given in mask_format, see shadowmask.
+    """
+    s = sector_of(index, azimuth)
+    altq = altitude / HORIZON_QUANT
+    bldgshade = index["bldg"][s] > altq
+    result = {"sh": shadowmask.encode(1.0 - bldgshade, mask_format)}
+    if "veg" in index:
+        vegshade = (index["veg"][s] > altq) & (index["trunk"][s] <= altq)
+        vegshade &= np.logical_not(bldgshade)
+        result["vegsh"] = shadowmask.encode(1.0 - vegshade, mask_format)
+
+    return result
+
+
+def iter_horizon_shadows(index, azimuths, altitudes, mask_format="float"):
+    # Same yield contract as shadowbatch.iter_shadows
+    for idx, (azimuth, altitude) in enumerate(zip(azimuths, altitudes)):
+        yield idx, horizon_shadows(index, azimuth, altitude, mask_format)
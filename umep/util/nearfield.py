@@ -0,0 +1,338 @@
+import time
+
+import numpy as np
+
+from umep.util import heightpyramid as hp
+from umep.util import shadowingfunctions as shadow
+from umep.util import shadowmask
+
+# the far field is cast on blocks of 2**FAR_LEVEL pixels, a divisor of
+# tiling.TILE_ALIGN so that tiles start on whole blocks
+FAR_LEVEL = 2
+
+
+def near_amaxvalue(amaxvalue, altitude, near_radius):
+    """
+    Height drop of the ray at near_radius meters for a sun altitude in degrees.
+    Passed as amaxvalue it stops the exact ray march at the near field radius.
+    """
+    return min(amaxvalue, near_radius * np.tan(np.radians(altitude)))
+
+
+def _upsample(grid, block, shape):
+    # block values repeated over their pixels, cropped to the fine grid
+    return np.repeat(np.repeat(grid, block, axis=0), block, axis=1)[
+        : shape[0], : shape[1]
+    ]
+
+
+def _pair_max(grid, block):
+    # maxima of the 2 x 2 blocks from block (i - 1, j - 1), for i, j in 0..n, with
+    # the blocks off the grid at -inf. A pixel shifted by d lands in the blocks
+    # (d // block) + {0, 1} of its own block.
+    coarse = hp.max_pyramid(grid, int(np.log2(block)))[-1].astype(np.float64)
+    padded = np.pad(coarse, 1, constant_values=-np.inf)
+    return np.maximum(
+        np.maximum(padded[:-1, :-1], padded[1:, :-1]),
+        np.maximum(padded[:-1, 1:], padded[1:, 1:]),
+    )
+
+
+def _pair_floor(shape):
+    # 0 where the 2 x 2 blocks reach off the grid, where the shadow functions pad
+    # with an absolute zero, -inf elsewhere. The last blocks may be partial.
+    edge = np.zeros((shape[0] + 2, shape[1] + 2), dtype=bool)
+    edge[[0, -2, -1], :] = True
+    edge[:, [0, -2, -1]] = True
+    pair = edge[:-1, :-1] | edge[1:, :-1] | edge[:-1, 1:] | edge[1:, 1:]
+    return np.where(pair, 0.0, -np.inf)
+
+
+def far_field(grids, azimuth, altitude, scale, amaxvalue, near_radius, level=FAR_LEVEL):
+    """
+    Far field ray heights on the block maxima of each grid (DSM, canopy DSM), for
+    the ray steps the near field march to near_radius meters does not take.
+
+    Returns, per grid, the highest obstruction minus the height drop over the far
+    field steps, at the native resolution. A pixel is shaded by the far field where
+    this is above its height. The far field is conservative: each native step reads
+    the maxima of the 2 x 2 blocks that hold the pixels it lands on, zero where
+    these reach off the grid, less its exact drop. Steps landing on the same blocks
+    are cast once with their smallest drop. Errors are extra shade only.
+    """
+    block = 2**level
+    sizex, sizey = grids[0].shape
+    dxs, dys, dzs = shadow.shadow_steps(
+        azimuth, altitude, scale, sizex, sizey, amaxvalue
+    )
+    # the near field march takes the steps up to the first one beyond its drop
+    nearsteps = np.searchsorted(
+        dzs, near_amaxvalue(amaxvalue, altitude, near_radius), side="right"
+    )
+    offsets = np.stack((dxs, dys), axis=1)[nearsteps + 1 :] // block
+    offsets, inverse = np.unique(offsets, axis=0, return_inverse=True)
+    drops = np.full(offsets.shape[0], np.inf)
+    np.minimum.at(drops, inverse.ravel(), dzs[nearsteps + 1 :])
+
+    pairs = [_pair_max(grid, block) for grid in grids]
+    floor = _pair_floor((pairs[0].shape[0] - 1, pairs[0].shape[1] - 1))
+    nx = pairs[0].shape[0] - 1
+    ny = pairs[0].shape[1] - 1
+    heights = [np.full((nx, ny), -np.inf) for _ in grids]
+    temp = np.zeros((nx, ny))
+    for (dx, dy), dz in zip(offsets, drops):
+        # pair index of block i shifted by dx is i + dx + 1
+        x0 = max(-dx - 1, 0)
+        x1 = min(nx - dx, nx)
+        y0 = max(-dy - 1, 0)
+        y1 = min(ny - dy, ny)
+        for pair, height in zip(pairs, heights):
+            # pairs entirely off the grid read the zero padding
+            temp[:] = 0.0
+            if x0 < x1 and y0 < y1:
+                np.fmax(
+                    pair[x0 + dx + 1 : x1 + dx + 1, y0 + dy + 1 : y1 + dy + 1] - dz,
+                    floor[x0 + dx + 1 : x1 + dx + 1, y0 + dy + 1 : y1 + dy + 1],
+                    out=temp[x0:x1, y0:y1],
+                )
+            np.fmax(height, temp, out=height)
+
+    return [_upsample(height, block, grids[0].shape) for height in heights]
+
+
+def shadowingfunctionglobalradiation_hybrid(
+    a,
+    azimuth,
+    altitude,
+    scale,
+    near_radius,
+    backend="numpy",
+    bounds=None,
+    mask_format="float",
+    amaxvalue=None,
+    level=FAR_LEVEL,
+):
+    """
+    shadowingfunctionglobalradiation with the exact ray march limited to
+    near_radius meters and the far field cast on blocks of 2**level pixels.
+    """
+    if amaxvalue is None:
+        amaxvalue = a.max()
+    sunlit = shadow.shadowingfunctionglobalradiation(
+        a,
+        azimuth,
+        altitude,
+        scale,
+        1,
+        backend,
+        bounds,
+        "bool",
+        near_amaxvalue(amaxvalue, altitude, near_radius),
+    )
+    (farbldg,) = far_field(
+        (a,), azimuth, altitude, scale, amaxvalue, near_radius, level
+    )
+    sunlit &= ~(farbldg > a)
+    if mask_format != "float":
+        return shadowmask.encode(sunlit, mask_format)
+
+    return sunlit.astype(np.float64)
+
+
+def shadowingfunction_20_hybrid(
+    a,
+    vegdem,
+    vegdem2,
+    azimuth,
+    altitude,
+    scale,
+    amaxvalue,
+    bush,
+    near_radius,
+    backend="numpy",
+    bushplant=None,
+    bounds=None,
+    mask_format="float",
+    level=FAR_LEVEL,
+):
+    """
+    shadowingfunction_20 with the exact ray march limited to near_radius meters and
+    the far field cast on blocks of 2**level pixels, returning the same dict.
+
+    In the far field canopies shade as solid blocks (the trunk zone is not seen
+    through) and vegetation behind buildings is resolved against the near field
+    building shadows. No shaded pixel is sunlit (sh and vegsh together), but a
+    pixel moved into building shadow by the far field is no longer counted in
+    vegsh, which shows as false sun of vegsh in near_field_report.
+    """
+    near = shadow.shadowingfunction_20(
+        a,
+        vegdem,
+        vegdem2,
+        azimuth,
+        altitude,
+        scale,
+        near_amaxvalue(amaxvalue, altitude, near_radius),
+        bush,
+        1,
+        backend,
+        bushplant,
+        bounds,
+    )
+    farbldg, farveg = far_field(
+        (a, vegdem), azimuth, altitude, scale, amaxvalue, near_radius, level
+    )
+    nearsh = near["sh"] == 0
+    nearveg = near["vegsh"] == 0
+    shaded = nearsh | (farbldg > a)
+    vegfar = farveg > a
+    vegshaded = (nearveg | vegfar) & ~shaded
+    # vegetation reached by the ray before a building (vbshvegsh of the exact kernel)
+    vegseen = (near["vbshvegsh"] == 0) | nearveg | (vegfar & ~nearsh)
+    vbshvegsh = 1.0 - (vegseen.astype(np.float64) - vegshaded)
+
+    return {
+        "sh": shadowmask.encode(
+            np.logical_not(shaded).astype(near["sh"].dtype), mask_format
+        ),
+        "vegsh": shadowmask.encode(
+            np.logical_not(vegshaded).astype(np.float64), mask_format
+        ),
+        "vbshvegsh": shadowmask.encode(vbshvegsh, mask_format),
+    }
+
+
+def near_field_report(
+    a,
+    azimuths,
+    altitudes,
+    scale,
+    near_radius,
+    vegdem=None,
+    vegdem2=None,
+    amaxvalue=None,
+    bush=None,
+    backend="numpy",
+    level=FAR_LEVEL,
+):
+    """
+    Error and runtime of the near field mode against the exact shadow functions.
+
+    Returns a dict with a record per sun position holding the fraction of pixels
+    of each shadow grid that differ ("sh" and, with vegetation, "vegsh"), split in
+    pixels wrongly shaded ("false_shade") and wrongly sunlit ("false_sun"), and the
+    exact and hybrid seconds. "mean_error", "max_error" (ground shadows) and the
+    overall "speedup" summarise the records.
+    """
+    azimuths = np.atleast_1d(np.asarray(azimuths, dtype=float))
+    altitudes = np.atleast_1d(np.asarray(altitudes, dtype=float))
+    if azimuths.shape != altitudes.shape:
+        raise ValueError("Azimuths and altitudes must be of the same length.")
+    if (vegdem is None) != (vegdem2 is None):
+        raise ValueError("Both vegdem and vegdem2 are required for vegetation shadows.")
+    if vegdem is not None and bush is None:
+        bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    if amaxvalue is None:
+        amaxvalue = a.max()
+        if vegdem is not None:
+            amaxvalue = np.maximum(amaxvalue, vegdem.max())
+    bounds = hp.tile_bounds(a, () if vegdem is None else (vegdem, vegdem2))
+
+    def exact_shadows(azimuth, altitude):
+        if vegdem is None:
+            return {
+                "sh": shadow.shadowingfunctionglobalradiation(
+                    a, azimuth, altitude, scale, 1, backend, bounds, "float", amaxvalue
+                )
+            }
+        return shadow.shadowingfunction_20(
+            a,
+            vegdem,
+            vegdem2,
+            azimuth,
+            altitude,
+            scale,
+            amaxvalue,
+            bush,
+            1,
+            backend,
+            None,
+            bounds,
+        )
+
+    def hybrid_shadows(azimuth, altitude):
+        if vegdem is None:
+            return {
+                "sh": shadowingfunctionglobalradiation_hybrid(
+                    a,
+                    azimuth,
+                    altitude,
+                    scale,
+                    near_radius,
+                    backend,
+                    bounds,
+                    "float",
+                    amaxvalue,
+                    level,
+                )
+            }
+        return shadowingfunction_20_hybrid(
+            a,
+            vegdem,
+            vegdem2,
+            azimuth,
+            altitude,
+            scale,
+            amaxvalue,
+            bush,
+            near_radius,
+            backend,
+            None,
+            bounds,
+            "float",
+            level,
+        )
+
+    if azimuths.shape[0]:
+        # untimed calls, so that neither mode pays for loading the kernels
+        exact_shadows(azimuths[0], altitudes[0])
+        hybrid_shadows(azimuths[0], altitudes[0])
+
+    records = []
+    for azimuth, altitude in zip(azimuths, altitudes):
+        start = time.perf_counter()
+        exact = exact_shadows(azimuth, altitude)
+        exact_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        hybrid = hybrid_shadows(azimuth, altitude)
+        hybrid_seconds = time.perf_counter() - start
+        record = {
+            "azimuth": float(azimuth),
+            "altitude": float(altitude),
+            "exact_seconds": exact_seconds,
+            "hybrid_seconds": hybrid_seconds,
+        }
+        for key in exact:
+            # 1 = sunlit in both
+            sunlit = exact[key] != 0
+            hybridsunlit = hybrid[key] != 0
+            record[key] = {
+                "error": float(np.mean(sunlit != hybridsunlit)),
+                "false_shade": float(np.mean(sunlit & ~hybridsunlit)),
+                "false_sun": float(np.mean(~sunlit & hybridsunlit)),
+            }
+        records.append(record)
+
+    errors = [record["sh"]["error"] for record in records]
+    exact_total = sum(record["exact_seconds"] for record in records)
+    hybrid_total = sum(record["hybrid_seconds"] for record in records)
+    return {
+        "near_radius": near_radius,
+        "block": 2**level,
+        "mean_error": float(np.mean(errors)) if errors else 0.0,
+        "max_error": float(np.max(errors)) if errors else 0.0,
+        "exact_seconds": exact_total,
+        "hybrid_seconds": hybrid_total,
+        "speedup": exact_total / hybrid_total if hybrid_total > 0 else None,
+        "positions": records,
+    }
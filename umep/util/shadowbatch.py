@@ -0,0 +1,507 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from umep.util import compilation, nearfield, shadowcache, shadowmask
+from umep.util import heightpyramid as hp
+from umep.util import shadowingfunctions as shadow
+from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_13 import (
+    shadowingfunction_wallheight_13,
+)
+from umep.util.SEBESOLWEIGCommonFiles.shadowingfunction_wallheight_23 import (
+    shadowingfunction_wallheight_23,
+)
+
+# sun positions cast per task in worker processes
+PROCESS_POSITIONS = 8
+# grids attached from shared memory in a worker process
+_SHARED = {}
+
+
+def process_pool(workers, backend, initializer=None, initargs=()):
+    """
+    Pool of worker processes for shadow casting. Workers are spawned rather than
+    forked, forked children can hang on the numba threading layer of the parent.
+    Scripts using worker processes therefore need the usual
+    if __name__ == "__main__": guard.
+    """
+    if backend == "numba":
+        # fills the on-disk cache once, the workers then load the compiled kernels
+        compilation.warmup()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initializer,
+        initargs=initargs,
+    )
+
+
+def _share(grids):
+    # copies the grids to shared memory blocks, returns the blocks and the specs
+    # from which workers attach to them
+    blocks = {}
+    specs = {}
+    for key, grid in grids.items():
+        if grid is None:
+            specs[key] = None
+            continue
+        grid = np.asarray(grid)
+        block = shared_memory.SharedMemory(create=True, size=max(grid.nbytes, 1))
+        np.ndarray(grid.shape, dtype=grid.dtype, buffer=block.buf)[...] = grid
+        blocks[key] = block
+        specs[key] = (block.name, grid.shape, grid.dtype.str)
+    return blocks, specs
+
+
+def _attach(specs):
+    # worker initializer, the blocks are kept referenced for the worker lifetime
+    for key, spec in specs.items():
+        if spec is None:
+            _SHARED[key] = None
+            continue
+        name, shape, dtype = spec
+        block = shared_memory.SharedMemory(name=name)
+        _SHARED[key + "_block"] = block
+        _SHARED[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _shared_task(azimuths, altitudes, scale, backend, params):
+    # shadows for a chunk of sun positions on the shared grids, with the tile
+    # bounds and the site key of the parent
+    state = _state(
+        _SHARED["vegdem"],
+        _SHARED["vegdem2"],
+        _SHARED["bush"],
+        _SHARED["walls"],
+        _SHARED["aspect"],
+        (_SHARED["bmax"], _SHARED["bmin"]),
+        **params,
+    )
+    return [
+        result
+        for _, result in iter_shadows(
+            _SHARED["a"],
+            azimuths,
+            altitudes,
+            scale,
+            backend=backend,
+            workers=1,
+            state=state,
+        )
+    ]
+
+
+def _iter_processes(a, state, azimuths, altitudes, scale, backend, processes):
+    # iter_shadows over a pool of worker processes reading the grids from shared
+    # memory, results are yielded in order
+    grids = {key: state[key] for key in ("vegdem", "vegdem2", "bush", "walls")}
+    grids.update(
+        a=a, aspect=state["aspect"], bmax=state["bounds"][0], bmin=state["bounds"][1]
+    )
+    params = {key: state[key] for key in _PARAMS}
+    blocks, specs = _share(grids)
+    try:
+        with process_pool(processes, backend, _attach, (specs,)) as pool:
+            starts = iter(range(0, len(azimuths), PROCESS_POSITIONS))
+            pending = deque()
+
+            def submit():
+                start = next(starts, None)
+                if start is None:
+                    return
+                chunk = slice(start, start + PROCESS_POSITIONS)
+                future = pool.submit(
+                    _shared_task,
+                    azimuths[chunk],
+                    altitudes[chunk],
+                    scale,
+                    backend,
+                    params,
+                )
+                pending.append((start, future))
+
+            # a bounded number of chunks in flight caps the memory of the results
+            for _ in range(2 * (processes or os.cpu_count() or 1)):
+                submit()
+            while pending:
+                start, future = pending.popleft()
+                results = future.result()
+                submit()
+                for j, result in enumerate(results):
+                    yield start + j, result
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+
+def _cast_one(a, azimuth, altitude, scale, state, backend):
+    # Casts shadows for a single sun position from the shared state
+    if state["walls"] is not None:
+        if state["vegdem"] is not None:
+            vegsh, sh, vbshvegsh, wallsh, wallsun, wallshve, facesh, facesun = (
+                shadowingfunction_wallheight_23(
+                    a,
+                    state["vegdem"],
+                    state["vegdem2"],
+                    azimuth,
+                    altitude,
+                    scale,
+                    state["amaxvalue"],
+                    state["bush"],
+                    state["walls"],
+                    state["aspect"],
+                    backend,
+                    state["bounds"],
+                    state["mask_format"],
+                )
+            )
+            return {
+                "sh": sh,
+                "vegsh": vegsh,
+                "vbshvegsh": vbshvegsh,
+                "wallsh": wallsh,
+                "wallsun": wallsun,
+                "wallshve": wallshve,
+                "facesh": facesh,
+                "facesun": facesun,
+            }
+        sh, wallsh, wallsun, facesh, facesun = shadowingfunction_wallheight_13(
+            a,
+            azimuth,
+            altitude,
+            scale,
+            state["walls"],
+            state["aspect"],
+            state["bounds"],
+            state["mask_format"],
+            state["amaxvalue"],
+        )
+        return {
+            "sh": sh,
+            "wallsh": wallsh,
+            "wallsun": wallsun,
+            "facesh": facesh,
+            "facesun": facesun,
+        }
+    if state["near_radius"] is not None:
+        if state["vegdem"] is not None:
+            return nearfield.shadowingfunction_20_hybrid(
+                a,
+                state["vegdem"],
+                state["vegdem2"],
+                azimuth,
+                altitude,
+                scale,
+                state["amaxvalue"],
+                state["bush"],
+                state["near_radius"],
+                backend,
+                state["bushplant"],
+                state["bounds"],
+                state["mask_format"],
+            )
+        return {
+            "sh": nearfield.shadowingfunctionglobalradiation_hybrid(
+                a,
+                azimuth,
+                altitude,
+                scale,
+                state["near_radius"],
+                backend,
+                state["bounds"],
+                state["mask_format"],
+                state["amaxvalue"],
+            )
+        }
+    if state["vegdem"] is not None:
+        return shadow.shadowingfunction_20(
+            a,
+            state["vegdem"],
+            state["vegdem2"],
+            azimuth,
+            altitude,
+            scale,
+            state["amaxvalue"],
+            state["bush"],
+            1,
+            backend,
+            state["bushplant"],
+            state["bounds"],
+            state["mask_format"],
+        )
+    return {
+        "sh": shadow.shadowingfunctionglobalradiation(
+            a,
+            azimuth,
+            altitude,
+            scale,
+            1,
+            backend,
+            state["bounds"],
+            state["mask_format"],
+            state["amaxvalue"],
+        )
+    }
+
+
+def _cast(a, azimuth, altitude, scale, state, backend):
+    # Casts through the shadow cache when one is given
+    if state["cache"] is None:
+        return _cast_one(a, azimuth, altitude, scale, state, backend)
+    return shadowcache.cached(
+        state["cache"],
+        state["site"],
+        azimuth,
+        altitude,
+        lambda azi, alt: _cast_one(a, azi, alt, scale, state, backend),
+    )
+
+
+# scalar state passed on to worker processes
+_PARAMS = ("amaxvalue", "mask_format", "near_radius", "cache", "site")
+
+
+def _state(
+    vegdem,
+    vegdem2,
+    bush,
+    walls,
+    aspect,
+    bounds,
+    amaxvalue,
+    mask_format,
+    near_radius,
+    cache,
+    site,
+):
+    return {
+        "vegdem": vegdem,
+        "vegdem2": vegdem2,
+        "amaxvalue": amaxvalue,
+        "bush": bush,
+        "bushplant": None if bush is None else bush > 1.0,
+        "walls": walls,
+        "aspect": aspect,
+        "bounds": bounds,
+        "mask_format": mask_format,
+        "near_radius": near_radius,
+        "cache": cache,
+        "site": site,
+    }
+
+
+def prepare_shadows(
+    a,
+    scale,
+    vegdem=None,
+    vegdem2=None,
+    amaxvalue=None,
+    bush=None,
+    walls=None,
+    aspect=None,
+    mask_format="float",
+    near_radius=None,
+    cache=None,
+):
+    """
+    DSM level state of iter_shadows: amaxvalue, bushplant, the tile height bounds
+    for early ray termination, the wall arrays and the site key of the shadow
+    cache. Preparing it once spares callers that cast one position per call (as
+    SOLWEIG timesteps) the bounds and the hashing of the grids on every call.
+
+    See iter_shadows for the arguments.
+    """
+    shadowmask.check_mask_format(mask_format)
+    if (vegdem is None) != (vegdem2 is None):
+        raise ValueError("Both vegdem and vegdem2 are required for vegetation shadows.")
+    if (walls is None) != (aspect is None):
+        raise ValueError("Both walls and aspect are required for wall shadows.")
+    if near_radius is not None and walls is not None:
+        raise ValueError(
+            "The near field mode does not support the wall height schemes."
+        )
+    if vegdem is not None and bush is None:
+        bush = np.logical_not(vegdem2 * vegdem) * vegdem
+    if amaxvalue is None:
+        amaxvalue = a.max()
+        if vegdem is not None:
+            amaxvalue = np.maximum(amaxvalue, vegdem.max())
+    site = None
+    if cache is not None:
+        site = shadowcache.site_key(
+            (a, vegdem, vegdem2, bush, walls, aspect),
+            {
+                "scale": float(scale),
+                "amaxvalue": float(amaxvalue),
+                "mask_format": mask_format,
+                "near_radius": near_radius,
+            },
+        )
+
+    return _state(
+        vegdem,
+        vegdem2,
+        bush,
+        walls,
+        aspect,
+        hp.tile_bounds(a, () if vegdem is None else (vegdem, vegdem2)),
+        amaxvalue,
+        mask_format,
+        near_radius,
+        cache,
+        site,
+    )
+
+
+def iter_shadows(
+    a,
+    azimuths,
+    altitudes,
+    scale,
+    vegdem=None,
+    vegdem2=None,
+    amaxvalue=None,
+    bush=None,
+    walls=None,
+    aspect=None,
+    backend="numpy",
+    workers=None,
+    mask_format="float",
+    near_radius=None,
+    cache=None,
+    processes=None,
+    state=None,
+):
+    """
+    Casts shadows for a sequence of sun positions, yielding (index, result) in order.
+
+    The DSM level state (see prepare_shadows) is prepared once and shared across
+    positions. With the numpy backend positions are spread
+    over a pool of worker threads, whereas the numba kernels are already parallel
+    over rows so positions are then cast one after another.
+
+    a = DSM
+    azimuths, altitudes = sun positions in degrees
+    vegdem, vegdem2 = canopy and trunk zone DSMs, already offset by the DSM
+    amaxvalue = maximum obstruction height, computed from a if None
+    bush = bush grid, used for vegetation shadows
+    walls, aspect = wall heights and aspects (radians) for the wall height schemes
+    mask_format = "float", "bool" or "packed" binary shadow grids, see shadowmask
+    near_radius = meters cast exactly, further obstructions are cast on coarser
+        blocks (see nearfield), None for exact shadows
+    cache = shadowcache.open_cache dict to reuse shadows across runs, positions
+        are then cast at the rounded sun position
+    processes = number of worker processes casting chunks of positions on grids
+        held in shared memory, None to cast in this process
+    state = prepare_shadows result for a and scale, reused across calls, which
+        then takes the place of the arguments from vegdem to cache but backend
+        and workers
+
+    Each result is a dict holding "sh" and, when vegetation and / or walls are
+    provided, the same grids as the underlying shadow function.
+    """
+    shadow.check_backend(backend)
+    azimuths = np.atleast_1d(np.asarray(azimuths, dtype=float))
+    altitudes = np.atleast_1d(np.asarray(altitudes, dtype=float))
+    if azimuths.shape != altitudes.shape:
+        raise ValueError("Azimuths and altitudes must be of the same length.")
+    if state is None:
+        state = prepare_shadows(
+            a,
+            scale,
+            vegdem,
+            vegdem2,
+            amaxvalue,
+            bush,
+            walls,
+            aspect,
+            mask_format,
+            near_radius,
+            cache,
+        )
+    if processes is not None:
+        yield from _iter_processes(
+            a, state, azimuths, altitudes, scale, backend, processes
+        )
+        return
+
+    if backend == "numba" or len(azimuths) < 2:
+        for idx in range(len(azimuths)):
+            yield idx, _cast(a, azimuths[idx], altitudes[idx], scale, state, backend)
+        return
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # keep a bounded number of positions in flight to cap memory
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        next_idx = 0
+        for idx in range(len(azimuths)):
+            pending.append(
+                pool.submit(
+                    _cast, a, azimuths[idx], altitudes[idx], scale, state, backend
+                )
+            )
+            if len(pending) >= 2 * workers:
+                yield next_idx, pending.popleft().result()
+                next_idx += 1
+        while pending:
+            yield next_idx, pending.popleft().result()
+            next_idx += 1
+
+
+def shadowingfunction_batch(
+    a,
+    azimuths,
+    altitudes,
+    scale,
+    vegdem=None,
+    vegdem2=None,
+    amaxvalue=None,
+    bush=None,
+    walls=None,
+    aspect=None,
+    backend="numpy",
+    workers=None,
+    mask_format="float",
+    near_radius=None,
+    cache=None,
+):
+    """
+    Casts shadows for arrays of sun positions in a single call.
+
+    See iter_shadows for the arguments. Returns a dict of stacked grids of shape
+    (positions, rows, cols), allocated once for all positions.
+    """
+    n = len(np.atleast_1d(azimuths))
+    stacked = {}
+    for idx, result in iter_shadows(
+        a,
+        azimuths,
+        altitudes,
+        scale,
+        vegdem,
+        vegdem2,
+        amaxvalue,
+        bush,
+        walls,
+        aspect,
+        backend,
+        workers,
+        mask_format,
+        near_radius,
+        cache,
+    ):
+        for key, grid in result.items():
+            if key not in stacked:
+                stacked[key] = np.empty((n,) + grid.shape, dtype=grid.dtype)
+            stacked[key][idx] = grid
+
+    return stacked
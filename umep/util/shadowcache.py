@@ -0,0 +1,138 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+# sun positions are rounded to CACHE_QUANTUM degrees and shadows are cast for the
+# rounded position, so that a cached grid does not depend on the run storing it
+CACHE_QUANTUM = 0.01
+# default cap of the cache directory in bytes
+CACHE_SIZE = 2**30
+# eviction brings the cache down to this fraction of the cap, so that the
+# directory is only scanned once every few writes
+EVICT_TO = 0.8
+
+
+def open_cache(cache_dir, max_bytes=CACHE_SIZE, quantum=CACHE_QUANTUM):
+    """
+    On-disk shadow cache shared by runs on the same site, returned as a dict to pass
+    to shadowbatch.iter_shadows (cache argument).
+
+    cache_dir = directory holding one .npz file per site, quantum and sun position
+    max_bytes = size cap, least recently used positions are removed beyond it
+    quantum = sun position rounding in degrees
+    """
+    if max_bytes <= 0:
+        raise ValueError("The shadow cache size must be positive.")
+    if quantum <= 0:
+        raise ValueError("The sun position quantum must be positive.")
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    cache = {"dir": str(cache_dir), "max_bytes": int(max_bytes), "quantum": quantum}
+    # size of the entries, kept up to date by the writes of this process and
+    # corrected by each eviction scan
+    cache["bytes"] = sum(size for _, size, _ in _entries(cache))
+
+    return cache
+
+
+def site_key(grids, params):
+    """
+    Content hash of the grids (DSM, vegetation, walls...) and parameters a shadow
+    grid depends on. None grids are hashed as such, so that e.g. runs with and
+    without vegetation do not share entries.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for grid in grids:
+        if grid is None:
+            digest.update(b"none")
+            continue
+        grid = np.ascontiguousarray(grid)
+        digest.update(f"{grid.dtype.str}{grid.shape}".encode())
+        digest.update(grid.data)
+    digest.update(repr(sorted(params.items())).encode())
+
+    return digest.hexdigest()
+
+
+def quantise(azimuth, altitude, quantum=CACHE_QUANTUM):
+    # sun position as whole multiples of the quantum
+    return round(float(azimuth / quantum)), round(float(altitude / quantum))
+
+
+def _entries(cache):
+    # (mtime, size, path) of the cache entries
+    entries = []
+    for entry in os.scandir(cache["dir"]):
+        if entry.name.endswith(".npz"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+
+def _evict(cache):
+    # removes the least recently used entries down to EVICT_TO of the size cap
+    entries = sorted(_entries(cache))
+    total = sum(size for _, size, _ in entries)
+    # the newest entry is always kept
+    for _, size, path in entries[:-1]:
+        if total <= cache["max_bytes"] * EVICT_TO:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    cache["bytes"] = total
+
+
+def cached(cache, site, azimuth, altitude, cast):
+    """
+    Shadows for a sun position from the cache, cast with cast(azimuth, altitude) at
+    the rounded position and stored when missing.
+
+    cast = callable returning a dict of grids
+    """
+    quantum = cache["quantum"]
+    qazimuth, qaltitude = quantise(azimuth, altitude, quantum)
+    # positions are multiples of the quantum, which is part of the entry name so
+    # that caches opened with different quanta on one directory do not collide
+    name = f"{site}_{quantum!r}_{qazimuth}_{qaltitude}.npz"
+    path = os.path.join(cache["dir"], name)
+    try:
+        with np.load(path) as data:
+            result = {key: data[key] for key in data.files}
+    except FileNotFoundError:
+        result = None
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        # truncated or corrupt entry, cast again and replaced
+        result = None
+    if result is not None:
+        # recency is kept in the modification time, atime is often not updated
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return result
+
+    result = cast(qazimuth * quantum, qaltitude * quantum)
+    # written aside and moved in place, readers never see partial files
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=cache["dir"])
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, **result)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    # the directory is only scanned once the tracked size passes the cap
+    cache["bytes"] = cache.get("bytes", 0) + os.path.getsize(path)
+    if cache["bytes"] > cache["max_bytes"]:
+        _evict(cache)
+
+    return result
@@ -3,32 +3,36 @@
 import numpy as np
 
 # import matplotlib.pylab as plt
-from numba import njit, types
+from numba import njit, prange, types
 
+from umep.util import heightpyramid as hp
+from umep.util import shadowmask
 
-def shadowingfunctionglobalradiation(a, azimuth, altitude, scale, forsvf):
-    # %This m.file calculates shadows on a DEM
-    # % conversion
+SHADOW_BACKENDS = ("numpy", "numba")
+
+
+def check_backend(backend):
+    if backend not in SHADOW_BACKENDS:
+        raise ValueError(
+            f"Unknown shadow backend '{backend}', expected one of {SHADOW_BACKENDS}"
+        )
+
+
+def shadow_steps(
+    azimuth, altitude, scale, sizex, sizey, amaxvalue, index=1.0, distances=False
+):
+    """
+    Ray marching offsets for a sun position, replicating the main while loop
+    shared by the shadow functions. Azimuth and altitude in degrees.
+
+    Returns integer row and column offsets (dx, dy) and the height drop (dz)
+    for each step so that compiled kernels can march without Python overhead.
+    With distances=True the horizontal distance of each step in pixels is
+    returned as a fourth array.
+    """
     degrees = np.pi / 180.0
-    # if azimuth == 0.0:
-    # azimuth = 0.000000000001
-    azimuth = np.dot(azimuth, degrees)
-    altitude = np.dot(altitude, degrees)
-    # % measure the size of the image
-    sizex = a.shape[0]
-    sizey = a.shape[1]
-    if forsvf == 0:
-        barstep = np.max([sizex, sizey])
-        total = 100.0 / barstep  # dlg.progressBar.setRange(0, barstep)
-    # % initialise parameters
-    f = a
-    dx = 0.0
-    dy = 0.0
-    dz = 0.0
-    temp = np.zeros((sizex, sizey))
-    index = 1.0
-    # % other loop parameters
-    amaxvalue = a.max()
+    azimuth = azimuth * degrees
+    altitude = altitude * degrees
     pibyfour = np.pi / 4.0
     threetimespibyfour = 3.0 * pibyfour
     fivetimespibyfour = 5.0 * pibyfour
@@ -38,13 +42,18 @@ def shadowingfunctionglobalradiation(a, azimuth, altitude, scale, forsvf):
     tanazimuth = np.tan(azimuth)
     signsinazimuth = np.sign(sinazimuth)
     signcosazimuth = np.sign(cosazimuth)
-    dssin = np.abs((1.0 / sinazimuth))
-    dscos = np.abs((1.0 / cosazimuth))
+    with np.errstate(divide="ignore"):
+        dssin = np.abs((1.0 / sinazimuth))
+        dscos = np.abs((1.0 / cosazimuth))
     tanaltitudebyscale = np.tan(altitude) / scale
-    # % main loop
+    dx = 0.0
+    dy = 0.0
+    dz = 0.0
+    dxs = []
+    dys = []
+    dss = []
+    dzs = []
     while amaxvalue >= dz and np.abs(dx) < sizex and np.abs(dy) < sizey:
-        # while np.logical_and(np.logical_and(amaxvalue >= dz, np.abs(dx) <= sizex), np.abs(dy) <= sizey):(np.logical_and(amaxvalue >= dz, np.abs(dx) <= sizex), np.abs(dy) <= sizey):
-        # if np.logical_or(np.logical_and(pibyfour <= azimuth, azimuth < threetimespibyfour), np.logical_and(fivetimespibyfour <= azimuth, azimuth < seventimespibyfour)):
         if (
             pibyfour <= azimuth
             and azimuth < threetimespibyfour
@@ -58,37 +67,153 @@ def shadowingfunctionglobalradiation(a, azimuth, altitude, scale, forsvf):
             dy = signsinazimuth * np.abs(np.round(index * tanazimuth))
             dx = -1.0 * signcosazimuth * index
             ds = dscos
-
-        # % note: dx and dy represent absolute values while ds is an incremental value
         dz = ds * index * tanaltitudebyscale
-        temp[0:sizex, 0:sizey] = 0.0
-        absdx = np.abs(dx)
-        absdy = np.abs(dy)
-        xc1 = (dx + absdx) / 2.0 + 1.0
-        xc2 = sizex + (dx - absdx) / 2.0
-        yc1 = (dy + absdy) / 2.0 + 1.0
-        yc2 = sizey + (dy - absdy) / 2.0
-        xp1 = -((dx - absdx) / 2.0) + 1.0
-        xp2 = sizex - (dx + absdx) / 2.0
-        yp1 = -((dy - absdy) / 2.0) + 1.0
-        yp2 = sizey - (dy + absdy) / 2.0
-        temp[int(xp1) - 1 : int(xp2), int(yp1) - 1 : int(yp2)] = (
-            a[int(xc1) - 1 : int(xc2), int(yc1) - 1 : int(yc2)] - dz
+        dxs.append(dx)
+        dys.append(dy)
+        dss.append(ds * index)
+        dzs.append(dz)
+        index += 1.0
+
+    steps = (
+        np.array(dxs, dtype=np.int64),
+        np.array(dys, dtype=np.int64),
+        np.array(dzs, dtype=np.float64),
+    )
+    if distances:
+        return steps + (np.array(dss, dtype=np.float64),)
+    return steps
+
+
+def shadowingfunctionglobalradiation(
+    a,
+    azimuth,
+    altitude,
+    scale,
+    forsvf,
+    backend: str = "numpy",
+    bounds=None,
+    mask_format: str = "float",
+    amaxvalue=None,
+):
+    # %This m.file calculates shadows on a DEM
+    # bounds = optional precomputed heightpyramid.tile_bounds(a) for early termination
+    # mask_format = "float", "bool" or "packed", see shadowmask
+    # amaxvalue = maximum obstruction height, a.max() if None (e.g. set for tiles)
+    check_backend(backend)
+    shadowmask.check_mask_format(mask_format)
+    # % measure the size of the image
+    sizex = a.shape[0]
+    sizey = a.shape[1]
+    # % ray march steps, each tile stops once its local obstruction bound is passed
+    if amaxvalue is None:
+        amaxvalue = a.max()
+    dxs, dys, dzs = shadow_steps(azimuth, altitude, scale, sizex, sizey, amaxvalue)
+    if bounds is None:
+        bounds = hp.tile_bounds(a)
+    stops = hp.tile_stops(bounds, dxs, dys, dzs)
+    if backend == "numba":
+        # the kernel writes bool masks directly, without a float grid
+        sh = np.empty(
+            (sizex, sizey), dtype=np.float64 if mask_format == "float" else np.bool_
+        )
+        shadowingfunctionglobalradiation_numba(
+            a, dxs, dys, dzs, stops, hp.PYRAMID_TILE, sh
         )
+        return shadowmask.encode(sh, mask_format)
+    # % initialise parameters
+    f = a.astype(np.float64)
+    temp = np.zeros((sizex, sizey))
+    # % main loop
+    for k in range(dzs.shape[0]):
+        window = hp.active_window(stops, k, hp.PYRAMID_TILE, sizex, sizey)
+        if window is None:
+            break
+        r0, r1, c0, c1 = window
+        dx = dxs[k]
+        dy = dys[k]
+        dz = dzs[k]
+        temp[r0:r1, c0:c1] = 0.0
+        # shifted DSM clipped to the active window
+        x0 = max(-dx, 0, r0)
+        x1 = min(sizex - dx, sizex, r1)
+        y0 = max(-dy, 0, c0)
+        y1 = min(sizey - dy, sizey, c1)
+        if x0 < x1 and y0 < y1:
+            temp[x0:x1, y0:y1] = a[x0 + dx : x1 + dx, y0 + dy : y1 + dy] - dz
         # f = np.maximum(f, temp)  # bad performance in python3. Replaced with fmax
-        f = np.fmax(f, temp)
-        index += 1.0
+        f[r0:r1, c0:c1] = np.fmax(f[r0:r1, c0:c1], temp[r0:r1, c0:c1])
 
     f = f - a
     f = np.logical_not(f)
+    if mask_format != "float":
+        return shadowmask.encode(f, mask_format)
     sh = np.double(f)
 
     return sh
 
 
+@njit(parallel=True, cache=True)
+def shadowingfunctionglobalradiation_numba(
+    a: np.ndarray,
+    dxs: np.ndarray,
+    dys: np.ndarray,
+    dzs: np.ndarray,
+    stops: np.ndarray,
+    tile: int,
+    sh: np.ndarray,
+):
+    # Compiled equivalent of shadowingfunctionglobalradiation
+    # Rows are processed in parallel, each keeping a running max over the shifted
+    # DSM for every step from shadow_steps - no per step temporaries are allocated
+    # Each tile of the row only marches up to its stop step from heightpyramid
+    # The shadows are written to sh, a float64 or bool grid
+    sizex = a.shape[0]
+    sizey = a.shape[1]
+    nty = stops.shape[1]
+    for i in prange(sizex):
+        tx = i // tile
+        f = np.empty(sizey, dtype=np.float64)
+        for j in range(sizey):
+            f[j] = a[i, j]
+        rowstop = 0
+        for ty in range(nty):
+            rowstop = max(rowstop, stops[tx, ty])
+        for k in range(rowstop):
+            dx = dxs[k]
+            dy = dys[k]
+            dz = dzs[k]
+            rowin = 0 <= i + dx < sizex
+            for ty in range(nty):
+                if stops[tx, ty] <= k:
+                    continue
+                for j in range(ty * tile, min((ty + 1) * tile, sizey)):
+                    # outside of the shifted DSM the original pads with zeros
+                    if rowin and 0 <= j + dy < sizey:
+                        temp = a[i + dx, j + dy] - dz
+                    else:
+                        temp = 0.0
+                    # same NaN semantics as np.fmax
+                    if temp > f[j] or f[j] != f[j]:
+                        f[j] = temp
+        for j in range(sizey):
+            sh[i, j] = f[j] - a[i, j] == 0.0
+
+
 # @jit(nopython=True)
 def shadowingfunction_20(
-    a, vegdem, vegdem2, azimuth, altitude, scale, amaxvalue, bush, forsvf
+    a,
+    vegdem,
+    vegdem2,
+    azimuth,
+    altitude,
+    scale,
+    amaxvalue,
+    bush,
+    forsvf,
+    backend="numpy",
+    bushplant=None,
+    bounds=None,
+    mask_format="float",
 ):
     # plt.ion()
     # fig = plt.figure(figsize=(24, 7))
@@ -108,11 +233,30 @@ def shadowingfunction_20(
 
     # This function casts shadows on buildings and vegetation units.
     # New capability to deal with pergolas 20210827
-
-    # conversion
-    degrees = np.pi / 180.0
-    azimuth = azimuth * degrees
-    altitude = altitude * degrees
+    # bushplant (bush > 1) and bounds (heightpyramid.tile_bounds) can be passed
+    # precomputed when casting many sun positions
+    # mask_format = "float", "bool" or "packed" for the (binary) outputs, see shadowmask
+
+    check_backend(backend)
+    shadowmask.check_mask_format(mask_format)
+    if bushplant is None:
+        bushplant = bush > 1.0
+    # ray march steps, each tile stops once its local obstruction bound is passed
+    dxs, dys, dzs = shadow_steps(
+        azimuth, altitude, scale, a.shape[0], a.shape[1], amaxvalue, index=0.0
+    )
+    if bounds is None:
+        bounds = hp.tile_bounds(a, (vegdem, vegdem2))
+    stops = hp.tile_stops(bounds, dxs, dys, dzs)
+    if backend == "numba":
+        sh, vegsh, vbshvegsh = shadowingfunction_20_parallel(
+            a, vegdem, vegdem2, bushplant, dxs, dys, dzs, stops, hp.PYRAMID_TILE
+        )
+        return {
+            "sh": shadowmask.encode(sh, mask_format),
+            "vegsh": shadowmask.encode(vegsh, mask_format),
+            "vbshvegsh": shadowmask.encode(vbshvegsh, mask_format),
+        }
 
     # measure the size of grid
     sizex = a.shape[0]
@@ -126,15 +270,11 @@ def shadowingfunction_20(
         # dlg.progressBar.setValue(0)
 
     # initialise parameters
-    dx = 0.0
-    dy = 0.0
-    dz = 0.0
     temp = np.zeros((sizex, sizey), dtype=np.float32)
     tempvegdem = np.zeros((sizex, sizey), dtype=np.float32)
     tempvegdem2 = np.zeros((sizex, sizey), dtype=np.float32)
     templastfabovea = np.zeros((sizex, sizey), dtype=np.float32)
     templastgabovea = np.zeros((sizex, sizey), dtype=np.float32)
-    bushplant = bush > 1.0
     sh = np.zeros((sizex, sizey), dtype=np.float32)  # shadows from buildings
     vbshvegsh = np.zeros(
         (sizex, sizey), dtype=np.float32
@@ -142,75 +282,52 @@ def shadowingfunction_20(
     vegsh = np.add(
         np.zeros((sizex, sizey), dtype=np.float32), bushplant, dtype=float
     )  # vegetation shadow
-    f = a
-
-    pibyfour = np.pi / 4.0
-    threetimespibyfour = 3.0 * pibyfour
-    fivetimespibyfour = 5.0 * pibyfour
-    seventimespibyfour = 7.0 * pibyfour
-    sinazimuth = np.sin(azimuth)
-    cosazimuth = np.cos(azimuth)
-    tanazimuth = np.tan(azimuth)
-    signsinazimuth = np.sign(sinazimuth)
-    signcosazimuth = np.sign(cosazimuth)
-    dssin = np.abs((1.0 / sinazimuth))
-    dscos = np.abs((1.0 / cosazimuth))
-    tanaltitudebyscale = np.tan(altitude) / scale
-    # index = 1
-    index = 0
+    f = a.astype(np.float64)
 
     # new case with pergola (thin vertical layer of vegetation), August 2021
-    dzprev = 0
+    dzprev = 0.0
 
     # main loop
-    while (amaxvalue >= dz) and (np.abs(dx) < sizex) and (np.abs(dy) < sizey):
-        if (
-            (pibyfour <= azimuth)
-            and (azimuth < threetimespibyfour)
-            or (fivetimespibyfour <= azimuth)
-            and (azimuth < seventimespibyfour)
-        ):
-            dy = signsinazimuth * index
-            dx = -1.0 * signcosazimuth * np.abs(np.round(index / tanazimuth))
-            ds = dssin
-        else:
-            dy = signsinazimuth * np.abs(np.round(index * tanazimuth))
-            dx = -1.0 * signcosazimuth * index
-            ds = dscos
-        # note: dx and dy represent absolute values while ds is an incremental value
-        dz = (ds * index) * tanaltitudebyscale
-        tempvegdem[0:sizex, 0:sizey] = 0.0
-        tempvegdem2[0:sizex, 0:sizey] = 0.0
-        temp[0:sizex, 0:sizey] = 0.0
-        templastfabovea[0:sizex, 0:sizey] = 0.0
-        templastgabovea[0:sizex, 0:sizey] = 0.0
-        absdx = np.abs(dx)
-        absdy = np.abs(dy)
-        xc1 = int((dx + absdx) / 2.0)
-        xc2 = int(sizex + (dx - absdx) / 2.0)
-        yc1 = int((dy + absdy) / 2.0)
-        yc2 = int(sizey + (dy - absdy) / 2.0)
-        xp1 = int(-((dx - absdx) / 2.0))
-        xp2 = int(sizex - (dx + absdx) / 2.0)
-        yp1 = int(-((dy - absdy) / 2.0))
-        yp2 = int(sizey - (dy + absdy) / 2.0)
-
-        tempvegdem[xp1:xp2, yp1:yp2] = vegdem[xc1:xc2, yc1:yc2] - dz
-        tempvegdem2[xp1:xp2, yp1:yp2] = vegdem2[xc1:xc2, yc1:yc2] - dz
-        temp[xp1:xp2, yp1:yp2] = a[xc1:xc2, yc1:yc2] - dz
-
-        f = np.fmax(f, temp)  # Moving building shadow
-        sh[(f > a)] = 1.0
-        sh[(f <= a)] = 0.0
-        fabovea = tempvegdem > a  # vegdem above DEM
-        gabovea = tempvegdem2 > a  # vegdem2 above DEM
-
-        # new pergola condition
-        templastfabovea[xp1:xp2, yp1:yp2] = vegdem[xc1:xc2, yc1:yc2] - dzprev
-        templastgabovea[xp1:xp2, yp1:yp2] = vegdem2[xc1:xc2, yc1:yc2] - dzprev
-        lastfabovea = templastfabovea > a
-        lastgabovea = templastgabovea > a
+    for k in range(dzs.shape[0]):
+        window = hp.active_window(stops, k, hp.PYRAMID_TILE, sizex, sizey)
+        if window is None:
+            break
+        r0, r1, c0, c1 = window
+        dx = dxs[k]
+        dy = dys[k]
+        dz = dzs[k]
+        win = (slice(r0, r1), slice(c0, c1))
+        tempvegdem[win] = 0.0
+        tempvegdem2[win] = 0.0
+        temp[win] = 0.0
+        templastfabovea[win] = 0.0
+        templastgabovea[win] = 0.0
+        # shifted grids clipped to the active window
+        x0 = max(-dx, 0, r0)
+        x1 = min(sizex - dx, sizex, r1)
+        y0 = max(-dy, 0, c0)
+        y1 = min(sizey - dy, sizey, c1)
+        if x0 < x1 and y0 < y1:
+            shifted = (slice(x0 + dx, x1 + dx), slice(y0 + dy, y1 + dy))
+            clipped = (slice(x0, x1), slice(y0, y1))
+            tempvegdem[clipped] = vegdem[shifted] - dz
+            tempvegdem2[clipped] = vegdem2[shifted] - dz
+            temp[clipped] = a[shifted] - dz
+            # new pergola condition
+            templastfabovea[clipped] = vegdem[shifted] - dzprev
+            templastgabovea[clipped] = vegdem2[shifted] - dzprev
         dzprev = dz
+
+        awin = a[win]
+        f[win] = np.fmax(f[win], temp[win])  # Moving building shadow
+        fwin = f[win]
+        shwin = sh[win]
+        shwin[(fwin > awin)] = 1.0
+        shwin[(fwin <= awin)] = 0.0
+        fabovea = tempvegdem[win] > awin  # vegdem above DEM
+        gabovea = tempvegdem2[win] > awin  # vegdem2 above DEM
+        lastfabovea = templastfabovea[win] > awin
+        lastgabovea = templastgabovea[win] > awin
         vegsh2 = np.add(
             np.add(np.add(fabovea, gabovea, dtype=float), lastfabovea, dtype=float),
             lastgabovea,
@@ -220,9 +337,10 @@ def shadowingfunction_20(
         # vegsh2[vegsh2 == 1] = 0. # This one is the ultimate question...
         vegsh2[vegsh2 > 0] = 1.0
 
-        vegsh = np.fmax(vegsh, vegsh2)
-        vegsh[(vegsh * sh > 0.0)] = 0.0
-        vbshvegsh = vegsh + vbshvegsh  # removing shadows 'behind' buildings
+        vegshwin = vegsh[win]
+        vegshwin[...] = np.fmax(vegshwin, vegsh2)
+        vegshwin[(vegshwin * shwin > 0.0)] = 0.0
+        vbshvegsh[win] += vegshwin  # removing shadows 'behind' buildings
 
         # im1 = ax1.imshow(fabovea)
         # im2 = ax2.imshow(gabovea)
@@ -239,8 +357,6 @@ def shadowingfunction_20(
         # plt.show()
         # plt.pause(0.05)
 
-        index += 1.0
-
     sh = 1.0 - sh
     vbshvegsh[(vbshvegsh > 0.0)] = 1.0
     vbshvegsh = vbshvegsh - vegsh
@@ -268,13 +384,103 @@ def shadowingfunction_20(
     # plt.show()
     # plt.pause(0.05)
 
-    shadowresult = {"sh": sh, "vegsh": vegsh, "vbshvegsh": vbshvegsh}
+    shadowresult = {
+        "sh": shadowmask.encode(sh, mask_format),
+        "vegsh": shadowmask.encode(vegsh, mask_format),
+        "vbshvegsh": shadowmask.encode(vbshvegsh, mask_format),
+    }
 
     return shadowresult
 
 
+@njit(parallel=True, cache=True)
+def shadowingfunction_20_parallel(
+    a: np.ndarray,
+    vegdem: np.ndarray,
+    vegdem2: np.ndarray,
+    bushplant: np.ndarray,
+    dxs: np.ndarray,
+    dys: np.ndarray,
+    dzs: np.ndarray,
+    stops: np.ndarray,
+    tile: int,
+):
+    # Compiled equivalent of shadowingfunction_20, parallel over rows
+    # The shifted grids are rounded to float32 as in the float32 temporaries of the
+    # NumPy version so that the outputs (and their dtypes) are identical
+    # Each tile of the row only marches up to its stop step from heightpyramid
+    sizex = a.shape[0]
+    sizey = a.shape[1]
+    nty = stops.shape[1]
+    sh = np.empty((sizex, sizey), dtype=np.float32)
+    vegsh = np.empty((sizex, sizey), dtype=np.float64)
+    vbshvegsh = np.empty((sizex, sizey), dtype=np.float64)
+    for i in prange(sizex):
+        f = np.empty(sizey, dtype=np.float64)
+        for j in range(sizey):
+            f[j] = a[i, j]
+            sh[i, j] = 0.0
+            vegsh[i, j] = 1.0 if bushplant[i, j] else 0.0
+            vbshvegsh[i, j] = 0.0
+        tx = i // tile
+        rowstop = 0
+        for ty in range(nty):
+            rowstop = max(rowstop, stops[tx, ty])
+        for k in range(rowstop):
+            dx = dxs[k]
+            dy = dys[k]
+            dz = dzs[k]
+            # new case with pergola (thin vertical layer of vegetation), August 2021
+            dzprev = dzs[k - 1] if k > 0 else 0.0
+            rowin = 0 <= i + dx < sizex
+            for j in range(sizey):
+                if stops[tx, j // tile] <= k:
+                    continue
+                if rowin and 0 <= j + dy < sizey:
+                    temp = np.float32(a[i + dx, j + dy] - dz)
+                    tempvegdem = np.float32(vegdem[i + dx, j + dy] - dz)
+                    tempvegdem2 = np.float32(vegdem2[i + dx, j + dy] - dz)
+                    templastfabovea = np.float32(vegdem[i + dx, j + dy] - dzprev)
+                    templastgabovea = np.float32(vegdem2[i + dx, j + dy] - dzprev)
+                else:
+                    temp = np.float32(0.0)
+                    tempvegdem = np.float32(0.0)
+                    tempvegdem2 = np.float32(0.0)
+                    templastfabovea = np.float32(0.0)
+                    templastgabovea = np.float32(0.0)
+                # np.fmax semantics
+                if temp > f[j] or f[j] != f[j]:
+                    f[j] = temp
+                aij = a[i, j]
+                if f[j] > aij:
+                    sh[i, j] = 1.0
+                elif f[j] <= aij:
+                    sh[i, j] = 0.0
+                vegsh2 = 0
+                if tempvegdem > aij:
+                    vegsh2 += 1
+                if tempvegdem2 > aij:
+                    vegsh2 += 1
+                if templastfabovea > aij:
+                    vegsh2 += 1
+                if templastgabovea > aij:
+                    vegsh2 += 1
+                if vegsh2 > 0 and vegsh2 < 4 and vegsh[i, j] < 1.0:
+                    vegsh[i, j] = 1.0
+                if vegsh[i, j] * sh[i, j] > 0.0:
+                    vegsh[i, j] = 0.0
+                vbshvegsh[i, j] += vegsh[i, j]
+        for j in range(sizey):
+            sh[i, j] = 1.0 - sh[i, j]
+            vbsh = 1.0 if vbshvegsh[i, j] > 0.0 else vbshvegsh[i, j]
+            vbshvegsh[i, j] = 1.0 - (vbsh - vegsh[i, j])
+            vegsh[i, j] = 1.0 - vegsh[i, j]
+
+    return sh, vegsh, vbshvegsh
+
+
 # NOTE: Numba offers limited gains in this case
-@njit
+@njit(cache=True)
 def shadowingfunction_20_numba(
     a: np.ndarray,
     vegdem: np.ndarray,
@@ -358,7 +564,6 @@ def shadowingfunction_20_numba(
             ds = dscos
         # note: dx and dy represent absolute values while ds is an incremental value
         dz = (ds * index) * tanaltitudebyscale
-        print(index, dz)
         tempvegdem[0:sizex, 0:sizey] = 0.0
         tempvegdem2[0:sizex, 0:sizey] = 0.0
         temp[0:sizex, 0:sizey] = 0.0
@@ -0,0 +1,112 @@
+import numpy as np
+
+# "float" keeps the float grids of the original shadow functions, "bool" returns
+# one byte per pixel and "packed" eight pixels per byte (np.packbits along rows)
+MASK_FORMATS = ("float", "bool", "packed")
+# dtypes of the SVF shadow matrices per format, float32 for memory
+MATRIX_DTYPES = {"float": np.float32, "bool": np.bool_, "packed": np.uint8}
+
+
+def check_mask_format(mask_format):
+    if mask_format not in MASK_FORMATS:
+        raise ValueError(
+            f"Unknown shadow mask format '{mask_format}', expected one of {MASK_FORMATS}"
+        )
+
+
+def encode(grid, mask_format):
+    """
+    Converts a binary (0 / 1) shadow grid to the requested mask format. Float grids
+    are returned unchanged for "float".
+    """
+    if mask_format == "float":
+        return grid
+    mask = grid if grid.dtype == np.bool_ else grid != 0
+    if mask_format == "packed":
+        return np.packbits(mask, axis=-1)
+    return mask
+
+
+def packed_cols(cols):
+    # number of bytes holding a packed row of cols pixels
+    return (cols + 7) // 8
+
+
+def unpack(mask, cols):
+    """
+    Bool view of a packed (uint8) mask with cols pixels per row. Float and bool
+    grids are returned unchanged.
+    """
+    if mask.dtype != np.uint8:
+        return mask
+    return np.unpackbits(mask, axis=-1, count=cols).view(np.bool_)
+
+
+def to_float(mask, cols):
+    # float64 grid from any mask format, 1 = sunlit
+    mask = unpack(mask, cols)
+    if mask.dtype == np.bool_:
+        return mask.astype(np.float64)
+    return mask
+
+
+def combine_veg(sh, vegsh, psi, cols):
+    """
+    Ground shadow including vegetation, sh - (1 - vegsh) * (1 - psi) with psi the
+    vegetation transmissivity term. Masks are combined by selection, which gives the
+    same values as the float expression.
+    """
+    if sh.dtype.kind == "f" and vegsh.dtype.kind == "f":
+        return sh - (1 - vegsh) * (1 - psi)
+    sh = unpack(sh, cols) != 0
+    vegsh = unpack(vegsh, cols) != 0
+    return np.where(vegsh, sh, sh - (1 - psi))
+
+
+def pack_patches(matrix):
+    """
+    SVF shadow matrix (rows, cols, patches) of 0 / 1 values bit-packed along the
+    patch axis, eight patches per byte (20 bytes per pixel for 153 patches instead
+    of 612 as float32). Returned as a dict of the packed "bits" and the number of
+    "patches", patches are read with patch().
+    """
+    return {
+        "bits": np.packbits(np.asarray(matrix) != 0, axis=-1),
+        "patches": matrix.shape[-1],
+    }
+
+
+def empty_patches(rows, cols, patches):
+    # bit-packed shadow matrix with all patches shaded, filled with set_patch
+    patches = int(patches)
+    bits = np.zeros((rows, cols, (patches + 7) // 8), dtype=np.uint8)
+    return {"bits": bits, "patches": patches}
+
+
+def unpack_patches(matrix):
+    # (rows, cols, patches) uint8 matrix from a bit-packed one
+    return np.unpackbits(matrix["bits"], axis=-1, count=matrix["patches"])
+
+
+def patch(matrix, idx):
+    """
+    Grid of patch idx of an SVF shadow matrix, unpacked to uint8 0 / 1 on the fly
+    for bit-packed matrices. Other matrices are indexed as matrix[:, :, idx].
+    """
+    if isinstance(matrix, dict):
+        return (matrix["bits"][:, :, idx >> 3] >> (7 - (idx & 7))) & 1
+    return matrix[:, :, idx]
+
+
+def set_patch(matrix, idx, grid, cols):
+    # stores the shadow grid (any mask format) of patch idx in a shadow matrix,
+    # None for matrices that are not kept
+    if matrix is None:
+        return
+    if not isinstance(matrix, dict):
+        matrix[:, :, idx] = grid
+        return
+    bit = np.uint8(1 << (7 - (idx & 7)))
+    layer = matrix["bits"][:, :, idx >> 3]
+    layer &= ~bit
+    layer |= (unpack(grid, cols) != 0).astype(np.uint8) * bit
@@ -0,0 +1,90 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from umep.util import shadowmask
+
+# shadow matrices of svfForProcessing153, one file each
+MATRICES = ("shmat", "vegshmat", "vbshvegshmat")
+META_FILE = "meta.json"
+
+
+def create_store(store_dir, rows, cols, patches, mask_format="float"):
+    """
+    On-disk store of the SVF shadow matrices, to be filled patch by patch.
+
+    Each matrix is a memory-mapped .npy file laid out as (patches, rows, cols), a
+    patch being one contiguous chunk, with packed masks holding eight pixels per
+    byte along the rows. Returns the store opened for writing, see open_store.
+    """
+    shadowmask.check_mask_format(mask_format)
+    path = Path(store_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    matcols = shadowmask.packed_cols(cols) if mask_format == "packed" else cols
+    for name in MATRICES:
+        # files are allocated sparse, zeros are not written
+        matrix = np.lib.format.open_memmap(
+            path / f"{name}.npy",
+            mode="w+",
+            dtype=shadowmask.MATRIX_DTYPES[mask_format],
+            shape=(patches, rows, matcols),
+        )
+        del matrix
+    meta = {"rows": rows, "cols": cols, "patches": patches, "mask_format": mask_format}
+    with open(path / META_FILE, "w") as f:
+        json.dump(meta, f, indent=2)
+
+    return open_store(store_dir, "r+")
+
+
+def open_store(store_dir, mode="r"):
+    """
+    Shadow matrix store as a dict of the rows, cols, patches and mask_format with
+    the (patches, rows, cols) memory maps of the matrices. Nothing is read until
+    the maps are indexed.
+    """
+    path = Path(store_dir)
+    if not (path / META_FILE).is_file():
+        raise ValueError(f"No shadow matrix store found in {store_dir}.")
+    with open(path / META_FILE) as f:
+        store = json.load(f)
+    store["dir"] = str(store_dir)
+    for name in MATRICES:
+        store[name] = np.load(path / f"{name}.npy", mmap_mode=mode)
+
+    return store
+
+
+def matrix(store, name):
+    # (rows, cols, patches) view as the in-memory matrices, [:, :, idx] maps a patch
+    return store[name].transpose(1, 2, 0)
+
+
+def read_patch(store, name, index):
+    # one patch of a matrix, packed masks are unpacked to bool
+    return shadowmask.unpack(np.asarray(store[name][index]), store["cols"])
+
+
+def read_window(store, name, window):
+    """
+    (rows, cols, patches) array of a matrix over the window (row0, row1, col0,
+    col1), packed masks unpacked to bool. Only the rows of the window are read.
+    """
+    row0, row1, col0, col1 = window
+    if store["mask_format"] != "packed":
+        return np.moveaxis(np.asarray(store[name][:, row0:row1, col0:col1]), 0, -1)
+    # whole bytes are read and the window is cut from the unpacked pixels
+    byte0 = col0 // 8
+    byte1 = shadowmask.packed_cols(col1)
+    grid = np.asarray(store[name][:, row0:row1, byte0:byte1])
+    grid = shadowmask.unpack(grid, (byte1 - byte0) * 8)
+    offset = byte0 * 8
+
+    return np.moveaxis(grid[:, :, col0 - offset : col1 - offset], 0, -1)
+
+
+def flush(store):
+    for name in MATRICES:
+        if isinstance(store[name], np.memmap):
+            store[name].flush()
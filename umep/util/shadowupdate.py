@@ -0,0 +1,244 @@
+import numpy as np
+
+from umep.util import shadowbatch, tiling
+from umep.util import shadowingfunctions as shadow
+
+GRIDS = ("a", "vegdem", "vegdem2", "walls", "aspect")
+
+
+def _copy(grid):
+    return None if grid is None else np.array(grid, copy=True)
+
+
+def _amaxvalue(grids):
+    amaxvalue = grids["a"].max()
+    if grids["vegdem"] is not None:
+        amaxvalue = np.maximum(amaxvalue, grids["vegdem"].max())
+    return amaxvalue
+
+
+def _bush(grids):
+    if grids["vegdem"] is None:
+        return None
+    return np.logical_not(grids["vegdem2"] * grids["vegdem"]) * grids["vegdem"]
+
+
+def shadow_state(
+    a,
+    azimuths,
+    altitudes,
+    scale,
+    vegdem=None,
+    vegdem2=None,
+    walls=None,
+    aspect=None,
+    backend="numpy",
+    workers=None,
+    mask_format="float",
+    amaxvalue=None,
+):
+    """
+    Shadows for a set of sun positions (above the horizon) together with the grids
+    they were cast from, to be updated after local edits with update_shadows.
+
+    See shadowbatch.iter_shadows for the arguments, the bush grid is derived from
+    the vegetation. Returns a dict holding the grids, the sun positions and
+    parameters and the stacked "shadows" from shadowbatch.shadowingfunction_batch.
+    """
+    grids = {
+        "a": _copy(a),
+        "vegdem": _copy(vegdem),
+        "vegdem2": _copy(vegdem2),
+        "walls": _copy(walls),
+        "aspect": _copy(aspect),
+    }
+    if amaxvalue is None:
+        amaxvalue = _amaxvalue(grids)
+    azimuths = np.atleast_1d(np.asarray(azimuths, dtype=float))
+    altitudes = np.atleast_1d(np.asarray(altitudes, dtype=float))
+    shadows = shadowbatch.shadowingfunction_batch(
+        grids["a"],
+        azimuths,
+        altitudes,
+        scale,
+        grids["vegdem"],
+        grids["vegdem2"],
+        amaxvalue,
+        _bush(grids),
+        grids["walls"],
+        grids["aspect"],
+        backend,
+        workers,
+        mask_format,
+    )
+
+    return {
+        "grids": grids,
+        "azimuths": azimuths,
+        "altitudes": altitudes,
+        "scale": scale,
+        "amaxvalue": amaxvalue,
+        "backend": backend,
+        "mask_format": mask_format,
+        "shadows": shadows,
+        "recast_fraction": 1.0,
+    }
+
+
+def affected_window(edit_mask, reach, azimuth, altitude, scale, packed=False):
+    """
+    Bounding window (row0, row1, col0, col1) of the pixels whose sun-ward ray
+    passes over an edited pixel within reach meters of height drop, i.e. the pixels
+    whose shadows an edit up to reach meters above the lowest surface can change.
+    The edit mask must hold at least one edited pixel.
+    """
+    erows = np.nonzero(edit_mask.any(axis=1))[0]
+    ecols = np.nonzero(edit_mask.any(axis=0))[0]
+    sizex, sizey = edit_mask.shape
+    # step 0 is the pixel itself, so the edited pixels are always included
+    dxs, dys, _ = shadow.shadow_steps(
+        azimuth, altitude, scale, sizex, sizey, max(reach, 0.0), index=0.0
+    )
+    # a pixel p is reached when p + (dx, dy) is edited
+    r0 = max(erows[0] - dxs.max(), 0)
+    r1 = min(erows[-1] + 1 - dxs.min(), sizex)
+    c0 = max(ecols[0] - dys.max(), 0)
+    c1 = min(ecols[-1] + 1 - dys.min(), sizey)
+    if packed:
+        # packed rows are updated in whole bytes
+        c0 = c0 // 8 * 8
+        c1 = min(-(-c1 // 8) * 8, sizey)
+
+    return int(r0), int(r1), int(c0), int(c1)
+
+
+def update_shadows(
+    state,
+    a,
+    vegdem=None,
+    vegdem2=None,
+    walls=None,
+    aspect=None,
+    edit_mask=None,
+):
+    """
+    Shadow state for edited grids, recasting only the pixels an edit can affect.
+
+    For each sun position the window of pixels whose sun-ward ray crosses the
+    edited region (see affected_window) is recast on the window padded by the
+    tiling halo, which gives the same shadows as a full run. The reach of an edit
+    is bounded by the highest edited surface, before or after the edit, over the
+    lowest surface of the grid.
+
+    state = shadow_state or a previous update_shadows result
+    a, vegdem, vegdem2, walls, aspect = edited grids, the same as in the state
+    edit_mask = edited pixels, found by comparing the grids with the state if None
+
+    Returns a new state, "recast_fraction" being the mean fraction of pixels recast
+    per sun position. The amaxvalue of the state is kept unless the edited grids
+    rise above it, in which case all shadows are cast again.
+    """
+    old = state["grids"]
+    grids = {
+        "a": _copy(a),
+        "vegdem": _copy(vegdem),
+        "vegdem2": _copy(vegdem2),
+        "walls": _copy(walls),
+        "aspect": _copy(aspect),
+    }
+    for key in GRIDS:
+        if (grids[key] is None) != (old[key] is None):
+            raise ValueError(f"The {key} grid must be given as in the shadow state.")
+        if grids[key] is not None and grids[key].shape != old["a"].shape:
+            raise ValueError("The edited grids must match the extent of the state.")
+    if edit_mask is None:
+        edit_mask = np.zeros(old["a"].shape, dtype=bool)
+        for key in GRIDS:
+            if grids[key] is not None:
+                edit_mask |= grids[key] != old[key]
+    elif edit_mask.shape != old["a"].shape:
+        raise ValueError("The edit mask must match the extent of the state.")
+
+    amaxvalue = state["amaxvalue"]
+    if _amaxvalue(grids) > amaxvalue:
+        return shadow_state(
+            grids["a"],
+            state["azimuths"],
+            state["altitudes"],
+            state["scale"],
+            grids["vegdem"],
+            grids["vegdem2"],
+            grids["walls"],
+            grids["aspect"],
+            state["backend"],
+            None,
+            state["mask_format"],
+        )
+
+    if not edit_mask.any():
+        return dict(state, grids=grids, recast_fraction=0.0)
+    # highest edited surface, before or after the edit
+    top = max(grids["a"][edit_mask].max(), old["a"][edit_mask].max())
+    for key in ("vegdem", "vegdem2"):
+        if grids[key] is not None:
+            top = max(top, grids[key][edit_mask].max(), old[key][edit_mask].max())
+    reach = top - min(grids["a"].min(), old["a"].min())
+    # the halo is taken over the whole grid, as for tiles
+    obstrmax = max(grids["a"].max(), 0.0)
+    if grids["vegdem"] is not None:
+        obstrmax = max(obstrmax, grids["vegdem"].max())
+    relief = obstrmax - grids["a"].min()
+    bush = _bush(grids)
+    packed = state["mask_format"] == "packed"
+    sizex, sizey = grids["a"].shape
+
+    shadows = {key: grid.copy() for key, grid in state["shadows"].items()}
+    recast = 0
+    for idx, (azimuth, altitude) in enumerate(
+        zip(state["azimuths"], state["altitudes"])
+    ):
+        core = affected_window(
+            edit_mask, reach, azimuth, altitude, state["scale"], packed
+        )
+        halo = tiling.halo_size(relief, amaxvalue, state["scale"], altitude)
+        r0, r1, c0, c1 = core
+        padded = (
+            max(r0 - halo, 0),
+            min(r1 + halo, sizex),
+            max(c0 - halo, 0),
+            min(c1 + halo, sizey),
+        )
+        window = {}
+        for key, grid in dict(grids, bush=bush).items():
+            grid = tiling._window(grid, padded)
+            # contiguous copies, the compiled kernels are specialised on the layout
+            window[key] = None if grid is None else np.ascontiguousarray(grid)
+        result = shadowbatch.shadowingfunction_batch(
+            window["a"],
+            azimuth,
+            altitude,
+            state["scale"],
+            window["vegdem"],
+            window["vegdem2"],
+            amaxvalue,
+            window["bush"],
+            window["walls"],
+            window["aspect"],
+            state["backend"],
+            1,
+            state["mask_format"],
+        )
+        for key, grid in result.items():
+            ispacked = grid.dtype == np.uint8
+            trows, tcols = tiling._core_index(core, padded, ispacked)
+            grows, gcols = tiling._grid_index(core, ispacked)
+            shadows[key][idx][grows, gcols] = grid[0][trows, tcols]
+        recast += (r1 - r0) * (c1 - c0)
+
+    positions = max(len(state["azimuths"]), 1)
+    return dict(
+        state,
+        grids=grids,
+        shadows=shadows,
+        recast_fraction=recast / (positions * sizex * sizey),
+    )
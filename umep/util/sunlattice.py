@@ -0,0 +1,79 @@
+import json
+
+import numpy as np
+
+
+def check_lattice(lattice):
+    # lattice = (azimuth step, altitude step) in degrees
+    if len(lattice) != 2 or min(lattice) <= 0:
+        raise ValueError(
+            "The sun lattice must be a pair of positive (azimuth, altitude) steps."
+        )
+
+
+def snap(azimuths, altitudes, lattice):
+    """
+    Sun positions moved to the nearest node of a lattice of (azimuth step, altitude
+    step) degrees, so that positions of different days and years share shadows.
+    Altitudes stay above the horizon (at least one step) and at most 90 degrees,
+    azimuths are wrapped to [0, 360).
+    """
+    check_lattice(lattice)
+    azstep, altstep = lattice
+    azimuths = np.asarray(azimuths, dtype=float)
+    altitudes = np.asarray(altitudes, dtype=float)
+    snapped_azimuths = np.mod(np.round(azimuths / azstep) * azstep, 360.0)
+    snapped_altitudes = np.clip(np.round(altitudes / altstep) * altstep, altstep, 90.0)
+
+    return snapped_azimuths, snapped_altitudes
+
+
+def angular_error(azimuths, altitudes, snapped_azimuths, snapped_altitudes):
+    # great circle angle (degrees) between the sun positions and the snapped ones
+    alt1 = np.radians(altitudes)
+    alt2 = np.radians(snapped_altitudes)
+    dazi = np.radians(np.asarray(azimuths) - np.asarray(snapped_azimuths))
+    cosangle = np.sin(alt1) * np.sin(alt2) + np.cos(alt1) * np.cos(alt2) * np.cos(dazi)
+
+    return np.degrees(np.arccos(np.clip(cosangle, -1.0, 1.0)))
+
+
+def snap_report(azimuths, altitudes, lattice):
+    """
+    Angular error of snapping sun positions (above the horizon) to a lattice.
+
+    Returns a dict with the lattice steps, the number of positions and of distinct
+    lattice nodes, i.e. the shadow grids to cast, and the mean and max errors in
+    degrees.
+    """
+    azimuths = np.asarray(azimuths, dtype=float)
+    altitudes = np.asarray(altitudes, dtype=float)
+    day = altitudes > 0
+    snapped_azimuths, snapped_altitudes = snap(azimuths[day], altitudes[day], lattice)
+    errors = angular_error(
+        azimuths[day], altitudes[day], snapped_azimuths, snapped_altitudes
+    )
+    nodes = set(zip(snapped_azimuths.tolist(), snapped_altitudes.tolist()))
+
+    return {
+        "azimuth_step": float(lattice[0]),
+        "altitude_step": float(lattice[1]),
+        "positions": int(day.sum()),
+        "unique_positions": len(nodes),
+        "mean_error": float(errors.mean()) if errors.size else 0.0,
+        "max_error": float(errors.max()) if errors.size else 0.0,
+    }
+
+
+def save_report(path, report):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def format_report(report):
+    return (
+        f"Sun positions snapped to a {report['azimuth_step']} x "
+        f"{report['altitude_step']} degree lattice: {report['positions']} positions "
+        f"on {report['unique_positions']} nodes, mean error "
+        f"{report['mean_error']:.3f} and max error {report['max_error']:.3f} degrees"
+    )
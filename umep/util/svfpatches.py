@@ -0,0 +1,160 @@
+"""
+SVF error and runtime of each sky patch option on a DSM.
+
+    python -m umep.util.svfpatches DSM.tif --cdsm CDSM.tif --output patches.json
+
+The SVFs of each option are compared with those of the finest option (609
+patches), so that screening runs can trade accuracy for throughput knowingly.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from umep import common
+from umep.functions import svf_functions as svf
+
+# 609 patches
+REFERENCE = 4
+GRIDS = ("svf", "svfE", "svfS", "svfW", "svfN")
+VEG_GRIDS = ("svfveg", "svfaveg")
+
+
+def _run(dsm, vegdem, vegdem2, scale, usevegdem, patch_option, backend, workers):
+    start = time.perf_counter()
+    result = svf.svfForProcessing153(
+        dsm,
+        vegdem,
+        vegdem2,
+        scale,
+        usevegdem,
+        backend,
+        workers,
+        keep_shmat=False,
+        patch_option=patch_option,
+    )
+    return result, time.perf_counter() - start
+
+
+def patch_report(
+    dsm,
+    scale,
+    vegdem=None,
+    vegdem2=None,
+    options=tuple(svf.PATCH_OPTIONS),
+    reference=REFERENCE,
+    backend="numpy",
+    workers=None,
+):
+    """
+    SVF error and runtime of sky patch options against a reference option.
+
+    Returns a dict with the reference option and its seconds, and a record per
+    option holding the number of patches, the seconds and speedup over the
+    reference and, per SVF grid, the mean absolute, root mean square and max
+    errors.
+    """
+    for patch_option in (*options, reference):
+        svf.check_patch_option(patch_option)
+    usevegdem = 0 if vegdem is None else 1
+    if vegdem is None:
+        vegdem = np.zeros(dsm.shape)
+    if vegdem2 is None:
+        vegdem2 = np.zeros(dsm.shape)
+    grids = GRIDS + (VEG_GRIDS if usevegdem == 1 else ())
+    args = (dsm, vegdem, vegdem2, scale, usevegdem)
+
+    exact, exact_seconds = _run(*args, reference, backend, workers)
+    records = []
+    for patch_option in options:
+        if patch_option == reference:
+            result, seconds = exact, exact_seconds
+        else:
+            result, seconds = _run(*args, patch_option, backend, workers)
+        record = {
+            "patch_option": patch_option,
+            "patches": svf.PATCH_OPTIONS[patch_option],
+            "seconds": seconds,
+            "speedup": exact_seconds / seconds if seconds > 0 else None,
+        }
+        for grid in grids:
+            error = np.abs(result[grid] - exact[grid])
+            record[grid] = {
+                "mean_error": float(error.mean()),
+                "rmse": float(np.sqrt(np.mean(error**2))),
+                "max_error": float(error.max()),
+            }
+        records.append(record)
+
+    return {
+        "reference": reference,
+        "reference_patches": svf.PATCH_OPTIONS[reference],
+        "reference_seconds": exact_seconds,
+        "options": records,
+    }
+
+
+def print_report(report, file=sys.stderr):
+    print(
+        f"SVF errors against {report['reference_patches']} patches "
+        f"({report['reference_seconds']:.2f} s)",
+        file=file,
+    )
+    for record in report["options"]:
+        print(
+            f"option {record['patch_option']} {record['patches']:>4} patches "
+            f"{record['seconds']:8.2f} s x{record['speedup'] or 0:.2f} "
+            f"svf mean {record['svf']['mean_error']:.4f} "
+            f"max {record['svf']['max_error']:.4f}",
+            file=file,
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="SVF error and runtime of each sky patch option."
+    )
+    parser.add_argument("dsm", help="DSM GeoTIFF")
+    parser.add_argument("--cdsm", help="vegetation canopy GeoTIFF")
+    parser.add_argument("--bbox", type=float, nargs=4, help="minx miny maxx maxy")
+    parser.add_argument(
+        "--options",
+        type=int,
+        nargs="+",
+        default=list(svf.PATCH_OPTIONS),
+        choices=list(svf.PATCH_OPTIONS),
+    )
+    parser.add_argument(
+        "--reference", type=int, default=REFERENCE, choices=list(svf.PATCH_OPTIONS)
+    )
+    parser.add_argument("--backend", default="numpy", choices=["numpy", "numba"])
+    parser.add_argument("--output", help="JSON file, printed when not given")
+    args = parser.parse_args(argv)
+
+    dsm, transf, crs = common.load_raster(args.dsm, args.bbox)
+    vegdem = None
+    if args.cdsm is not None:
+        vegdem, cdsm_transf, cdsm_crs = common.load_raster(args.cdsm, args.bbox)
+        if not (cdsm_crs == crs and cdsm_transf == transf):
+            raise ValueError("Mismatching CRS or transform for DSM and CDSM.")
+    report = patch_report(
+        dsm,
+        1 / transf.a,
+        vegdem,
+        options=args.options,
+        reference=args.reference,
+        backend=args.backend,
+    )
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import numpy as np
+
+from umep.functions import svf_functions as svf
+from umep.util import shadowmask, tiling
+from umep.util.SEBESOLWEIGCommonFiles.create_patches import create_patches
+
+# SVF rasters of svf_functions.svfForProcessing153
+SVF_NAMES = (
+    "svf",
+    "svfE",
+    "svfS",
+    "svfW",
+    "svfN",
+    "svfveg",
+    "svfEveg",
+    "svfSveg",
+    "svfWveg",
+    "svfNveg",
+    "svfaveg",
+    "svfEaveg",
+    "svfSaveg",
+    "svfWaveg",
+    "svfNaveg",
+)
+MATRIX_NAMES = ("shmat", "vegshmat", "vbshvegshmat")
+# mask format of the shadow matrices by dtype
+MATRIX_FORMATS = {
+    np.dtype(dtype): mask_format
+    for mask_format, dtype in shadowmask.MATRIX_DTYPES.items()
+}
+
+
+def influence_window(edit_mask, radius, packed=False):
+    """
+    Bounding window (row0, row1, col0, col1) of the pixels within radius pixels of
+    an edited pixel, i.e. the pixels whose sky patches can see the edit. The edit
+    mask must hold at least one edited pixel.
+    """
+    erows = np.nonzero(edit_mask.any(axis=1))[0]
+    ecols = np.nonzero(edit_mask.any(axis=0))[0]
+    rows, cols = edit_mask.shape
+    r0 = max(erows[0] - radius, 0)
+    r1 = min(erows[-1] + 1 + radius, rows)
+    c0 = max(ecols[0] - radius, 0)
+    c1 = min(ecols[-1] + 1 + radius, cols)
+    if packed:
+        # packed rows are updated in whole bytes
+        c0 = c0 // 8 * 8
+        c1 = min(-(-c1 // 8) * 8, cols)
+
+    return int(r0), int(r1), int(c0), int(c1)
+
+
+def update_svf(
+    svfs,
+    dsm,
+    vegdem,
+    vegdem2,
+    scale,
+    usevegdem,
+    edit_mask,
+    edit_height=None,
+    backend="numpy",
+    workers=None,
+    amaxvalue=None,
+    patch_option=2,
+):
+    """
+    SVFs for edited grids, recomputed only where the edit can be seen from.
+
+    A sky patch ray leaving a pixel rises by tan(altitude) per meter, so an edit
+    reaching edit_height can only be seen from pixels within
+    (edit_height - lowest surface) / tan(lowest patch altitude) meters, and no
+    further than the amaxvalue march. The SVFs of these pixels are recomputed on
+    their window padded by the tiling halo, which gives the same values as a full
+    run, and the other pixels keep the given values.
+
+    svfs = dict of svfForProcessing153 results for the grids before the edit, the
+    shadow matrices ("shmat", "vegshmat", "vbshvegshmat") are updated when given
+    as arrays (in memory or the memory maps of a shadowstore opened with "r+")
+    dsm, vegdem, vegdem2, scale, usevegdem = edited inputs of svfForProcessing153
+    edit_mask = footprint of the edit, pixels whose surface or vegetation changed
+    edit_height = highest surface (DSM, or DSM plus vegetation) in the footprint
+    before or after the edit. If None the window spans the amaxvalue march, or
+    the whole grid without amaxvalue, as removals are not held by the edited grids
+    amaxvalue = maximum obstruction height of both runs, of the edited grids as in
+    svfForProcessing153 if None
+
+    Returns a new dict holding the updated SVFs and shadow matrices (the arrays
+    given are updated in place), the "window" recomputed and its "recast_fraction"
+    of the grid.
+    """
+    svf.check_patch_option(patch_option)
+    if edit_mask.shape != dsm.shape:
+        raise ValueError("The edit mask must match the extent of the DSM.")
+    for name in SVF_NAMES[: 15 if usevegdem == 1 else 5]:
+        if svfs[name].shape != dsm.shape:
+            raise ValueError("The SVF rasters must match the extent of the DSM.")
+    matrices = {}
+    for name in MATRIX_NAMES:
+        matrix = svfs.get(name)
+        if matrix is None:
+            continue
+        if isinstance(matrix, dict):
+            raise TypeError("Bit-packed shadow matrices can not be updated.")
+        matrices[name] = matrix
+    mask_format = "float"
+    if matrices:
+        mask_format = MATRIX_FORMATS.get(matrices["shmat"].dtype)
+        if mask_format is None:
+            raise ValueError("Unknown shadow matrix type.")
+        if matrices["shmat"].shape[2] != svf.PATCH_OPTIONS[patch_option]:
+            raise ValueError("The shadow matrices are of another patch option.")
+    result = dict(svfs)
+    result["window"] = None
+    result["recast_fraction"] = 0.0
+    edit_mask = np.asarray(edit_mask, dtype=bool)
+    if not edit_mask.any():
+        return result
+
+    # as in svfForProcessing153, the vegetation is offset by the DSM
+    dsm32 = dsm.astype(np.float32)
+    vegdem32 = vegdem.astype(np.float32)
+    rows, cols = dsm.shape
+    # the grids before the edit were marched as far as what was removed, unless
+    # both runs share a given amaxvalue
+    reach = amaxvalue
+    if amaxvalue is None:
+        if usevegdem == 1:
+            amaxvalue = svf.svf_amaxvalue(dsm32, vegdem32)
+        else:
+            amaxvalue = dsm32.max()
+    surface = dsm32 + vegdem32 if usevegdem == 1 else dsm32
+    # the halo is taken over the whole grid, as for tiles
+    obstrmax = max(dsm32.max(), surface.max(), 0.0)
+    _, _, _, skyvaultaltint, _, _, _ = create_patches(patch_option)
+    low = skyvaultaltint.min()
+    if edit_height is not None:
+        relief = edit_height - dsm32.min()
+        reach = relief if reach is None else reach
+        radius = tiling.halo_size(relief, reach, scale, low)
+    elif reach is not None:
+        radius = tiling.halo_size(reach, reach, scale, low)
+    else:
+        # what was removed may have been the highest obstruction
+        radius = max(rows, cols)
+    core = influence_window(edit_mask, radius, mask_format == "packed")
+    halo = tiling.halo_size(obstrmax - dsm32.min(), amaxvalue, scale, low)
+    r0, r1, c0, c1 = core
+    padded = (
+        max(r0 - halo, 0),
+        min(r1 + halo, rows),
+        max(c0 - halo, 0),
+        min(c1 + halo, cols),
+    )
+    window = svf.svfForProcessing153(
+        tiling._window(dsm, padded),
+        tiling._window(vegdem, padded),
+        tiling._window(vegdem2, padded),
+        scale,
+        usevegdem,
+        backend,
+        workers,
+        mask_format,
+        amaxvalue,
+        keep_shmat=bool(matrices),
+        patch_option=patch_option,
+    )
+    for name in SVF_NAMES[: 15 if usevegdem == 1 else 5]:
+        trows, tcols = tiling._core_index(core, padded, False)
+        grid = np.array(svfs[name], copy=True)
+        grid[r0:r1, c0:c1] = window[name][trows, tcols]
+        result[name] = grid
+    packed = mask_format == "packed"
+    for name, matrix in matrices.items():
+        trows, tcols = tiling._core_index(core, padded, packed)
+        grows, gcols = tiling._grid_index(core, packed)
+        matrix[grows, gcols] = window[name][trows, tcols]
+    result["window"] = core
+    result["recast_fraction"] = (r1 - r0) * (c1 - c0) / (rows * cols)
+
+    return result
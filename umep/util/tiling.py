@@ -0,0 +1,330 @@
+import os
+from collections import deque
+
+import numpy as np
+from tqdm import tqdm
+
+from umep.functions import svf_functions as svf
+from umep.util import shadowbatch, shadowmask, shadowstore
+from umep.util import shadowingfunctions as shadow
+from umep.util.SEBESOLWEIGCommonFiles.create_patches import create_patches
+
+# tile sizes and halos are kept to whole bytes of the packed shadow masks
+TILE_ALIGN = 8
+# sun positions cast per tile task, bounds the memory of the stitched results
+TILE_POSITIONS = 8
+
+
+def _align(n):
+    return -(-int(n) // TILE_ALIGN) * TILE_ALIGN
+
+
+def halo_size(relief, amaxvalue, scale, min_altitude):
+    """
+    Halo in pixels around each tile for which tiled shadows match the untiled ones.
+
+    Each ray step advances at least one pixel along the main axis. The march stops
+    once the height drop exceeds amaxvalue, and a step can no longer shade a pixel
+    once its drop exceeds the relief (highest obstruction, or zero for the padding
+    outside the grid, minus the lowest surface). Steps further out than the halo
+    therefore have no effect on the tile core.
+
+    relief, amaxvalue = heights in meters
+    scale = scale of DSM (1 meter pixels=1, 2 meter pixels=0.5)
+    min_altitude = lowest sun or sky patch altitude in degrees
+    """
+    if min_altitude <= 0:
+        raise ValueError("Tiling requires sun or patch altitudes above the horizon.")
+    drop = max(min(relief, amaxvalue), 0.0)
+    reach = drop * scale / np.tan(np.radians(min_altitude))
+
+    return _align(np.ceil(reach) + 1)
+
+
+def tile_windows(rows, cols, tile_size, halo):
+    """
+    Splits a grid into tiles. Returns a list of (core, padded) windows given as
+    (row0, row1, col0, col1), the padded window extending the core by the halo
+    within the grid.
+    """
+    if tile_size < 1:
+        raise ValueError("Tile size must be a positive number of pixels.")
+    tile_size = _align(tile_size)
+    windows = []
+    for r0 in range(0, rows, tile_size):
+        for c0 in range(0, cols, tile_size):
+            r1 = min(r0 + tile_size, rows)
+            c1 = min(c0 + tile_size, cols)
+            padded = (
+                max(r0 - halo, 0),
+                min(r1 + halo, rows),
+                max(c0 - halo, 0),
+                min(c1 + halo, cols),
+            )
+            windows.append(((r0, r1, c0, c1), padded))
+
+    return windows
+
+
+def _window(grid, window):
+    # grid clipped to a window, None and scalars are passed through
+    if grid is None or np.ndim(grid) < 2:
+        return grid
+    r0, r1, c0, c1 = window
+    return grid[r0:r1, c0:c1]
+
+
+def _core_index(core, padded, packed):
+    # row and column slices of the core within a padded tile result
+    r0, r1, c0, c1 = core
+    rows = slice(r0 - padded[0], r1 - padded[0])
+    if packed:
+        # packed rows hold eight pixels per byte, tiles start on whole bytes
+        start = (c0 - padded[2]) // 8
+        return rows, slice(start, start + shadowmask.packed_cols(c1 - c0))
+    return rows, slice(c0 - padded[2], c1 - padded[2])
+
+
+def _grid_index(core, packed):
+    # row and column slices of the core within the stitched grid
+    r0, r1, c0, c1 = core
+    if packed:
+        start = c0 // 8
+        return slice(r0, r1), slice(start, start + shadowmask.packed_cols(c1 - c0))
+    return slice(r0, r1), slice(c0, c1)
+
+
+def _shadow_tile(
+    grids,
+    azimuths,
+    altitudes,
+    scale,
+    amaxvalue,
+    backend,
+    mask_format,
+    near_radius,
+    cache,
+):
+    # shadows for a chunk of sun positions on one padded tile
+    return shadowbatch.shadowingfunction_batch(
+        grids["a"],
+        azimuths,
+        altitudes,
+        scale,
+        grids["vegdem"],
+        grids["vegdem2"],
+        amaxvalue,
+        grids["bush"],
+        grids["walls"],
+        grids["aspect"],
+        backend,
+        1,
+        mask_format,
+        near_radius,
+        cache,
+    )
+
+
+def iter_shadows_tiled(
+    a,
+    azimuths,
+    altitudes,
+    scale,
+    vegdem=None,
+    vegdem2=None,
+    amaxvalue=None,
+    bush=None,
+    walls=None,
+    aspect=None,
+    backend="numpy",
+    workers=None,
+    mask_format="float",
+    tile_size=1024,
+    near_radius=None,
+    cache=None,
+):
+    """
+    Tiled equivalent of shadowbatch.iter_shadows, with the same arguments and
+    yielding the same (index, result) pairs.
+
+    The grid is split into tiles of tile_size pixels, each padded with a halo from
+    halo_size so that the stitched results match the untiled run exactly. Tiles are
+    cast in a pool of worker processes, a few sun positions at a time. With a
+    cache, entries are stored per tile.
+    """
+    shadow.check_backend(backend)
+    shadowmask.check_mask_format(mask_format)
+    azimuths = np.atleast_1d(np.asarray(azimuths, dtype=float))
+    altitudes = np.atleast_1d(np.asarray(altitudes, dtype=float))
+    if azimuths.shape != altitudes.shape:
+        raise ValueError("Azimuths and altitudes must be of the same length.")
+    if len(azimuths) == 0:
+        return
+    # DSM level values are taken from the whole grid, not from each tile
+    obstrmax = max(a.max(), 0.0)
+    if vegdem is not None:
+        obstrmax = max(obstrmax, vegdem.max())
+    if amaxvalue is None:
+        amaxvalue = a.max()
+        if vegdem is not None:
+            amaxvalue = np.maximum(amaxvalue, vegdem.max())
+    halo = halo_size(obstrmax - a.min(), amaxvalue, scale, altitudes.min())
+    windows = tile_windows(a.shape[0], a.shape[1], tile_size, halo)
+    grids = {
+        "a": a,
+        "vegdem": vegdem,
+        "vegdem2": vegdem2,
+        "bush": bush,
+        "walls": walls,
+        "aspect": aspect,
+    }
+
+    def submit(pool, start):
+        chunk = slice(start, start + TILE_POSITIONS)
+        return [
+            pool.submit(
+                _shadow_tile,
+                {key: _window(grid, padded) for key, grid in grids.items()},
+                azimuths[chunk],
+                altitudes[chunk],
+                scale,
+                amaxvalue,
+                backend,
+                mask_format,
+                near_radius,
+                cache,
+            )
+            for _, padded in windows
+        ]
+
+    with shadowbatch.process_pool(workers, backend) as pool:
+        pending = submit(pool, 0)
+        for start in range(0, len(azimuths), TILE_POSITIONS):
+            futures = pending
+            # the next chunk is cast while this one is consumed
+            if start + TILE_POSITIONS < len(azimuths):
+                pending = submit(pool, start + TILE_POSITIONS)
+            stitched = {}
+            for (core, padded), future in zip(windows, futures):
+                for key, grid in future.result().items():
+                    packed = grid.dtype == np.uint8
+                    if key not in stitched:
+                        cols = a.shape[1]
+                        if packed:
+                            cols = shadowmask.packed_cols(cols)
+                        stitched[key] = np.empty(
+                            (grid.shape[0], a.shape[0], cols), dtype=grid.dtype
+                        )
+                    trows, tcols = _core_index(core, padded, packed)
+                    grows, gcols = _grid_index(core, packed)
+                    stitched[key][:, grows, gcols] = grid[:, trows, tcols]
+            for j in range(len(azimuths[start : start + TILE_POSITIONS])):
+                yield start + j, {key: grid[j] for key, grid in stitched.items()}
+
+
+def _svf_tile(
+    grids, scale, usevegdem, backend, mask_format, amaxvalue, keep_shmat, patch_option
+):
+    # SVF and shadow matrices for one padded tile
+    return svf.svfForProcessing153(
+        grids["dsm"],
+        grids["vegdem"],
+        grids["vegdem2"],
+        scale,
+        usevegdem,
+        backend,
+        1,
+        mask_format,
+        amaxvalue,
+        keep_shmat=keep_shmat,
+        patch_option=patch_option,
+        show_progress=False,
+    )
+
+
+def svf_tiled(
+    dsm,
+    vegdem,
+    vegdem2,
+    scale,
+    usevegdem,
+    backend="numpy",
+    workers=None,
+    mask_format="float",
+    tile_size=1024,
+    shmat_dir=None,
+    keep_shmat=True,
+    patch_option=2,
+):
+    """
+    Tiled equivalent of svf_functions.svfForProcessing153, returning the same
+    dict. Tiles padded with a halo from halo_size are processed in a pool of
+    worker processes and stitched so that the results match the untiled run.
+    With shmat_dir the shadow matrices are stitched into a shadowstore instead of
+    memory, as in svfForProcessing153, and with keep_shmat False they are None.
+    """
+    shadow.check_backend(backend)
+    shadowmask.check_mask_format(mask_format)
+    svf.check_patch_option(patch_option)
+    if not keep_shmat and shmat_dir is not None:
+        raise ValueError("Shadow matrices that are not kept can not be stored.")
+    rows, cols = dsm.shape
+    # as in svfForProcessing153, the vegetation is offset by the DSM
+    dsm32 = dsm.astype(np.float32)
+    vegdem32 = vegdem.astype(np.float32)
+    if usevegdem == 1:
+        amaxvalue = svf.svf_amaxvalue(dsm32, vegdem32)
+    else:
+        amaxvalue = dsm32.max()
+    obstrmax = max(dsm32.max(), (vegdem32 + dsm32).max(), 0.0)
+    _, _, _, skyvaultaltint, aziinterval, _, _ = create_patches(patch_option)
+    halo = halo_size(obstrmax - dsm32.min(), amaxvalue, scale, skyvaultaltint.min())
+    windows = tile_windows(rows, cols, tile_size, halo)
+    grids = {"dsm": dsm, "vegdem": vegdem, "vegdem2": vegdem2}
+
+    stitched = {}
+    if shmat_dir is not None:
+        patches = int(aziinterval.sum())
+        store = shadowstore.create_store(shmat_dir, rows, cols, patches, mask_format)
+        for key in shadowstore.MATRICES:
+            stitched[key] = shadowstore.matrix(store, key)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with shadowbatch.process_pool(workers, backend) as pool:
+        # a bounded window of tiles in flight, each result is dropped once stitched
+        pending = deque()
+        tiles = iter(windows)
+        for core, padded in tqdm(windows):
+            while len(pending) < 2 * workers:
+                window = next(tiles, None)
+                if window is None:
+                    break
+                future = pool.submit(
+                    _svf_tile,
+                    {key: _window(grid, window[1]) for key, grid in grids.items()},
+                    scale,
+                    usevegdem,
+                    backend,
+                    mask_format,
+                    amaxvalue,
+                    keep_shmat,
+                    patch_option,
+                )
+                pending.append(future)
+            result = pending.popleft().result()
+            for key, grid in result.items():
+                if grid is None:
+                    stitched[key] = None
+                    continue
+                packed = grid.dtype == np.uint8
+                if key not in stitched:
+                    shape = (rows, shadowmask.packed_cols(cols) if packed else cols)
+                    stitched[key] = np.empty(shape + grid.shape[2:], dtype=grid.dtype)
+                trows, tcols = _core_index(core, padded, packed)
+                grows, gcols = _grid_index(core, packed)
+                stitched[key][grows, gcols] = grid[trows, tcols]
+            del result
+    if shmat_dir is not None:
+        shadowstore.flush(store)
+
+    return stitched
@@ -58,6 +58,8 @@ def generate_wall_hts(
     bbox: list[int, int, int, int],
     out_dir: str,
     wall_limit: float = 0,
+    aspect_backend: str = "numba",  # "numba" (compiled, parallel) or "numpy" wall
+    # aspect filter, both give the same aspects, negative wall limits run numpy
 ):
     """ """
     dsm_rast, dsm_transf, dsm_crs = common.load_raster(dsm_path, bbox)
@@ -70,7 +72,9 @@ def generate_wall_hts(
     walls = wa.findwalls(dsm_rast, wall_limit)
     common.save_raster(out_path_str + "/" + "wall_hts.tif", walls, dsm_transf, dsm_crs)
 
-    dirwalls = wa.filter1Goodwin_as_aspect_v3(walls, dsm_scale, dsm_rast)
+    dirwalls = wa.filter1Goodwin_as_aspect_v3(
+        walls, dsm_scale, dsm_rast, aspect_backend
+    )
     common.save_raster(
         out_path_str + "/" + "wall_aspects.tif", dirwalls, dsm_transf, dsm_crs
     )